@@ -1,10 +1,13 @@
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.urls import reverse
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
 from contextlib import suppress
 
-from rdrf.models.definition.models import Registry
+from rdrf.models.definition.models import Registry, ClinicalData
 from rdrf.models.definition.models import RegistryForm
 from rdrf.models.definition.models import RDRFContext
 from rdrf.models.definition.models import Section
@@ -18,6 +21,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# the typed value fields of a FieldValue
+VALUE_FIELDS = ["raw_value", "display_value", "raw_integer", "raw_float", "file_name", "raw_date", "raw_boolean"]
+PROJECTED_FIELDS = ["datatype", "is_range", "column_name"] + VALUE_FIELDS
+
+
 class FieldValue(models.Model):
     """
     Used for reporting
@@ -71,7 +79,6 @@ class FieldValue(models.Model):
 
     @classmethod
     def put(cls, registry_model, patient_model, context_model, form_model, section_model, cde_model, index, value):
-        datatype = cde_model.datatype.strip().lower()
         model, _ = cls.objects.get_or_create(
             registry=registry_model,
             patient=patient_model,
@@ -80,60 +87,72 @@ class FieldValue(models.Model):
             section=section_model,
             cde=cde_model,
             index=index)
+        model.assign(form_model, section_model, cde_model, index, value)
+        model.save()
 
-        model.datatype = model.set_datatype(datatype)
-        model.is_range = True if cde_model.pv_group else False
-        model.column_name = model.get_column_name(form_model,
-                                                  section_model,
-                                                  cde_model,
-                                                  index)
+    def assign(self, form_model, section_model, cde_model, index, value):
+        """
+        Sets the reporting fields from the clinical value of the cde
+        """
+        datatype = cde_model.datatype.strip().lower()
+        self.datatype = self.set_datatype(datatype)
+        self.is_range = True if cde_model.pv_group else False
+        self.column_name = self.get_column_name(form_model,
+                                                section_model,
+                                                cde_model,
+                                                index)
+        for field_name in VALUE_FIELDS:
+            setattr(self, field_name, None)
+        self.display_value = ""
         if value is None:
-            model.save()
             return
 
         if datatype == 'string':
             try:
-                model.raw_value = str(value)
+                self.raw_value = str(value)
             except BaseException:
                 pass
         elif cde_model.pv_group:
-            model.display_value = cde_model.get_display_value(value)
+            self.display_value = cde_model.get_display_value(value)
         elif datatype in ['integer', 'int', 'ineger']:
             try:
-                model.raw_integer = int(value)
+                self.raw_integer = int(value)
             except TypeError:
                 pass
             except ValueError:
                 pass
         elif datatype in ['boolean', 'bool']:
             try:
-                model.raw_boolean = bool(value)
+                self.raw_boolean = bool(value)
             except BaseException:
                 pass
         elif datatype in ['float', 'numeric', 'decimal']:
             try:
-                model.raw_float = float(value)
+                self.raw_float = float(value)
             except TypeError:
                 pass
             except ValueError:
                 pass
         elif datatype == 'date':
             try:
-                model.raw_date = parse_iso_date(value)
+                self.raw_date = parse_iso_date(value)
             except BaseException:
                 pass
         elif datatype == 'file':
             try:
-                model.file_name = value.get("file_name", None)
+                self.file_name = value.get("file_name", None)
             except BaseException:
                 pass
         else:
             try:
-                model.raw_value = str(value)
+                self.raw_value = str(value)
             except BaseException:
                 pass
 
-        model.save()
+    @property
+    def projection(self):
+        # the fields assign sets, to compare a stored row with a new one
+        return tuple(getattr(self, field_name) for field_name in PROJECTED_FIELDS)
 
     def set_datatype(self, datatype):
         if datatype in ['string', 'striing']:
@@ -314,3 +333,14 @@ class Query(models.Model):
         except KeyError as ke:
             errors.append("key error: %s" % ke)
         return errors
+
+
+@receiver(post_save, sender=ClinicalData)
+def clinical_data_saved(sender, instance, created, raw, using, update_fields, **kwargs):
+    # keep the report field values of the patient context current
+    if raw or getattr(settings, "FIELD_VALUES_PROJECTION", "sync") == "off":
+        return
+    if instance.collection != "cdes" or instance.django_model != "Patient" or instance.context_id is None:
+        return
+    from explorer.utils import schedule_field_values_projection
+    schedule_field_values_projection(instance, using)
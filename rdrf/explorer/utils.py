@@ -1,26 +1,63 @@
 from collections import OrderedDict
 import json
 
+from django.conf import settings
 from django.db import ProgrammingError
-from django.db import connection
+from django.db import connection, connections, router, transaction
 
+from rdrf.helpers import metadata_cache
+from rdrf.db.clinical_document import ClinicalDocument
+from rdrf.db import history as history_storage
+from rdrf.db.cde_index import CDEQuery
 from rdrf.helpers.utils import get_cached_instance
 from rdrf.helpers.utils import timed
 from rdrf.models.definition.models import Registry, RegistryForm, Section
 from rdrf.models.definition.models import CommonDataElement, ClinicalData
 
 from .models import Query
-from .models import FieldValue
+from .models import FieldValue, PROJECTED_FIELDS
 from .forms import QueryForm
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# explorer result rows whose field values are loaded together
+FIELD_VALUE_BATCH_SIZE = 500
+
+FIELD_VALUE_COLUMNS = ["patient_id", "context_id", "column_name", "datatype", "raw_value",
+                       "display_value", "raw_integer", "raw_float", "file_name", "raw_boolean", "raw_date"]
+
+
 class MissingDataError(Exception):
     pass
 
 
+def field_value_for_report(datatype, raw_value, display_value, raw_integer, raw_float, file_name, raw_boolean,
+                           raw_date):
+    """
+    The report value of a FieldValue from its columns, as chosen by
+    datatype. Returns ( found, value ): unknown datatypes are not reported.
+    """
+    if datatype == 'string':
+        return True, raw_value
+    if datatype == 'range':
+        return True, display_value
+    if datatype == 'integer':
+        return True, raw_integer
+    if datatype == 'float':
+        return True, raw_float
+    if datatype == 'file':
+        return True, file_name
+    if datatype == 'boolean':
+        return True, raw_boolean
+    if datatype == 'date':
+        return True, raw_date
+    if datatype == 'calculated':
+        return True, FieldValue(raw_value=raw_value).get_calculated_value()
+    return False, None
+
+
 class DatabaseUtils(object):
 
     result = None
@@ -139,7 +176,6 @@ class DatabaseUtils(object):
 
     @timed
     def generate_results2(self, reverse_column_map, col_map, max_items):
-        from registry.patients.models import Patient
         self.reverse_map = reverse_column_map
         self.col_map = col_map
         report_columns = col_map.values()
@@ -161,41 +197,31 @@ class DatabaseUtils(object):
                 sql_columns_dict["snapshot"] = False
             return sql_columns_dict
 
-        def sql_only_c():
+        # criteria given as a list of [ key, operator, value ] filter the
+        # patients on their indexed cde values
+        patient_ids = None
+        if isinstance(self.criteria, list) and self.criteria:
+            patient_ids = set(CDEQuery.from_spec(self.registry_model, self.criteria).patient_ids())
+
+        def rows():
             for row in self.cursor:
                 d = get_sql_dict(row)
+                if patient_ids is None or d.get("id") in patient_ids:
+                    yield d
+
+        def sql_only_c():
+            for d in rows():
                 yield d
 
         def full_new():
-            registry_id = self.registry_model.id
-            from copy import copy
-            for row in self.cursor:
-                row_dict = copy(blank_dict)
-                d = get_sql_dict(row)
-                row_dict.update(d)
-                patient_id = int(d['id'])
-                patient_model = Patient.objects.get(id=patient_id)
-                q = (FieldValue.objects.filter(registry_id=registry_id)
-                     .prefetch_related("patient")
-                     .prefetch_related("context")
-                     .prefetch_related("form")
-                     .prefetch_related("section")
-                     .prefetch_related("cde"))
-
-                for context_model in patient_model.context_models:
-                    context_id = context_model.pk
-                    row = copy(row_dict)
-                    row["context_id"] = context_id
-
-                    qry = q.filter(registry_id=registry_id,
-                                   patient_id=patient_id,
-                                   context_id=context_id,
-                                   column_name__in=report_columns,
-                                   index__lt=max_items)
-
-                    self._get_fvs_by_datatype(qry, row)
-
-                    yield row
+            batch = []
+            for d in rows():
+                batch.append(d)
+                if len(batch) == FIELD_VALUE_BATCH_SIZE:
+                    yield from self._pivot_field_values(batch, blank_dict, report_columns, max_items)
+                    batch = []
+            if batch:
+                yield from self._pivot_field_values(batch, blank_dict, report_columns, max_items)
 
         if self.mongo_search_type == "C":
             # current data - no longitudinal snapshots
@@ -211,23 +237,46 @@ class DatabaseUtils(object):
                                            max_items):
                 yield d
 
-    def _get_fvs_by_datatype(self, query, row):
-        for fv in query.filter(datatype='string'):
-            row[fv.column_name] = fv.raw_value
-        for fv in query.filter(datatype='range'):
-            row[fv.column_name] = fv.display_value
-        for fv in query.filter(datatype='integer'):
-            row[fv.column_name] = fv.raw_integer
-        for fv in query.filter(datatype='float'):
-            row[fv.column_name] = fv.raw_float
-        for fv in query.filter(datatype='file'):
-            row[fv.column_name] = fv.file_name
-        for fv in query.filter(datatype='boolean'):
-            row[fv.column_name] = fv.raw_boolean
-        for fv in query.filter(datatype='date'):
-            row[fv.column_name] = fv.raw_date
-        for fv in query.filter(datatype='calculated'):
-            row[fv.column_name] = fv.get_calculated_value()
+    def _pivot_field_values(self, sql_dicts, blank_dict, report_columns, max_items):
+        """
+        One report row per context of each sql result row's patient, filled
+        from the field values of all the patients loaded in one query
+        """
+        from copy import copy
+        from django.contrib.contenttypes.models import ContentType
+        from registry.patients.models import Patient
+        from rdrf.models.definition.models import RDRFContext
+        patient_ids = set(int(d['id']) for d in sql_dicts)
+        existing_ids = set(Patient.objects.filter(id__in=patient_ids).values_list("id", flat=True))
+        missing_ids = patient_ids - existing_ids
+        if missing_ids:
+            logger.warning("explorer report: patients %s not found" % sorted(missing_ids))
+
+        patient_contexts = {}
+        contexts = RDRFContext.objects.filter(content_type=ContentType.objects.get_for_model(Patient),
+                                              object_id__in=existing_ids).order_by("created_at")
+        for context_id, patient_id in contexts.values_list("id", "object_id"):
+            patient_contexts.setdefault(patient_id, []).append(context_id)
+
+        values = {}
+        field_values = FieldValue.objects.filter(registry_id=self.registry_model.id,
+                                                 patient_id__in=existing_ids,
+                                                 column_name__in=list(report_columns),
+                                                 index__lt=max_items).order_by("patient_id", "context_id")
+        for fv in field_values.values_list(*FIELD_VALUE_COLUMNS).iterator():
+            found, value = field_value_for_report(*fv[3:])
+            if found:
+                values.setdefault((fv[0], fv[1]), {})[fv[2]] = value
+
+        for d in sql_dicts:
+            row_dict = copy(blank_dict)
+            row_dict.update(d)
+            patient_id = int(d['id'])
+            for context_id in patient_contexts.get(patient_id, []):
+                row = copy(row_dict)
+                row["context_id"] = context_id
+                row.update(values.get((patient_id, context_id), {}))
+                yield row
 
     @timed
     def generate_results(self, reverse_column_map, col_map, max_items):
@@ -401,8 +450,8 @@ class DatabaseUtils(object):
         for cde_dict in self.projection:
             form_model = RegistryForm.objects.get(
                 name=cde_dict["formName"], registry=self.registry_model)
-            section_model = Section.objects.get(code=cde_dict["sectionCode"])
-            cde_model = CommonDataElement.objects.get(code=cde_dict["cdeCode"])
+            section_model = metadata_cache.load_section(cde_dict["sectionCode"])
+            cde_model = metadata_cache.load_cde(cde_dict["cdeCode"])
             column_name = self._get_database_column_name(form_model, section_model, cde_model)
             data["multisection_column_map"][(
                 form_model, section_model, cde_model)] = column_name
@@ -455,6 +504,8 @@ class DatabaseUtils(object):
         else:
             record = mongo_document
         result["context_id"] = record.get("context_id", None)
+        # index once - every report column is looked up in the same record
+        record = ClinicalDocument(record)
 
         # timestamp from top level in for current and snapshot
         result['timestamp'] = mongo_document.get("timestamp", None)
@@ -499,31 +550,18 @@ class DatabaseUtils(object):
         mongo_query = {"django_id": sql_column_data["id"],
                        "django_model": "Patient",
                        "record_type": "snapshot"}
-        for snapshot in history.find(**mongo_query).data():
+        for snapshot in history_storage.load_snapshots(history.find(**mongo_query).data()):
             yield self._get_result_map(snapshot, is_snapshot=True, max_items=max_items)
 
     def _get_cde_value(self, form_model, section_model, cde_model, mongo_document):
         # retrieve value of cde
-        for form_dict in mongo_document["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if section_dict["code"] == section_model.code:
-                        if section_dict["allow_multiple"]:
-                            values = []
-                            for section_item in section_dict["cdes"]:
-                                for cde_dict in section_item:
-                                    if cde_dict["code"] == cde_model.code:
-                                        values.append(
-                                            self._get_sensible_value_from_cde(
-                                                cde_model, cde_dict["value"]))
-
-                            return values
-                        else:
-                            for cde_dict in section_dict["cdes"]:
-                                if cde_dict["code"] == cde_model.code:
-                                    value = self._get_sensible_value_from_cde(
-                                        cde_model, cde_dict["value"])
-                                    return value
+        document = ClinicalDocument.wrap(mongo_document)
+        if document.is_multisection(form_model.name, section_model.code):
+            return [self._get_sensible_value_from_cde(cde_model, value)
+                    for value in document.values(form_model.name, section_model.code, cde_model.code)]
+        elif (form_model.name, section_model.code, cde_model.code) in document:
+            return self._get_sensible_value_from_cde(
+                cde_model, document.value(form_model.name, section_model.code, cde_model.code))
 
         if section_model.allow_multiple:
             # no data filled in?
@@ -590,62 +628,147 @@ class ParseQuery(object):
         pass
 
 
-def create_field_values(registry_model, patient_model, context_model, remove_existing=False, form_model=None):
+class FieldValueProjector(object):
     """
-    Create faster representations of the clinical data for reporting
+    Keeps the FieldValue rows of patient contexts in step with their cdes
+    records: the rows a record should have are diffed against the stored
+    ones and the inserts, updates and deletes applied in bulk in one
+    transaction.
     """
-    if remove_existing:
-        qry = FieldValue.objects.filter(registry=registry_model,
-                                        patient=patient_model,
-                                        context=context_model)
 
-        if form_model:
-            qry = qry.filter(form=form_model)
+    def __init__(self, registry_model):
+        self.registry_model = registry_model
 
-        qry.delete()
+    def project(self, patient_id, context_model, data, form_model=None):
+        """
+        Returns the number of rows created, updated and deleted
+        """
+        return self.project_many([(patient_id, context_model, data)], form_model)
 
-    dynamic_data = patient_model.get_dynamic_data(registry_model,
-                                                  context_id=context_model.id)
-    if dynamic_data:
-        for form_dict in dynamic_data["forms"]:
-            try:
-                form_model = RegistryForm.objects.get(name=form_dict["name"],
-                                                      registry=registry_model)
-            except RegistryForm.DoesNotExist:
+    def project_many(self, records, form_model=None):
+        """
+        :param records: ( patient id, context model, nested clinical data ) triples
+        :param form_model: only project this form
+        """
+        context_ids = [context_model.pk for _, context_model, _ in records]
+        existing = FieldValue.objects.filter(registry=self.registry_model, context_id__in=context_ids)
+        if form_model is not None:
+            existing = existing.filter(form=form_model)
+        existing = {self._key(fv.patient_id, fv.context_id, fv.form_id, fv.section_id, fv.cde_id, fv.index): fv
+                    for fv in existing}
+
+        to_create = []
+        to_update = []
+        for patient_id, context_model, data in records:
+            for key, fv in self._field_values(patient_id, context_model, data, form_model):
+                current = existing.pop(key, None)
+                if current is None:
+                    to_create.append(fv)
+                elif current.projection != fv.projection:
+                    for field_name in PROJECTED_FIELDS:
+                        setattr(current, field_name, getattr(fv, field_name))
+                    to_update.append(current)
+        to_delete = [fv.pk for fv in existing.values()]
+
+        with transaction.atomic(using=router.db_for_write(FieldValue)):
+            if to_delete:
+                FieldValue.objects.filter(pk__in=to_delete).delete()
+            FieldValue.objects.bulk_update(to_update, PROJECTED_FIELDS, batch_size=FIELD_VALUE_BATCH_SIZE)
+            FieldValue.objects.bulk_create(to_create, batch_size=FIELD_VALUE_BATCH_SIZE)
+        return len(to_create), len(to_update), len(to_delete)
+
+    def _key(self, patient_id, context_id, form_id, section_id, cde_id, index):
+        return patient_id, context_id, form_id, section_id, cde_id, index
+
+    def _field_values(self, patient_id, context_model, data, only_form_model):
+        if not data:
+            return
+        for form_dict in data.get("forms", []):
+            form_model = metadata_cache.get_form(self.registry_model, form_dict["name"])
+            if form_model is None:
+                continue
+            if only_form_model is not None and form_model.pk != only_form_model.pk:
                 continue
             for section_dict in form_dict["sections"]:
-                try:
-                    section_model = Section.objects.get(code=section_dict["code"])
-                except Section.DoesNotExist:
+                section_model = metadata_cache.get_section(section_dict["code"])
+                if section_model is None:
                     continue
                 if not section_dict["allow_multiple"]:
-                    for cde_dict in section_dict["cdes"]:
-                        try:
-                            cde_model = CommonDataElement.objects.get(code=cde_dict["code"])
-                        except CommonDataElement.DoesNotExist:
+                    items = [section_dict["cdes"]]
+                else:
+                    items = section_dict["cdes"]
+                for index, item in enumerate(items):
+                    for cde_dict in item:
+                        cde_model = metadata_cache.get_cde(cde_dict["code"])
+                        if cde_model is None:
                             continue
+                        fv = FieldValue(registry=self.registry_model,
+                                        patient_id=patient_id,
+                                        context=context_model,
+                                        form=form_model,
+                                        section=section_model,
+                                        cde=cde_model,
+                                        index=index)
+                        fv.assign(form_model, section_model, cde_model, index, cde_dict["value"])
+                        yield self._key(patient_id, context_model.pk, form_model.pk, section_model.pk,
+                                        cde_model.pk, index), fv
 
-                        FieldValue.put(registry_model,
-                                       patient_model,
-                                       context_model,
-                                       form_model,
-                                       section_model,
-                                       cde_model,
-                                       0,
-                                       cde_dict["value"])
-                else:
-                    for index, item in enumerate(section_dict["cdes"]):
-                        for cde_dict in item:
-                            try:
-                                cde_model = CommonDataElement.objects.get(code=cde_dict["code"])
-                            except CommonDataElement.DoesNotExist:
-                                continue
-
-                            FieldValue.put(registry_model,
-                                           patient_model,
-                                           context_model,
-                                           form_model,
-                                           section_model,
-                                           cde_model,
-                                           index,
-                                           cde_dict["value"])
+
+def create_field_values(registry_model, patient_model, context_model, remove_existing=False, form_model=None):
+    """
+    Create faster representations of the clinical data for reporting.
+    Rows no longer in the clinical data are always removed, so
+    remove_existing is kept for compatibility only.
+    """
+    dynamic_data = patient_model.get_dynamic_data(registry_model,
+                                                  context_id=context_model.id)
+    FieldValueProjector(registry_model).project(patient_model.pk, context_model, dynamic_data, form_model)
+
+
+def project_field_values(record_id):
+    """
+    Brings the field values of the context of a saved cdes record up to date
+    """
+    from rdrf.models.definition.models import RDRFContext
+    record = ClinicalData.objects.filter(pk=record_id).first()
+    if record is None or record.context_id is None:
+        return
+    context_model = RDRFContext.objects.filter(pk=record.context_id).select_related("registry").first()
+    if context_model is None or context_model.registry.code != record.registry_code:
+        return
+    # the first record of a context is the one the forms show
+    first_record = ClinicalData.objects.collection(record.registry_code, "cdes").filter(
+        django_model=record.django_model, django_id=record.django_id, context_id=record.context_id).first()
+    if first_record is None or first_record.pk != record.pk:
+        return
+    FieldValueProjector(context_model.registry).project(record.django_id, context_model, record.data)
+
+
+def _is_scheduled(using, record_id):
+    return any(getattr(func, "field_values_record_id", None) == record_id
+               for _, func in connections[using].run_on_commit)
+
+
+def schedule_field_values_projection(record, using):
+    """
+    Projects a saved cdes record once its transaction commits - once per
+    transaction however many times the record is saved - in a celery task
+    if settings.FIELD_VALUES_PROJECTION is "async"
+    """
+    asynchronous = getattr(settings, "FIELD_VALUES_PROJECTION", "sync") == "async"
+    record_id = record.pk
+    if _is_scheduled(using, record_id):
+        return
+
+    def run():
+        if asynchronous:
+            from rdrf.services.tasks import project_field_values as project_field_values_task
+            project_field_values_task.delay(record_id)
+        else:
+            try:
+                project_field_values(record_id)
+            except Exception as ex:
+                logger.error("error projecting field values of record %s: %s" % (record_id, ex))
+
+    run.field_values_record_id = record_id
+    transaction.on_commit(run, using=using)
@@ -0,0 +1,259 @@
+"""
+Indexed clinical values.
+
+The cde values sit in nested arrays of the clinical data json so filtering
+patients on them ( "all patients with CDE X = Y" ) scans every cdes record.
+A registry can list the cdes it filters on in its metadata:
+
+    "indexed_cdes": ["ClinicalForm____ClinicalSection____CDE01", ...]
+
+The values of those cdes are then kept in the CDEIndexValue table, one row
+per value ( per item for a multisection ), in a column typed from the cde
+datatype with a btree index. The rows of a patient context are rewritten
+whenever its cdes record is saved; update_cde_index rebuilds them after the
+list changes.
+
+CDEQuery compiles cde predicates into queries on that table:
+
+    CDEQuery(registry_model).filter("ClinicalForm____ClinicalSection____CDE01", "gte", 3).patient_ids()
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import router, transaction
+
+from rdrf.db.change_log import cde_values
+from rdrf.helpers import metadata_cache
+
+logger = logging.getLogger(__name__)
+
+TEXT = "value_text"
+NUMBER = "value_number"
+DATE = "value_date"
+
+NUMBER_DATATYPES = ("integer", "float", "calculated")
+# longer text values are not indexed ( btree entries are size limited )
+TEXT_LENGTH = 255
+
+OPERATORS = {
+    "eq": "",
+    "lt": "__lt",
+    "lte": "__lte",
+    "gt": "__gt",
+    "gte": "__gte",
+    "in": "__in",
+    "contains": "__icontains",
+}
+
+
+class CDEQueryError(Exception):
+    pass
+
+
+def parse_key(key):
+    if isinstance(key, str):
+        key = key.split(settings.FORM_SECTION_DELIMITER)
+    key = tuple(key)
+    if len(key) != 3:
+        raise CDEQueryError("Bad cde key %s" % (key, ))
+    return key
+
+
+def value_column(cde_code):
+    cde_model = metadata_cache.get_cde(cde_code)
+    datatype = cde_model.datatype.strip().lower() if cde_model else ""
+    if datatype in NUMBER_DATATYPES:
+        return NUMBER
+    if datatype == "date":
+        return DATE
+    return TEXT
+
+
+def convert(column, value):
+    """
+    value as stored in column, None if it does not convert
+    """
+    if value is None or value == "":
+        return None
+    if column == NUMBER:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    if column == DATE:
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        try:
+            return datetime.datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+        except ValueError:
+            return None
+    value = str(value)
+    return value if len(value) <= TEXT_LENGTH else None
+
+
+def make_rows(registry_code, patient_id, context_id, record, keys):
+    from rdrf.models.definition.models import CDEIndexValue
+    values = cde_values(record)
+    rows = []
+    for key in keys:
+        if key not in values:
+            continue
+        form_name, section_code, cde_code = key
+        column = value_column(cde_code)
+        items = values[key] if isinstance(values[key], list) else [values[key]]
+        for item, value in enumerate(items):
+            converted = convert(column, value)
+            if converted is not None:
+                rows.append(CDEIndexValue(registry_code=registry_code,
+                                          patient_id=patient_id,
+                                          context_id=context_id,
+                                          form_name=form_name,
+                                          section_code=section_code,
+                                          cde_code=cde_code,
+                                          item=item,
+                                          **{column: converted}))
+    return rows
+
+
+def _is_indexed_record(clinical_data):
+    if clinical_data.collection != "cdes" or clinical_data.django_model != "Patient":
+        return False
+    return bool(metadata_cache.get_indexed_cdes(clinical_data.registry_code))
+
+
+def update_record(clinical_data):
+    """
+    Rewrites the index rows of the patient context of a saved cdes record
+    """
+    from rdrf.models.definition.models import CDEIndexValue
+    if not _is_indexed_record(clinical_data):
+        return
+    keys = metadata_cache.get_indexed_cdes(clinical_data.registry_code)
+    rows = make_rows(clinical_data.registry_code, clinical_data.django_id, clinical_data.context_id,
+                     clinical_data.data, keys)
+    with transaction.atomic(using=router.db_for_write(CDEIndexValue)):
+        _context_rows(clinical_data).delete()
+        CDEIndexValue.objects.bulk_create(rows)
+
+
+def delete_record(clinical_data):
+    if _is_indexed_record(clinical_data):
+        _context_rows(clinical_data).delete()
+
+
+def _context_rows(clinical_data):
+    from rdrf.models.definition.models import CDEIndexValue
+    return CDEIndexValue.objects.filter(registry_code=clinical_data.registry_code,
+                                        patient_id=clinical_data.django_id,
+                                        context_id=clinical_data.context_id)
+
+
+def rebuild(registry_model, batch_size=500):
+    """
+    Rewrites all the index rows of the registry, returns the number written
+    """
+    from rdrf.models.definition.models import CDEIndexValue, ClinicalData
+    keys = registry_model.indexed_cdes
+    records = ClinicalData.objects.collection(registry_model.code, "cdes").filter(django_model="Patient")
+    written = 0
+    seen = set()
+    with transaction.atomic(using=router.db_for_write(CDEIndexValue)):
+        CDEIndexValue.objects.filter(registry_code=registry_model.code).delete()
+        if not keys:
+            return 0
+        rows = []
+        # ordered by pk: the first record of a context is the one the forms show
+        for patient_id, context_id, data in records.values_list("django_id", "context_id", "data").iterator(
+                chunk_size=batch_size):
+            if (patient_id, context_id) in seen:
+                continue
+            seen.add((patient_id, context_id))
+            rows.extend(make_rows(registry_model.code, patient_id, context_id, data, keys))
+            if len(rows) >= batch_size:
+                CDEIndexValue.objects.bulk_create(rows)
+                written += len(rows)
+                rows = []
+        CDEIndexValue.objects.bulk_create(rows)
+        written += len(rows)
+    return written
+
+
+class CDEQuery(object):
+    """
+    Patients whose indexed cde values match all the predicates
+    """
+
+    def __init__(self, registry_model, context_ids=None, predicates=None):
+        self.registry_model = registry_model
+        self.context_ids = context_ids
+        self.predicates = list(predicates or [])
+
+    @classmethod
+    def from_spec(cls, registry_model, spec, context_ids=None):
+        """
+        spec is a list of [ key, operator, value ] as json would give it
+        """
+        query = cls(registry_model, context_ids)
+        for predicate in spec:
+            if not isinstance(predicate, (list, tuple)) or len(predicate) != 3:
+                raise CDEQueryError("Bad cde predicate %s" % (predicate, ))
+            query = query.filter(*predicate)
+        return query
+
+    @staticmethod
+    def is_indexed(registry_model, key):
+        return parse_key(key) in metadata_cache.get_indexed_cdes(registry_model.code)
+
+    def filter(self, key, operator, value):
+        key = parse_key(key)
+        if not self.is_indexed(self.registry_model, key):
+            raise CDEQueryError("%s is not an indexed cde of registry %s" % (
+                settings.FORM_SECTION_DELIMITER.join(key), self.registry_model.code))
+        if operator not in OPERATORS:
+            raise CDEQueryError("Unknown cde operator %s" % operator)
+        return CDEQuery(self.registry_model, self.context_ids, self.predicates + [(key, operator, value)])
+
+    def _compile_predicate(self, key, operator, value):
+        from rdrf.models.definition.models import CDEIndexValue
+        form_name, section_code, cde_code = key
+        column = value_column(cde_code)
+        if operator == "contains":
+            column, converted = TEXT, str(value)
+        elif operator == "in":
+            converted = [convert(column, v) for v in value]
+        else:
+            converted = convert(column, value)
+            if converted is None:
+                raise CDEQueryError("%s is not a valid value for %s" % (value, cde_code))
+        rows = CDEIndexValue.objects.filter(registry_code=self.registry_model.code,
+                                            form_name=form_name,
+                                            section_code=section_code,
+                                            cde_code=cde_code,
+                                            **{column + OPERATORS[operator]: converted})
+        if self.context_ids is not None:
+            rows = rows.filter(context_id__in=self.context_ids)
+        return rows
+
+    def compile(self):
+        """
+        The queryset of the matching patient ids ( in the clinical database )
+        """
+        if not self.predicates:
+            raise CDEQueryError("No cde predicates")
+        query = None
+        for predicate in self.predicates:
+            rows = self._compile_predicate(*predicate)
+            if query is not None:
+                rows = rows.filter(patient_id__in=query)
+            query = rows.values("patient_id")
+        return query.values_list("patient_id", flat=True).distinct()
+
+    def patient_ids(self):
+        return list(self.compile())
+
+    def filter_patients(self, patients):
+        # the index is in the clinical database so the ids are materialised
+        return patients.filter(pk__in=self.patient_ids())
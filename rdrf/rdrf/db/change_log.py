@@ -0,0 +1,117 @@
+"""
+Per cde change log of the clinical data.
+
+Every history snapshot also adds a CDEChange row for each cde value which
+differs from the previous snapshot of the same patient context, so the
+history of one field is a single indexed query instead of a scan of the
+patient's snapshots. The values are those get_cde_value returns: a list of
+the item values for a multisection cde.
+
+Rows of existing history are written by the backfill_cde_changes command;
+until it has run for a registry its history is read from the snapshots.
+"""
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def cde_values(record):
+    """
+    (form name, section code, cde code) -> value of every cde in record
+    """
+    values = {}
+    for form_dict in (record or {}).get("forms", []):
+        for section_dict in form_dict.get("sections", []):
+            if section_dict.get("allow_multiple"):
+                # values of a cde absent from an item are left out, as get_cde_value does
+                keys = set()
+                items = []
+                for item in section_dict.get("cdes", []):
+                    items.append({cde_dict["code"]: cde_dict.get("value") for cde_dict in item})
+                    keys.update(items[-1].keys())
+                for cde_code in keys:
+                    values[(form_dict["name"], section_dict["code"], cde_code)] = [
+                        item[cde_code] for item in items if cde_code in item]
+            else:
+                for cde_dict in section_dict.get("cdes", []):
+                    values[(form_dict["name"], section_dict["code"], cde_dict["code"])] = cde_dict.get("value")
+    return values
+
+
+def changed_values(previous_record, record):
+    """
+    The ( key, value ) pairs of record differing from previous_record.
+    A cde which is no longer in record changes to None.
+    """
+    previous = cde_values(previous_record)
+    current = cde_values(record)
+    changes = [(key, value) for key, value in current.items() if key not in previous or previous[key] != value]
+    changes.extend((key, None) for key, value in previous.items() if key not in current and value is not None)
+    return changes
+
+
+def parse_timestamp(timestamp):
+    # snapshot timestamps are str(datetime.now())
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp
+    try:
+        return datetime.datetime.strptime(str(timestamp)[:19], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def make_changes(snapshot_model, snapshot, previous_record):
+    """
+    The unsaved CDEChange rows of a history snapshot ( its data, with the
+    record filled in ), given the record of the previous snapshot of the
+    same patient context
+    """
+    from rdrf.models.definition.models import CDEChange
+    if snapshot.get("django_model", "Patient") != "Patient":
+        return []
+    timestamp = parse_timestamp(snapshot.get("timestamp")) or datetime.datetime.now()
+    return [CDEChange(registry_code=snapshot_model.registry_code,
+                      patient_id=snapshot_model.django_id,
+                      context_id=snapshot_model.context_id,
+                      form_name=form_name,
+                      section_code=section_code,
+                      cde_code=cde_code,
+                      value=value,
+                      username=snapshot.get("username"),
+                      timestamp=timestamp,
+                      snapshot_id=snapshot_model.pk)
+            for (form_name, section_code, cde_code), value in changed_values(previous_record, snapshot["record"])]
+
+
+def log_changes(snapshot_model, snapshot, previous_record):
+    from rdrf.models.definition.models import CDEChange
+    changes = make_changes(snapshot_model, snapshot, previous_record)
+    if changes:
+        CDEChange.objects.bulk_create(changes)
+    return changes
+
+
+def get_changes(registry_code, patient_id, form_name, section_code, cde_code):
+    from rdrf.models.definition.models import CDEChange
+    return CDEChange.objects.filter(registry_code=registry_code,
+                                    patient_id=patient_id,
+                                    form_name=form_name,
+                                    section_code=section_code,
+                                    cde_code=cde_code).order_by("timestamp", "pk")
+
+
+def is_logged(registry_code):
+    """
+    Whether all the history of the registry is in the change log: the saves
+    since the log exists are, the earlier ones once backfill_cde_changes ran
+    """
+    from rdrf.models.definition.models import CDEChangeBackfill
+    return CDEChangeBackfill.objects.filter(registry_code=registry_code).exists()
+
+
+def mark_logged(registry_codes):
+    from rdrf.models.definition.models import CDEChangeBackfill
+    for registry_code in registry_codes:
+        CDEChangeBackfill.objects.update_or_create(registry_code=registry_code,
+                                                   defaults={"backfilled_at": datetime.datetime.now()})
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+
+
+class ClinicalDocument(object):
+    """
+    Indexed, read-only view over a nested clinical record:
+
+      {"forms": [{"name": ..., "sections": [{"code": ..., "allow_multiple": ..., "cdes": ...}]}]}
+
+    The nested lists are walked once when the document is built so that
+    values can then be looked up by (form, section, cde) or by multisection
+    item index without rescanning the record.
+    Where the record contains duplicate entries the first one wins, which
+    matches the behaviour of the linear scans this replaces.
+    The index is a snapshot - if the underlying data is mutated build a new
+    document.
+    """
+
+    def __init__(self, data):
+        self.data = data if data is not None else {}
+        self._forms = OrderedDict()       # form name -> form dict
+        self._sections = OrderedDict()    # (form name, section code) -> section dict
+        self._cdes = {}                   # (form name, section code) -> OrderedDict(cde code -> value)
+        self._items = {}                  # (form name, section code) -> [OrderedDict(cde code -> value)]
+        self._build()
+
+    @classmethod
+    def wrap(cls, data):
+        """
+        Return data as a ClinicalDocument, reusing it if already wrapped.
+        None is passed through so callers can keep their "no record" checks.
+        """
+        if data is None or isinstance(data, cls):
+            return data
+        return cls(data)
+
+    def _build(self):
+        for form_dict in self.data.get("forms") or []:
+            form_name = form_dict.get("name")
+            if form_name in self._forms:
+                continue
+            self._forms[form_name] = form_dict
+            for section_dict in form_dict.get("sections") or []:
+                section_key = (form_name, section_dict.get("code"))
+                if section_key in self._sections:
+                    continue
+                self._sections[section_key] = section_dict
+                if section_dict.get("allow_multiple"):
+                    self._items[section_key] = [self._index_item(item)
+                                                for item in section_dict.get("cdes") or []]
+                else:
+                    self._cdes[section_key] = self._index_item(section_dict.get("cdes"))
+
+    @staticmethod
+    def _index_item(item):
+        item_map = OrderedDict()
+        for cde_dict in item or []:
+            code = cde_dict.get("code")
+            if code not in item_map:
+                item_map[code] = cde_dict.get("value")
+        return item_map
+
+    def __contains__(self, key):
+        form_name, section_code, cde_code = key
+        return cde_code in self._cdes.get((form_name, section_code), {})
+
+    @property
+    def form_names(self):
+        return list(self._forms.keys())
+
+    def has_form(self, form_name):
+        return form_name in self._forms
+
+    def has_section(self, form_name, section_code):
+        return (form_name, section_code) in self._sections
+
+    def is_multisection(self, form_name, section_code):
+        return (form_name, section_code) in self._items
+
+    def get_form(self, form_name):
+        return self._forms.get(form_name)
+
+    def get_section(self, form_name, section_code):
+        return self._sections.get((form_name, section_code))
+
+    def sections(self, form_name):
+        """
+        Section dicts of the given form in stored order
+        """
+        return [section_dict for (f, _), section_dict in self._sections.items() if f == form_name]
+
+    def value(self, form_name, section_code, cde_code, default=None):
+        """
+        Value of a cde in a non-multisection
+        """
+        return self._cdes.get((form_name, section_code), {}).get(cde_code, default)
+
+    def items(self, form_name, section_code):
+        """
+        Items of a multisection as a list of (cde code -> value) maps
+        """
+        return self._items.get((form_name, section_code), [])
+
+    def num_items(self, form_name, section_code):
+        return len(self._items.get((form_name, section_code), []))
+
+    def item_value(self, form_name, section_code, cde_code, index, default=None):
+        """
+        Value of a cde in the item at (0 based) index of a multisection
+        """
+        items = self._items.get((form_name, section_code), [])
+        if 0 <= index < len(items):
+            return items[index].get(cde_code, default)
+        return default
+
+    def values(self, form_name, section_code, cde_code):
+        """
+        Values of a cde across all items of a multisection
+        """
+        return [item[cde_code] for item in self._items.get((form_name, section_code), [])
+                if cde_code in item]
+
+    def first_value(self, form_name, section_code, cde_code):
+        """
+        The value of a cde, or its first value if it is in a multisection
+        """
+        if self.is_multisection(form_name, section_code):
+            for value in self.values(form_name, section_code, cde_code):
+                return value
+            return None
+        return self.value(form_name, section_code, cde_code)
+
+    def lookup(self, form_name, section_code, cde_code):
+        """
+        Same contract as rdrf.helpers.utils.get_cde_value: a list of values
+        for a multisection, the value for a normal section and None when the
+        section is not in the record.
+        """
+        if self.is_multisection(form_name, section_code):
+            return self.values(form_name, section_code, cde_code)
+        return self.value(form_name, section_code, cde_code)
+
+    def iter_values(self, form_name=None):
+        """
+        Yields (form name, section code, item index, cde code, value) for every
+        stored value. item index is None for non-multisections.
+        """
+        for (f, section_code) in self._sections:
+            if form_name is not None and f != form_name:
+                continue
+            if (f, section_code) in self._items:
+                for index, item in enumerate(self._items[(f, section_code)]):
+                    for cde_code, value in item.items():
+                        yield f, section_code, index, cde_code, value
+            else:
+                for cde_code, value in self._cdes[(f, section_code)].items():
+                    yield f, section_code, None, cde_code, value
@@ -2,6 +2,7 @@ from rdrf.models.definition.models import Registry
 from rdrf.models.definition.models import RDRFContext
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from collections import defaultdict
 
 import logging
 
@@ -30,6 +31,37 @@ def create_rdrf_default_contexts(patient, registry_ids):
             return context_manager.get_or_create_default_context(patient)
 
 
+def get_default_contexts(registry_model, patient_ids):
+    """
+    patient id -> default context of the patient in the registry ( as
+    Patient.default_context ) for a batch of patients, in one query
+    """
+    from rdrf.models.definition.models import RegistryType
+    from registry.patients.models import Patient
+    registry_type = registry_model.registry_type
+    if registry_type == RegistryType.HAS_CONTEXTS:
+        return {}
+    patient_contexts = defaultdict(list)
+    for context_model in RDRFContext.objects.filter(registry=registry_model,
+                                                    content_type=ContentType.objects.get_for_model(Patient),
+                                                    object_id__in=patient_ids) \
+                                            .select_related("context_form_group") \
+                                            .order_by("created_at"):
+        patient_contexts[context_model.object_id].append(context_model)
+
+    defaults = {}
+    for patient_id, context_models in patient_contexts.items():
+        if registry_type == RegistryType.NORMAL:
+            if len(context_models) == 1:
+                defaults[patient_id] = context_models[0]
+        else:
+            for context_model in context_models:
+                if context_model.context_form_group and context_model.context_form_group.is_default:
+                    defaults[patient_id] = context_model
+                    break
+    return defaults
+
+
 class RDRFContextManager(object):
 
     def __init__(self, registry_model):
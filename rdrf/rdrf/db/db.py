@@ -17,6 +17,9 @@ class RegistryRouter:
         ("rdrf", "formprogress"),
         ("rdrf", "modjgo"),
         ("rdrf", "clinicaldata"),
+        ("rdrf", "cdechange"),
+        ("rdrf", "cdechangebackfill"),
+        ("rdrf", "cdeindexvalue"),
     )
 
     @classmethod
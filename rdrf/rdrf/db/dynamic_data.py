@@ -1,13 +1,20 @@
+import copy
 import datetime
+import uuid
 from operator import itemgetter
 from itertools import zip_longest
 import logging
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.conf import settings
+from django.db import router, transaction
 
+from rdrf.helpers import metadata_cache
 from rdrf.helpers.utils import BadKeyError
 
 from rdrf.db import filestorage
+from rdrf.db import change_log
+from rdrf.db import history as history_storage
+from rdrf.db.clinical_document import ClinicalDocument
 from rdrf.forms.file_upload import FileUpload, wrap_fs_data_for_form
 from rdrf.models.definition.models import Registry, ClinicalData
 from rdrf.helpers.utils import get_code, models_from_mongo_key, is_delimited_key, mongo_key, is_multisection
@@ -20,6 +27,14 @@ class FormParsingError(Exception):
     pass
 
 
+def deferred_side_effects():
+    """
+    Whether the history snapshots of saves are written in a celery task
+    after the save commits ( settings.FORM_SAVE_SIDE_EFFECTS is "async" )
+    """
+    return getattr(settings, "FORM_SAVE_SIDE_EFFECTS", "sync") == "async"
+
+
 class KeyValueMissing(Exception):
     pass
 
@@ -81,35 +96,26 @@ def section_not_allow_multiple(s, i):
 def get_mongo_value(registry_code, nested_data, delimited_key, multisection_index=None):
     """
     Grabs a CDE value out of the mongo document.
-      nested_data: mongo document dict
+      nested_data: mongo document dict or ClinicalDocument
       delimited_key: form_name____section_code____cde_code
     """
     registry_model = Registry.objects.get(code=registry_code)
     form_model, section_model, cde_model = models_from_mongo_key(registry_model, delimited_key)
+    document = ClinicalDocument.wrap(nested_data)
 
     if multisection_index is None:
-        sectionp = None
-    else:
-
-        def sectionp(s, ij):
-            return ij[1] == multisection_index
+        if document.is_multisection(form_model.name, section_model.code):
+            return None
+        return document.value(form_model.name, section_model.code, cde_model.code)
 
-    cdes = find_cdes(
-        nested_data,
-        form_model.name,
-        section_model.code,
-        cde_model.code,
-        sectionp=sectionp,
-        multisection=multisection_index is not None)
-    for cde in cdes:
-        return cde["value"]
-    return None
+    return document.item_value(form_model.name, section_model.code, cde_model.code, multisection_index)
 
 
 def update_multisection_file_cdes(registry_code, multisection_code, form_section_items, form_model,
                                   existing_nested_data, index_map):
 
     updates = []
+    existing_document = ClinicalDocument.wrap(existing_nested_data)
 
     for item_index, section_item_dict in enumerate(form_section_items):
         for key, value in section_item_dict.items():
@@ -118,7 +124,7 @@ def update_multisection_file_cdes(registry_code, multisection_code, form_section
                 actual_index = index_map[item_index]
 
                 existing_value = get_mongo_value(
-                    registry_code, existing_nested_data, key, multisection_index=actual_index)
+                    registry_code, existing_document, key, multisection_index=actual_index)
 
                 # antecedent here will never return true and the definition is not correct
                 if is_multiple_file_cde(cde_code):
@@ -318,8 +324,8 @@ class FormDataParser(object):
         the_section_model = None
         multisection_item_list = self.form_data[multisection_code]
         if len(multisection_item_list) == 0:
-            from rdrf.models.definition.models import Section
-            section_model = Section.objects.get(code=multisection_code)
+            from rdrf.helpers.metadata_cache import get_section
+            section_model = get_section(multisection_code)
             self.parsed_multisections[(self.form_model, section_model)] = []
             return
         items = []
@@ -465,6 +471,8 @@ class DynamicDataWrapper(object):
 
         # holds reference to the complete data record for this object
         self.patient_record = None
+        # (registry code, collection) -> record updated but not yet saved ( see commit_dynamic_data )
+        self.pending_records = {}
 
     def __str__(self):
         return "Dynamic Data Wrapper for %s id=%s" % (self.obj.__class__.__name__, self.obj.pk)
@@ -517,11 +525,11 @@ class DynamicDataWrapper(object):
 
     def get_cde_history(self, registry_code, form_name, section_code, cde_code):
         from rdrf.helpers.utils import get_cde_value
-        from rdrf.models.definition.models import Registry, RegistryForm, Section, CommonDataElement
+        from rdrf.models.definition.models import Registry, RegistryForm
         registry_model = Registry.objects.get(code=registry_code)
         form_model = RegistryForm.objects.get(registry=registry_model, name=form_name)
-        section_model = Section.objects.get(code=section_code)
-        cde_model = CommonDataElement.objects.get(code=cde_code)
+        section_model = metadata_cache.load_section(section_code)
+        cde_model = metadata_cache.load_cde(cde_code)
 
         def fmt(snapshot, snapshot_number):
             return {
@@ -542,9 +550,18 @@ class DynamicDataWrapper(object):
 
             return list(filter(is_different, snapshots))
 
+        if change_log.is_logged(registry_code):
+            changes = change_log.get_changes(registry_code, self.django_id, form_name, section_code, cde_code)
+            return collapse_same([{"timestamp": change.timestamp,
+                                   "value": change.value,
+                                   "user": change.username,
+                                   "id": str(change.pk)} for change in changes])
+
+        # history not in the change log yet ( see backfill_cde_changes )
         record_query = self._get_record(registry_code, "history", filter_by_context=False)
         record_query = record_query.find(record_type="snapshot")
-        data = [fmt(snapshot, i) for i, snapshot in enumerate(record_query.data())]
+        snapshots = history_storage.load_snapshots(record_query.data())
+        data = [fmt(snapshot, i) for i, snapshot in enumerate(snapshots)]
         return collapse_same(sorted(data, key=itemgetter("timestamp")))
 
     def load_registry_specific_data(self, registry_model=None):
@@ -577,8 +594,8 @@ class DynamicDataWrapper(object):
 
     def _is_section_code(self, code):
         # Supplied code will be non-delimited
-        from rdrf.models.definition.models import Section
-        return Section.objects.filter(code=code).exists()
+        from rdrf.helpers.metadata_cache import get_section
+        return get_section(code) is not None
 
     @staticmethod
     def handle_file_upload(registry_code, key, value, current_value):
@@ -614,10 +631,11 @@ class DynamicDataWrapper(object):
         return list(filter(bool, updated))
 
     def _update_files_in_fs(self, existing_record, registry, new_data, index_map):
+        existing_document = ClinicalDocument(existing_record)
         for key, value in new_data.items():
             cde_code = get_code(key)
             if is_file_cde(cde_code):
-                existing_value = get_mongo_value(registry, existing_record, key)
+                existing_value = get_mongo_value(registry, existing_document, key)
                 if is_multiple_file_cde(cde_code):
                     new_data[key] = self.handle_file_uploads(registry, key, value, existing_value)
                 else:
@@ -625,7 +643,7 @@ class DynamicDataWrapper(object):
 
             elif (self._is_section_code(key) and self.current_form_model and index_map is not None):
                 new_data[key] = update_multisection_file_cdes(registry, key, value, self.current_form_model,
-                                                              existing_record, index_map)
+                                                              existing_document, index_map)
 
     def update_dynamic_data(self, registry_model, cdes_record):
         # replace entire cdes record with supplied one
@@ -693,11 +711,18 @@ class DynamicDataWrapper(object):
                           parse_all_forms=False,
                           index_map=None,
                           additional_data=None,
-                          skip_bad_key=False):
+                          skip_bad_key=False,
+                          commit=True):
+        """
+        With commit=False the updated record is kept in memory ( and updated
+        by the next calls ) until commit_dynamic_data saves it
+        """
         self._convert_date_to_datetime(form_data)
 
         if self.CREATE_MODE:
             record = None
+        elif (registry, collection_name) in self.pending_records:
+            record = self.pending_records[(registry, collection_name)]
         else:
             record = self._get_record(registry, collection_name).first()
 
@@ -740,41 +765,103 @@ class DynamicDataWrapper(object):
             self.rdrf_context_id = context_id
 
         record.data.update(nested_data)
-        record.save()
+        if commit:
+            record.save()
+        else:
+            self.pending_records[(registry, collection_name)] = record
+        return record
+
+    def commit_dynamic_data(self, registry, collection_name):
+        """
+        Saves the record updated by the save_dynamic_data(..., commit=False)
+        calls in one write and returns it ( None if there were none )
+        """
+        record = self.pending_records.pop((registry, collection_name), None)
+        if record is not None:
+            record.save()
+        return record
+
+    def _make_snapshot(self, registry_code, record, form_name=None, form_user=None):
+        return {
+            "django_id": record.data['django_id'],
+            "django_model": record.data.get("django_model", None),
+            "registry_code": registry_code,
+            "record_type": "snapshot",
+            "username": self.user.username if self.user else None,
+            "timestamp": str(datetime.datetime.now()),
+            "form_user": form_user,
+            "form_name": form_name,
+            "record": record.data,
+        }
+
+    def _write_snapshot(self, registry_code, snapshot):
+        history_records = self._get_record(registry_code, "history")
+        previous = history_records.filter(data__record_type="snapshot").order_by("-pk").data()[:1]
+        previous = history_storage.load_snapshots(previous)
+        history = self._make_record(registry_code, "history", data=history_storage.compact(snapshot, history_records))
+        # the username is the one of the save, not of a deferred write
+        history.data["username"] = snapshot["username"]
+        history.save()
+        change_log.log_changes(history, snapshot, previous[0]["record"] if previous else None)
 
     def _save_longitudinal_snapshot(self, registry_code, record, form_name=None, form_user=None):
         try:
-            timestamp = str(datetime.datetime.now())
             patient_id = record.data['django_id']
-            snapshot = {
-                "django_id": patient_id,
-                "django_model": record.data.get("django_model", None),
-                "registry_code": registry_code,
-                "record_type": "snapshot",
-                "username": self.user.username if self.user else None,
-                "timestamp": timestamp,
-                "form_user": form_user,
-                "form_name": form_name,
-                "record": record.data,
-            }
-
-            history = self._make_record(registry_code, "history", data=snapshot)
-            history.save()
+            self._write_snapshot(registry_code, self._make_snapshot(registry_code, record, form_name, form_user))
         except Exception as ex:
             from registry.patients.models import Patient
             patient_model = Patient.objects.get(id=patient_id)
             logger.error("Couldn't add to history for patient %s: %s" % (getattr(patient_model, settings.LOG_PATIENT_FIELDNAME), ex))
 
-    def save_snapshot(self, registry_code, collection_name, form_name=None, form_user=None):
-        record = self._get_record(registry_code, collection_name).first()
-        if record is not None:
+    def _schedule_snapshot(self, registry_code, record, form_name=None, form_user=None):
+        # the record is copied now: the task writes the state of this save
+        # even if the record changes again before it runs
+        snapshot = self._make_snapshot(registry_code, record, form_name, form_user)
+        snapshot["record"] = copy.deepcopy(record.data)
+        snapshot["save_id"] = uuid.uuid4().hex
+        django_id = self.obj.pk
+        context_id = self.rdrf_context_id
+
+        def run():
+            from rdrf.services.tasks import save_history_snapshot
+            save_history_snapshot.delay(registry_code, django_id, context_id, snapshot)
+
+        transaction.on_commit(run, using=router.db_for_write(ClinicalData))
+
+    def save_deferred_snapshot(self, registry_code, snapshot):
+        """
+        Writes a snapshot scheduled by save_snapshot, once however many times
+        its task is delivered. Returns whether it was written.
+        """
+        with transaction.atomic(using=router.db_for_write(ClinicalData)):
+            history_records = self._get_record(registry_code, "history")
+            if history_records.filter(data__save_id=snapshot["save_id"]).exists():
+                return False
+            self._write_snapshot(registry_code, snapshot)
+        return True
+
+    def save_snapshot(self, registry_code, collection_name, form_name=None, form_user=None, record=None):
+        """
+        record is the ( just saved ) record to snapshot, loaded if not given
+        """
+        if record is None:
+            record = self._get_record(registry_code, collection_name).first()
+        if record is None:
+            return
+        if deferred_side_effects() and self.rdrf_context_id != "add":
+            self._schedule_snapshot(registry_code, record, form_name=form_name, form_user=form_user)
+        else:
             self._save_longitudinal_snapshot(registry_code, record, form_name=form_name, form_user=form_user)
 
-    def save_form_progress(self, registry_code, context_model=None):
+    def save_form_progress(self, registry_code, context_model=None, dynamic_data=None):
+        """
+        dynamic_data is the nested cdes record, loaded if not given
+        """
         from rdrf.forms.progress.form_progress import FormProgress
         registry_model = Registry.objects.get(code=registry_code)
         form_progress = FormProgress(registry_model)
-        dynamic_data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
+        if dynamic_data is None:
+            dynamic_data = self.load_dynamic_data(registry_code, "cdes", flattened=False)
         return form_progress.save_progress(self.obj, dynamic_data, context_model)
 
     def _convert_date_to_datetime(self, data):
@@ -1,16 +1,37 @@
 from django.conf import settings
+from rdrf.helpers import metadata_cache
+from rdrf.db.contexts_api import get_default_contexts
 from rdrf.services.io.reporting import report_field_functions
 from registry.patients.models import Patient, PatientAddress
 from rdrf.models.definition.models import ConsentSection, ConsentQuestion
-from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
+from rdrf.models.definition.models import RegistryForm, Section
 from rdrf.helpers.utils import get_cde_value
 from collections import OrderedDict
 
+import datetime
 import logging
 import collections
 
 logger = logging.getLogger(__name__)
 
+# the relations of the patients the expressions read, loaded for a whole
+# batch by GeneralisedFieldExpressionParser.evaluate_many
+PATIENT_PREFETCH = ("working_groups", "rdrf_registry", "consents", "patientaddress_set")
+
+
+def _prefetched(model, name):
+    """
+    The prefetched related objects of model, None if they weren't prefetched
+    """
+    return getattr(model, "_prefetched_objects_cache", {}).get(name)
+
+
+def _get_form(registry_model, form_name):
+    form_model = metadata_cache.get_form(registry_model, form_name)
+    if form_model is None:
+        raise RegistryForm.DoesNotExist("Form %s does not exist" % form_name)
+    return form_model
+
 
 class FieldExpressionError(Exception):
     pass
@@ -183,8 +204,7 @@ class PokeFieldExpression(GeneralisedFieldExpression):
         # FORMNAME, SECTIONCODE  - set_value will update
         _, form_name, section_code, item_num_string, cde_code = field_expression.split("/")
         self.item_number = int(item_num_string)
-        self.form_model = RegistryForm.objects.get(registry=self.registry_model,
-                                                   name=form_name)
+        self.form_model = _get_form(self.registry_model, form_name)
         self.section_model = self._get_section_model(section_code)
         self.cde_model = self._get_cde_model(cde_code)
 
@@ -368,7 +388,18 @@ class ConsentExpression(GeneralisedFieldExpression):
         self.field = field
 
     def evaluate(self, patient_model, mongo_data):
-        return patient_model.get_consent(self.consent_question_model, self.field)
+        consent_values = _prefetched(patient_model, "consents")
+        if consent_values is None:
+            return patient_model.get_consent(self.consent_question_model, self.field)
+        # as Patient.get_consent, from the prefetched registries and consents
+        registry_id = self.consent_question_model.section.registry_id
+        consent_value = None
+        if any(registry_model.pk == registry_id for registry_model in patient_model.rdrf_registry.all()):
+            consent_value = next((cv for cv in consent_values
+                                  if cv.consent_question_id == self.consent_question_model.pk), None)
+        if consent_value is None:
+            return False if self.field == "answer" else None
+        return getattr(consent_value, self.field)
 
     def set_value(self, patient_model, mongo_data, new_value, **kwargs):
         # must be answer field , True False for new_value
@@ -410,12 +441,20 @@ class AddressExpression(GeneralisedFieldExpression):
         self.field = field
 
     def evaluate(self, patient_model, mongo_data):
-
-        try:
-            address_model = PatientAddress.objects.get(patient=patient_model,
-                                                       address_type=self.address_type_model)
-        except PatientAddress.DoesNotExist:
-            return None
+        addresses = _prefetched(patient_model, "patientaddress_set")
+        if addresses is None:
+            try:
+                address_model = PatientAddress.objects.get(patient=patient_model,
+                                                           address_type=self.address_type_model)
+            except PatientAddress.DoesNotExist:
+                return None
+        else:
+            matching = [a for a in addresses if a.address_type_id == self.address_type_model.pk]
+            if not matching:
+                return None
+            if len(matching) > 1:
+                raise PatientAddress.MultipleObjectsReturned("more than one %s address" % self.address_type_model.type)
+            address_model = matching[0]
 
         return getattr(address_model, self.field.lower())
 
@@ -427,6 +466,9 @@ class AddressesExpression(GeneralisedFieldExpression):
         self.registry_model = registry_model
 
     def evaluate(self, patient_model, mongo_data):
+        addresses = _prefetched(patient_model, "patientaddress_set")
+        if addresses is not None:
+            return list(addresses)
         return [
             address_object for address_object in PatientAddress.objects.filter(
                 patient=patient_model)]
@@ -575,6 +617,54 @@ class GeneralisedFieldExpressionParser(object):
         return s
 
     def parse(self, field_expression):
+        """
+        The expression object of field_expression, parsed once per registry
+        until the definitions change ( see metadata_cache )
+        """
+        expressions = metadata_cache.get_field_expression_cache()
+        key = (self.registry_model.code, field_expression)
+        if key not in expressions:
+            expressions[key] = self._parse(field_expression)
+        return expressions[key]
+
+    def evaluate_many(self, patients, field_expressions):
+        """
+        { patient id: [ value of each field expression ] } for the patients
+        ( models or ids ), the clinical values read from the record of their
+        default context. The patients with their working groups, registries,
+        consents and addresses, their contexts and their clinical records are
+        loaded for the whole batch in a fixed number of queries.
+        """
+        from rdrf.models.definition.models import ClinicalData
+        expressions = [self.parse(field_expression) for field_expression in field_expressions]
+        patient_ids = [getattr(patient, "pk", patient) for patient in patients]
+        patient_models = Patient.objects.filter(pk__in=patient_ids) \
+                                        .select_related("next_of_kin_relationship") \
+                                        .prefetch_related(*PATIENT_PREFETCH)
+        contexts = get_default_contexts(self.registry_model, patient_ids)
+        records = {}
+        if contexts:
+            cdes = ClinicalData.objects.collection(self.registry_model.code, "cdes").filter(
+                django_model="Patient", context_id__in=[context_model.pk for context_model in contexts.values()])
+            # ordered by pk: the first record of a context is the one the forms show
+            for patient_id, data in cdes.values_list("django_id", "data"):
+                records.setdefault(patient_id, data)
+
+        results = {}
+        for patient_model in patient_models:
+            mongo_data = records.get(patient_model.pk)
+            if mongo_data is None:
+                # as Patient.evaluate_field_expression
+                context_model = contexts.get(patient_model.pk)
+                mongo_data = {"django_id": patient_model.pk,
+                              "django_model": "Patient",
+                              "timestamp": datetime.datetime.now(),
+                              "context_id": context_model.pk if context_model else None,
+                              "forms": []}
+            results[patient_model.pk] = [expression(patient_model, mongo_data) for expression in expressions]
+        return results
+
+    def _parse(self, field_expression):
         try:
             if field_expression.startswith("Consents/"):
                 return self._parse_consent_expression(field_expression)
@@ -616,13 +706,12 @@ class GeneralisedFieldExpressionParser(object):
             raise FieldExpressionError("Cannot parse multisection expression")
 
         try:
-            form_model = RegistryForm.objects.get(name=form_name,
-                                                  registry=self.registry_model)
+            form_model = _get_form(self.registry_model, form_name)
         except RegistryForm.DoesNotExist:
             raise FieldExpressionError("Cannot find form %s" % form_name)
 
         try:
-            section_model = Section.objects.get(code=multisection_code)
+            section_model = metadata_cache.load_section(multisection_code)
         except Section.DoesNotExist:
             raise FieldExpressionError("Cannot find section %s" % multisection_code)
 
@@ -662,8 +751,8 @@ class GeneralisedFieldExpressionParser(object):
             raise FieldExpressionError("consent section does not exist")
 
         try:
-            consent_question_model = ConsentQuestion.objects.get(code=consent_code,
-                                                                 section=consent_section_model)
+            consent_question_model = ConsentQuestion.objects.select_related("section").get(
+                code=consent_code, section=consent_section_model)
         except ConsentQuestion.DoesNotExist:
             raise FieldExpressionError("consent question does not exist")
 
@@ -725,10 +814,9 @@ class GeneralisedFieldExpressionParser(object):
         ClinicalFormName/SectionCode/CDECode
         """
         form_name, section_code, cde_code = field_expression.split("/")
-        form_model = RegistryForm.objects.get(
-            name=form_name, registry=self.registry_model)
-        section_model = Section.objects.get(code=section_code)
-        cde_model = CommonDataElement.objects.get(code=cde_code)
+        form_model = _get_form(self.registry_model, form_name)
+        section_model = metadata_cache.load_section(section_code)
+        cde_model = metadata_cache.load_cde(cde_code)
 
         return ClinicalFormExpression(self.registry_model,
                                       form_model,
@@ -0,0 +1,231 @@
+"""
+Storage of the clinical data history.
+
+Every form save adds a "snapshot" record to the history collection. Stored in
+full, a snapshot holds a copy of the whole cdes record of the context under
+"record". With settings.HISTORY_STORAGE = "delta" only every
+HISTORY_CHECKPOINT_INTERVAL-th snapshot of a context is stored in full ( a
+checkpoint ); the others hold under "delta" just what changed since their
+checkpoint, referenced by "checkpoint_id":
+
+    {"set": {top level key: value}, "unset": [top level key],
+     "forms": [{"name": form name}                      # unchanged
+               {"name": form name, "full": form dict}   # replaced
+               {"name": form name,
+                "sections": [{"code": section code},                   # unchanged
+                             {"code": section code, "full": section dict},
+                             {"code": section code, "cdes": {cde code: value}}]}]}
+
+Snapshots written before this, or in the full mode, are checkpoints, so both
+kinds can be read side by side. Readers should go through load_snapshots /
+get_snapshot_record rather than reading "record" directly.
+"""
+from copy import deepcopy
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FULL = "full"
+DELTA = "delta"
+
+
+def storage_mode():
+    return getattr(settings, "HISTORY_STORAGE", FULL)
+
+
+def checkpoint_interval():
+    return getattr(settings, "HISTORY_CHECKPOINT_INTERVAL", 10)
+
+
+def is_delta(snapshot):
+    return "delta" in snapshot and "record" not in snapshot
+
+
+# Encoding
+
+def _index(items, key):
+    return {item.get(key): item for item in items}
+
+
+def _shape(section):
+    return ({k: v for k, v in section.items() if k != "cdes"},
+            None if section.get("allow_multiple") else [cde.get("code") for cde in section.get("cdes", [])])
+
+
+def _section_delta(base_section, section):
+    if base_section == section:
+        return {"code": section.get("code")}
+    # multisections and sections whose cdes differ are replaced whole
+    if section.get("allow_multiple") or _shape(base_section) != _shape(section):
+        return {"code": section.get("code"), "full": section}
+    base_values = {cde["code"]: cde.get("value") for cde in base_section.get("cdes", [])}
+    return {"code": section.get("code"),
+            "cdes": {cde["code"]: cde.get("value") for cde in section.get("cdes", [])
+                     if cde.get("value") != base_values[cde["code"]]}}
+
+
+def _form_delta(base_form, form):
+    if base_form is None or {k: v for k, v in base_form.items() if k != "sections"} != \
+            {k: v for k, v in form.items() if k != "sections"}:
+        return {"name": form.get("name"), "full": form}
+    if base_form == form:
+        return {"name": form.get("name")}
+    base_sections = _index(base_form.get("sections", []), "code")
+    sections = []
+    for section in form.get("sections", []):
+        base_section = base_sections.get(section.get("code"))
+        if base_section is None:
+            sections.append({"code": section.get("code"), "full": section})
+        else:
+            sections.append(_section_delta(base_section, section))
+    return {"name": form.get("name"), "sections": sections}
+
+
+def make_delta(base, record):
+    """
+    The changes turning the base record into record
+    """
+    delta = {"set": {}, "unset": [], "forms": []}
+    for key, value in record.items():
+        if key != "forms" and (key not in base or base[key] != value):
+            delta["set"][key] = value
+    delta["unset"] = [key for key in base if key != "forms" and key not in record]
+    base_forms = _index(base.get("forms", []), "name")
+    for form in record.get("forms", []):
+        delta["forms"].append(_form_delta(base_forms.get(form.get("name")), form))
+    if "forms" not in record:
+        delta["no_forms"] = True
+    return delta
+
+
+# Decoding
+
+def _apply_section(base_section, entry):
+    if "full" in entry:
+        return deepcopy(entry["full"])
+    section = deepcopy(base_section)
+    for cde in section.get("cdes", []):
+        if cde["code"] in entry.get("cdes", {}):
+            cde["value"] = deepcopy(entry["cdes"][cde["code"]])
+    return section
+
+
+def _apply_form(base_form, entry):
+    if "full" in entry:
+        return deepcopy(entry["full"])
+    if "sections" not in entry:
+        return deepcopy(base_form)
+    base_sections = _index(base_form.get("sections", []), "code")
+    form = {k: deepcopy(v) for k, v in base_form.items() if k != "sections"}
+    form["sections"] = [_apply_section(base_sections.get(section_entry["code"]), section_entry)
+                        for section_entry in entry["sections"]]
+    return form
+
+
+def apply_delta(base, delta):
+    """
+    The record a delta was made from, given its base record
+    """
+    record = {key: deepcopy(value) for key, value in base.items() if key != "forms" and key not in delta["unset"]}
+    record.update(deepcopy(delta["set"]))
+    if not delta.get("no_forms"):
+        base_forms = _index(base.get("forms", []), "name")
+        record["forms"] = [_apply_form(base_forms.get(entry["name"]), entry) for entry in delta["forms"]]
+    return record
+
+
+# Writing
+
+def compact(snapshot, history_records):
+    """
+    The data to store for a new snapshot: the snapshot itself for a
+    checkpoint, otherwise a delta against the checkpoint of the latest
+    snapshot in history_records ( a queryset of the history of the same
+    patient context )
+    """
+    if storage_mode() != DELTA:
+        return snapshot
+    latest = history_records.filter(data__record_type="snapshot").order_by("-pk").first()
+    if latest is None:
+        return snapshot
+    if is_delta(latest.data):
+        checkpoint_id = latest.data["checkpoint_id"]
+        count = latest.data.get("delta_count", 0) + 1
+    else:
+        checkpoint_id = latest.pk
+        count = 1
+    if count >= checkpoint_interval():
+        return snapshot
+    checkpoint = history_records.filter(pk=checkpoint_id).values_list("data", flat=True).first()
+    if checkpoint is None or "record" not in checkpoint:
+        return snapshot
+    return to_delta(snapshot, checkpoint_id, checkpoint["record"], count)
+
+
+def to_delta(snapshot, checkpoint_id, checkpoint_record, count):
+    data = {key: value for key, value in snapshot.items() if key != "record"}
+    data["checkpoint_id"] = checkpoint_id
+    data["delta_count"] = count
+    data["delta"] = make_delta(checkpoint_record, snapshot["record"])
+    return data
+
+
+# Reading
+
+def load_snapshots(snapshots):
+    """
+    The snapshot data dicts with "record" filled in for the deltas.
+    The checkpoints not among snapshots are loaded in one query.
+    """
+    from rdrf.models.definition.models import ClinicalData
+    snapshots = list(snapshots)
+    checkpoint_ids = set(s["checkpoint_id"] for s in snapshots if is_delta(s))
+    checkpoints = {}
+    if checkpoint_ids:
+        checkpoints = dict(ClinicalData.objects.filter(pk__in=checkpoint_ids).values_list("pk", "data"))
+    result = []
+    for snapshot in snapshots:
+        if is_delta(snapshot):
+            checkpoint = checkpoints.get(snapshot["checkpoint_id"])
+            if checkpoint is None or "record" not in checkpoint:
+                logger.error("history checkpoint %s is missing" % snapshot["checkpoint_id"])
+                continue
+            snapshot = dict(snapshot)
+            snapshot["record"] = apply_delta(checkpoint["record"], snapshot.pop("delta"))
+        result.append(snapshot)
+    return result
+
+
+def expand_group(rows):
+    """
+    The ( pk, data with the record ) of rows, the ( pk, data ) of the
+    snapshots of one patient context in pk order: the checkpoints of the
+    deltas are among the earlier rows
+    """
+    records = {}
+    for pk, data in rows:
+        if is_delta(data):
+            checkpoint_record = records.get(data["checkpoint_id"])
+            if checkpoint_record is None:
+                logger.error("history checkpoint %s of snapshot %s is missing" % (data["checkpoint_id"], pk))
+                continue
+            record = apply_delta(checkpoint_record, data["delta"])
+            data = {key: value for key, value in data.items() if key not in ("delta", "checkpoint_id", "delta_count")}
+            data["record"] = record
+        else:
+            records[pk] = data["record"]
+        yield pk, data
+
+
+def get_snapshot_record(snapshot_id):
+    """
+    The cdes record as of the history snapshot with this id
+    """
+    from rdrf.models.definition.models import ClinicalData
+    data = ClinicalData.objects.filter(pk=snapshot_id, collection="history").values_list("data", flat=True).first()
+    if data is None:
+        raise ClinicalData.DoesNotExist("History snapshot %s does not exist" % snapshot_id)
+    snapshots = load_snapshots([data])
+    return snapshots[0]["record"] if snapshots else None
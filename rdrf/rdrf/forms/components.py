@@ -354,13 +354,15 @@ class FormsButton(RDRFComponent):
                 patient_model,
                 form_model,
                 context_form_group,
-                context_model=None):
+                context_model=None,
+                progress=None):
             self.registry_model = registry_model
             self.context_form_group = context_form_group
             self.patient_model = patient_model
             self.form_model = form_model
             self.context_model = context_model
-            self.progress = FormProgress(self.registry_model)
+            # shared by the wrappers of a button so progress is loaded once
+            self.progress = progress or FormProgress(self.registry_model)
             # if no progress cdes defined on form, don't show any percentage
             self.has_progress = form_model.has_progress_indicator
 
@@ -409,6 +411,7 @@ class FormsButton(RDRFComponent):
         self.context_form_group = context_form_group
         self.forms = [f for f in form_models if self.user.can_view(
             f) and not is_generated_form(f)]
+        self.progress = FormProgress(self.registry_model)
 
     def _get_template_data(self):
         # subclass should build dictionary for template
@@ -429,13 +432,19 @@ class FormsButton(RDRFComponent):
         }
 
     def _get_form_link_wrappers(self):
+        wrappers = self._create_form_link_wrappers()
+        self.progress.preload([(wrapper.patient_model, wrapper.context_model) for wrapper in wrappers])
+        return wrappers
+
+    def _create_form_link_wrappers(self):
         if self.context_form_group is None:
             default_context = self.patient_model.default_context(self.registry_model)
             return [self.FormWrapper(self.registry_model,
                                      self.patient_model,
                                      form_model,
                                      self.context_form_group,
-                                     default_context) for form_model in self.forms]
+                                     default_context,
+                                     self.progress) for form_model in self.forms]
         elif self.context_form_group.context_type == "F":
             # there should only be one context
             contexts = list(
@@ -453,7 +462,8 @@ class FormsButton(RDRFComponent):
                                      self.patient_model,
                                      form_model,
                                      self.context_form_group,
-                                     context_model) for form_model in self.forms]
+                                     context_model,
+                                     self.progress) for form_model in self.forms]
         else:
             # multiple group
             # we may have more than one assessment etc
@@ -467,7 +477,8 @@ class FormsButton(RDRFComponent):
                                  self.patient_model,
                                  form_model,
                                  self.context_form_group,
-                                 context_model) for form_model in self.forms
+                                 context_model,
+                                 self.progress) for form_model in self.forms
                 for context_model in context_models]
 
     @property
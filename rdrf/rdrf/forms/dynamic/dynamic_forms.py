@@ -3,7 +3,7 @@ from collections import OrderedDict
 from rdrf.forms.dynamic.field_lookup import FieldFactory
 from django.conf import settings
 import logging
-from rdrf.models.definition.models import CdePolicy
+from rdrf.helpers import metadata_cache
 
 logger = logging.getLogger(__name__)
 
@@ -35,10 +35,95 @@ def create_form_class(owner_class_name):
 
 
 def get_cde_policy(registry, cde):
-    try:
-        return CdePolicy.objects.get(registry=registry, cde=cde)
-    except CdePolicy.DoesNotExist:
-        return None
+    return metadata_cache.get_cde_policy(registry, cde)
+
+
+def _is_per_instance(cde):
+    # calculated fields embed the patient in their script and parametrised
+    # widgets receive the injected model
+    return bool(cde.calculation) or ":" in (cde.widget_name or "")
+
+
+def _field_code_on_form(registry_form, section, cde):
+    return "%s%s%s%s%s" % (registry_form.name,
+                           settings.FORM_SECTION_DELIMITER,
+                           section.code,
+                           settings.FORM_SECTION_DELIMITER,
+                           cde.code)
+
+
+def _create_field(registry, registry_form, section, cde, questionnaire_context=None,
+                  injected_model=None, injected_model_id=None, is_superuser=None):
+    cde_field = FieldFactory(
+        registry,
+        registry_form,
+        section,
+        cde,
+        questionnaire_context,
+        injected_model=injected_model,
+        injected_model_id=injected_model_id,
+        is_superuser=is_superuser).create_field()
+    cde_field.important = cde.important
+    return cde_field
+
+
+class CompiledSectionForm(object):
+    """
+    The fields of a section form for one permission profile, built once per
+    registry definition version ( see metadata_cache ). The fields which
+    depend on the patient and the cde policy conditions are applied by
+    form_class.
+    """
+
+    def __init__(self, registry, registry_form, section, questionnaire_context, is_superuser, group_ids):
+        # ( field code, cde, field or None if built per instance, policy to evaluate on the patient )
+        self.entries = []
+        for cde in section.cde_models:
+            cde_policy = get_cde_policy(registry, cde)
+            condition_policy = None
+            if cde_policy and group_ids is not None and not is_superuser:
+                if not group_ids & set(group.pk for group in cde_policy.groups_allowed.all()):
+                    continue
+                if cde_policy.condition:
+                    condition_policy = cde_policy
+            field = None
+            if not _is_per_instance(cde):
+                field = _create_field(registry, registry_form, section, cde, questionnaire_context,
+                                      is_superuser=is_superuser)
+            self.entries.append((_field_code_on_form(registry_form, section, cde), cde, field, condition_policy))
+
+    def form_class(self, registry, registry_form, section, questionnaire_context=None,
+                   injected_model=None, injected_model_id=None, is_superuser=None, patient_model=None):
+        base_fields = OrderedDict()
+        for field_code_on_form, cde, field, condition_policy in self.entries:
+            if condition_policy and patient_model and not condition_policy.evaluate_condition(patient_model):
+                continue
+            if field is None:
+                field = _create_field(registry, registry_form, section, cde, questionnaire_context,
+                                      injected_model, injected_model_id, is_superuser)
+            # forms deep copy base_fields so the fields can be shared
+            base_fields[field_code_on_form] = field
+
+        form_class_dict = {"base_fields": base_fields, "auto_id": True}
+        return type("SectionForm", (BaseForm,), form_class_dict)
+
+
+# hits and misses of the section form class cache in this process
+_form_class_stats = {"hits": 0, "misses": 0}
+STATS_LOG_INTERVAL = 1000
+
+
+def form_class_cache_stats():
+    return dict(_form_class_stats)
+
+
+def _policy_group_ids(registry, section):
+    group_ids = set()
+    for cde in section.cde_models:
+        cde_policy = get_cde_policy(registry, cde)
+        if cde_policy:
+            group_ids.update(group.pk for group in cde_policy.groups_allowed.all())
+    return group_ids
 
 
 def create_form_class_for_section(
@@ -51,38 +136,25 @@ def create_form_class_for_section(
         is_superuser=None,
         user_groups=None,
         patient_model=None):
-
-    base_fields = OrderedDict()
-    for cde in section.cde_models:
-        cde_policy = get_cde_policy(registry, cde)
-        if cde_policy and user_groups:
-            if not cde_policy.is_allowed(user_groups.all(),
-                                         patient_model,
-                                         is_superuser=is_superuser):
-                continue
-
-        cde_field = FieldFactory(
-            registry,
-            registry_form,
-            section,
-            cde,
-            questionnaire_context,
-            injected_model=injected_model,
-            injected_model_id=injected_model_id,
-            is_superuser=is_superuser).create_field()
-
-        cde_field.important = cde.important
-
-        field_code_on_form = "%s%s%s%s%s" % (registry_form.name,
-                                             settings.FORM_SECTION_DELIMITER,
-                                             section.code,
-                                             settings.FORM_SECTION_DELIMITER,
-                                             cde.code)
-        base_fields[field_code_on_form] = cde_field
-
-    form_class_dict = {"base_fields": base_fields, "auto_id": True}
-
-    return type("SectionForm", (BaseForm,), form_class_dict)
+    # a user without groups is not restricted by the cde policies
+    group_ids = set(user_groups.values_list("pk", flat=True)) if user_groups is not None else set()
+    relevant_group_ids = frozenset(group_ids & _policy_group_ids(registry, section)) if group_ids else None
+    key = (registry.code, registry_form.pk, section.code, questionnaire_context, bool(is_superuser), relevant_group_ids)
+
+    cache = metadata_cache.get_form_class_cache()
+    compiled = cache.get(key)
+    _form_class_stats["hits" if compiled else "misses"] += 1
+    logger.debug("section form class cache %s: %s" % ("hit" if compiled else "miss", key))
+    if compiled is None:
+        compiled = CompiledSectionForm(registry, registry_form, section, questionnaire_context, is_superuser,
+                                       relevant_group_ids)
+        cache[key] = compiled
+    lookups = _form_class_stats["hits"] + _form_class_stats["misses"]
+    if lookups % STATS_LOG_INTERVAL == 0:
+        logger.info("section form class cache: %(hits)s hits, %(misses)s misses" % _form_class_stats)
+
+    return compiled.form_class(registry, registry_form, section, questionnaire_context,
+                               injected_model, injected_model_id, is_superuser, patient_model)
 
 
 def create_form_class_for_consent_section(
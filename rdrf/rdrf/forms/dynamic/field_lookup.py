@@ -6,12 +6,12 @@ from django.utils.safestring import mark_safe
 from django.urls import reverse
 from collections import OrderedDict
 
+from rdrf.helpers import metadata_cache
 from rdrf.forms.dynamic import fields
 from rdrf.forms.widgets import widgets
 import logging
 from rdrf.forms.dynamic.calculated_fields import CalculatedFieldScriptCreator, CalculatedFieldScriptCreatorError
 from rdrf.forms.dynamic.validation import ValidatorFactory
-from rdrf.models.definition.models import CommonDataElement
 
 from django.utils.functional import lazy
 from django.utils.translation import ugettext_lazy as _
@@ -501,7 +501,7 @@ class ComplexFieldFactory(object):
             cdes = []
             for cde_code in cde_codes:
                 try:
-                    cde = CommonDataElement.objects.get(code=cde_code)
+                    cde = metadata_cache.load_cde(cde_code)
                     cdes.append(cde)
                 except Exception as ex:
                     logger.error("Couldn't get CDEs for %s - errored on code %s: %s" %
@@ -1,7 +1,6 @@
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.review_models import ReviewItemTypes
 from rdrf.models.definition.models import RegistryForm
-from rdrf.models.definition.models import Section
-from rdrf.models.definition.models import CommonDataElement
 from rdrf.models.definition.models import ConsentSection
 from rdrf.models.definition.models import ConsentQuestion
 from rdrf.forms.dynamic.field_lookup import FieldFactory
@@ -201,10 +200,10 @@ class ReviewFormGenerator:
             form_model = RegistryForm.objects.get(registry=self.registry_model,
                                                   name=form_name)
             cde_code = target_dict["cde"]
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            cde_model = metadata_cache.load_cde(cde_code)
 
             section_code = target_dict["section"]
-            section_model = Section.objects.get(code=section_code)
+            section_model = metadata_cache.load_section(section_code)
         else:
             raise Exception("unknown spec: %s" % spec)
 
@@ -338,7 +337,7 @@ class VerificationReviewFormGenerator(ReviewFormGenerator):
 
     def _get_cdes(self, cde_codes_csv):
         cde_codes = [s.strip() for s in cde_codes_csv.split(",")]
-        return [CommonDataElement.objects.get(code=cde_code) for cde_code in cde_codes]
+        return [metadata_cache.load_cde(cde_code) for cde_code in cde_codes]
 
 
 class DummyFormClass(forms.Form):
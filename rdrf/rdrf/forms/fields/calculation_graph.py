@@ -0,0 +1,249 @@
+"""
+Dependency graph of the calculated cdes.
+
+Every calculated cde CODE has a function CODE in calculated_functions and a
+function CODE_inputs() returning the codes of the cdes it reads. The graph
+maps each input cde to the calculations reading it so that, when some values
+change, only the calculations depending on them ( directly or through another
+calculation ) are evaluated, inputs first.
+
+The browser recalculates the calculated cdes of the form being edited. The
+calculations stored on other forms but reading inputs of the saved form ( via
+AcrossFormsInfo ) are updated on save by recalculate_dependents, given the
+cdes whose values the save changed ( see changed_codes ).
+"""
+from collections import defaultdict
+import logging
+
+from rdrf.forms.fields import calculated_functions
+from rdrf.helpers import metadata_cache
+
+logger = logging.getLogger(__name__)
+
+INPUTS_SUFFIX = "_inputs"
+
+_graph = None
+
+
+class CalculationGraphError(Exception):
+    pass
+
+
+class CalculationGraph(object):
+
+    def __init__(self, inputs):
+        """
+        :param inputs: dict of calculated cde code -> list of input cde codes
+        """
+        self.inputs = {code: list(input_codes) for code, input_codes in inputs.items()}
+        self.dependents = defaultdict(set)
+        for code, input_codes in self.inputs.items():
+            for input_code in input_codes:
+                self.dependents[input_code].add(code)
+        self.order = self._sort()
+        self.positions = {code: i for i, code in enumerate(self.order)}
+
+    @classmethod
+    def from_module(cls, module=calculated_functions):
+        inputs = {}
+        for name in dir(module):
+            if not name.endswith(INPUTS_SUFFIX):
+                continue
+            code = name[:-len(INPUTS_SUFFIX)]
+            if callable(getattr(module, code, None)):
+                inputs[code] = getattr(module, name)()
+        return cls(inputs)
+
+    def _sort(self):
+        # Kahn's algorithm over the calculations, alphabetical among equals
+        # so that the order is stable
+        remaining = {code: set(i for i in input_codes if i in self.inputs and i != code)
+                     for code, input_codes in self.inputs.items()}
+        order = []
+        ready = sorted(code for code, pending in remaining.items() if not pending)
+        while ready:
+            code = ready.pop(0)
+            order.append(code)
+            del remaining[code]
+            for dependent in sorted(self.dependents[code]):
+                if dependent in remaining and code in remaining[dependent]:
+                    remaining[dependent].discard(code)
+                    if not remaining[dependent]:
+                        ready.append(dependent)
+            ready.sort()
+        if remaining:
+            raise CalculationGraphError("Calculated cdes depend on each other: %s" % ", ".join(sorted(remaining)))
+        return order
+
+    def is_calculated(self, code):
+        return code in self.inputs
+
+    def affected(self, changed_codes):
+        """
+        The calculations depending directly or transitively on any of
+        changed_codes, in evaluation order
+        """
+        found = set()
+        pending = list(changed_codes)
+        while pending:
+            code = pending.pop()
+            for dependent in self.dependents.get(code, ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+        return self.sort(found)
+
+    def sort(self, codes):
+        """
+        codes in evaluation order, unknown codes last
+        """
+        return sorted(codes, key=lambda code: (self.positions.get(code, len(self.order)), code))
+
+
+def get_graph():
+    # the calculations are code so the graph only needs building once per process
+    global _graph
+    if _graph is None:
+        _graph = CalculationGraph.from_module()
+    return _graph
+
+
+def get_form_values(form_dict):
+    """
+    The values of the non multisection cdes of a form, as the calculated
+    functions receive them
+    """
+    form_values = {}
+    for section in form_dict.get("sections", []):
+        for cde in section.get("cdes", []):
+            if type(cde) is not list:
+                form_values[cde["code"]] = cde["value"]
+    return form_values
+
+
+def get_section_value(form_dict, section_code, cde_code):
+    # "" for None and None if never recorded, as the form shows it
+    for section in form_dict.get("sections", []):
+        if section.get("code") == section_code and not section.get("allow_multiple"):
+            for cde in section.get("cdes", []):
+                if cde.get("code") == cde_code:
+                    return "" if cde.get("value") is None else cde.get("value")
+    return None
+
+
+def set_section_value(form_dict, section_code, cde_code, value):
+    for section in form_dict.setdefault("sections", []):
+        if section.get("code") == section_code and not section.get("allow_multiple"):
+            for cde in section.setdefault("cdes", []):
+                if cde.get("code") == cde_code:
+                    cde["value"] = value
+                    return
+            section["cdes"].append({"code": cde_code, "value": value})
+            return
+    form_dict["sections"].append({"code": section_code,
+                                  "allow_multiple": False,
+                                  "cdes": [{"code": cde_code, "value": value}]})
+
+
+def changed_codes(form_name, previous_record, record):
+    """
+    The codes of the cdes of form_name whose values differ between the two
+    nested records
+    """
+    from rdrf.db.change_log import changed_values
+    return set(cde_code for (changed_form_name, _, cde_code), _ in changed_values(previous_record, record)
+               if changed_form_name == form_name)
+
+
+def get_patient_values(patient_model, registry_code):
+    return {'date_of_birth': patient_model.date_of_birth,
+            'patient_id': patient_model.id,
+            'registry_code': registry_code,
+            'sex': patient_model.sex}
+
+
+def _locate_calculations(registry_model, codes):
+    # calculated cde code -> [(form model, section code)] in the registry
+    locations = defaultdict(list)
+    for form_model in metadata_cache.get_forms(registry_model):
+        for section_model in metadata_cache.get_sections(form_model.get_sections()):
+            if section_model.allow_multiple:
+                continue
+            for cde_code in section_model.get_elements():
+                if cde_code in codes:
+                    locations[cde_code].append((form_model, section_model.code))
+    return locations
+
+
+def _target_context(patient_model, registry_model, context_model, form_model):
+    # the context holding form_model: the saved one if it has the form,
+    # otherwise the default context AcrossFormsInfo reads from
+    form_group = context_model.context_form_group if context_model else None
+    if form_group is None or form_group.items.filter(registry_form=form_model).exists():
+        return context_model
+    try:
+        return patient_model.default_context(registry_model)
+    except Exception as ex:
+        logger.warning("no context to recalculate %s: %s" % (form_model.name, ex))
+        return None
+
+
+def recalculate_dependents(patient_model, registry_model, context_model, form_name, changed_codes, user):
+    """
+    Updates the calculated cdes stored outside form_name which depend on
+    changed_codes. The new values are collected per context and each record
+    is written once. Returns the list of ( form name, cde code, new value )
+    saved.
+    """
+    from rdrf.forms.progress.form_progress import FormProgress
+    from rdrf.helpers.utils import mongo_key
+    from rdrf.models.definition.models import ClinicalData
+    from registry.patients.models import DynamicDataWrapper
+    affected = get_graph().affected(changed_codes)
+    if not affected:
+        return []
+
+    locations = _locate_calculations(registry_model, set(affected))
+    patient_values = get_patient_values(patient_model, registry_model.code)
+    collection = ClinicalData.objects.collection(registry_model.code, "cdes")
+    saved = []
+    # context id -> the record with the values calculated so far, which the
+    # calculations depending on other calculations read
+    records = {}
+    # context id -> ( context, form model -> { mongo key: new value } )
+    updates = {}
+    for code in affected:
+        for form_model, section_code in locations.get(code, []):
+            if form_model.name == form_name:
+                continue
+            target_context = _target_context(patient_model, registry_model, context_model, form_model)
+            if target_context is None:
+                continue
+            if target_context.pk not in records:
+                records[target_context.pk] = collection.find(patient_model, target_context.pk).data().first() or {}
+            record = records[target_context.pk]
+            form_dict = next((f for f in record.get("forms", []) if f.get("name") == form_model.name), None)
+            if form_dict is None:
+                form_dict = {"name": form_model.name, "sections": []}
+                record.setdefault("forms", []).append(form_dict)
+            new_value = getattr(calculated_functions, code)(dict(patient_values), get_form_values(form_dict))
+            if new_value == get_section_value(form_dict, section_code, code):
+                continue
+            set_section_value(form_dict, section_code, code, new_value)
+            form_updates = updates.setdefault(target_context.pk, (target_context, {}))[1]
+            form_updates.setdefault(form_model, {})[mongo_key(form_model.name, section_code, code)] = new_value
+            saved.append((form_model.name, code, new_value))
+
+    form_progress = FormProgress(registry_model)
+    for context_id, (target_context, form_updates) in updates.items():
+        wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+        wrapper.user = user
+        for form_model, values in form_updates.items():
+            wrapper.current_form_model = form_model
+            wrapper.save_dynamic_data(registry_model.code, "cdes", values, skip_bad_key=True, commit=False)
+        wrapper.commit_dynamic_data(registry_model.code, "cdes")
+        form_progress.save_for_patient(patient_model, target_context)
+        for form_model in form_updates:
+            wrapper.save_snapshot(registry_model.code, "cdes", form_name=form_model.name,
+                                  form_user=getattr(user, "username", None))
+    return saved
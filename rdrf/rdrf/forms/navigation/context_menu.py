@@ -55,6 +55,8 @@ class PatientContextMenu(object):
     def get_context_menu_forms(self):
         context_menu_forms = []
         self.form_progress.reset()
+        # no-op if the caller has already preloaded a batch including this context
+        self.form_progress.preload([(self.patient_model, self.context_model)])
         for form in self.get_forms():
             form_name = form.nice_name
             form_link = form.get_link(self.patient_model, self.context_model)
@@ -1,6 +1,8 @@
 from django.urls import reverse
 from django.templatetags.static import static
 from rdrf.helpers.utils import de_camelcase, parse_iso_datetime
+from rdrf.db.clinical_document import ClinicalDocument
+from rdrf.helpers.metadata_cache import get_complete_form_cde_codes
 from rdrf.models.definition.models import ClinicalData
 
 import math
@@ -49,6 +51,8 @@ class FormProgress(object):
         self.registry_model = registry_model
         self.progress_data = {}
         self.progress_collection = self._get_progress_collection()
+        # (patient id, context id or None) -> progress data ( see preload )
+        self.preloaded = {}
         self.progress_cdes_map = self._build_progress_map()
         self.loaded_data = None
         self.current_patient = None
@@ -86,8 +90,7 @@ class FormProgress(object):
         result = {}
         for form_model in self.registry_model.forms:
             if not form_model.is_questionnaire:
-                result[form_model.name] = set([cde_model.code for cde_model in
-                                               form_model.complete_form_cdes.all()])
+                result[form_model.name] = get_complete_form_cde_codes(self.registry_model, form_model.name)
         return result
 
     def _calculate_form_progress(self, form_model, dynamic_data):
@@ -128,18 +131,8 @@ class FormProgress(object):
     def _get_values_from_multisection(self, form_model, section_model, cde_model, dynamic_data):
         if dynamic_data is None:
             return []
-        for form_dict in dynamic_data["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if section_dict["code"] == section_model.code:
-                        values = []
-                        items = section_dict["cdes"]
-                        for item in items:
-                            for cde_dict in item:
-                                if cde_dict["code"] == cde_model.code:
-                                    values.append(cde_dict["value"])
-                        return values
-        return []
+        document = ClinicalDocument.wrap(dynamic_data)
+        return document.values(form_model.name, section_model.code, cde_model.code)
 
     def _get_num_items(self, form_model, section_model, dynamic_data):
         if not section_model.allow_multiple:
@@ -147,18 +140,8 @@ class FormProgress(object):
         else:
             if dynamic_data is None:
                 return 0
-            if "forms" not in dynamic_data:
-                return 0
-            for form_dict in dynamic_data["forms"]:
-                if form_dict["name"] == form_model.name:
-                    for section_dict in form_dict["sections"]:
-                        if section_dict["code"] == section_model.code:
-                            # for multisections the cdes field contains a list
-                            # of items, each of which is a list of cde dicts
-                            # containing the values for each item
-                            items = section_dict["cdes"]
-                            return len(items)
-        return 0
+            document = ClinicalDocument.wrap(dynamic_data)
+            return document.num_items(form_model.name, section_model.code)
 
     def _calculate_form_currency(self, form_model, dynamic_data):
         from datetime import timedelta, datetime
@@ -168,6 +151,9 @@ class FormProgress(object):
         if dynamic_data is None:
             return False
 
+        if isinstance(dynamic_data, ClinicalDocument):
+            dynamic_data = dynamic_data.data
+
         if form_timestamp_key in dynamic_data:
             timestamp = parse_iso_datetime(dynamic_data[form_timestamp_key])
             if timestamp >= one_year_ago:
@@ -177,19 +163,8 @@ class FormProgress(object):
 
     def _get_value_from_dynamic_data(self, form_model, section_model, cde_model, dynamic_data):
         # gets value or first value in a multisection
-        for form_dict in dynamic_data["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if section_dict["code"] == section_model.code:
-                        if not section_dict["allow_multiple"]:
-                            for cde_dict in section_dict["cdes"]:
-                                if cde_dict["code"] == cde_model.code:
-                                    return cde_dict["value"]
-                        else:
-                            for section_item in section_dict["cdes"]:
-                                for cde_dict in section_item:
-                                    if cde_dict["code"] == cde_model.code:
-                                        return cde_dict["value"]
+        document = ClinicalDocument.wrap(dynamic_data)
+        return document.first_value(form_model.name, section_model.code, cde_model.code)
 
     def _get_progress_cdes(self, form_model_required):
         cdes_required = self.progress_cdes_map[form_model_required.name]
@@ -248,18 +223,10 @@ class FormProgress(object):
     def _calculate_form_has_data(self, form_model, dynamic_data):
         if dynamic_data is None:
             return False
-        for form_dict in dynamic_data['forms']:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if not section_dict["allow_multiple"]:
-                        for cde_dict in section_dict["cdes"]:
-                            if test_value(cde_dict["value"]):
-                                return True
-                    else:
-                        for item in section_dict["cdes"]:
-                            for cde_dict in item:
-                                if test_value(cde_dict["value"]):
-                                    return True
+        document = ClinicalDocument.wrap(dynamic_data)
+        for _, _, _, _, value in document.iter_values(form_model.name):
+            if test_value(value):
+                return True
 
     def _calculate_form_cdes_status(self, form_model, dynamic_data):
         if dynamic_data is None:
@@ -269,22 +236,10 @@ class FormProgress(object):
         required_cdes = self.progress_cdes_map[form_model.name]
         cdes_status = {code: False for code in required_cdes}
 
-        for form_dict in dynamic_data["forms"]:
-            if form_dict["name"] == form_model.name:
-                for section_dict in form_dict["sections"]:
-                    if not section_dict["allow_multiple"]:
-                        for cde_dict in section_dict["cdes"]:
-                            if cde_dict["code"] in required_cdes:
-                                if cde_dict["value"]:
-                                    code = cde_dict["code"]
-                                    cdes_status[code] = True
-                    else:
-                        for item in section_dict["cdes"]:
-                            for cde_dict in item:
-                                if cde_dict["code"] in required_cdes:
-                                    if cde_dict["value"]:
-                                        code = cde_dict["code"]
-                                        cdes_status[code] = True
+        document = ClinicalDocument.wrap(dynamic_data)
+        for _, _, _, code, value in document.iter_values(form_model.name):
+            if code in required_cdes and value:
+                cdes_status[code] = True
         return cdes_status
 
     def _applicable(self, form_model):
@@ -307,6 +262,9 @@ class FormProgress(object):
 
         self._build_progress_map()
 
+        # index the record once - every form below is looked up in it
+        dynamic_data = ClinicalDocument.wrap(dynamic_data)
+
         groups_progress = {}
         forms_progress = {}
 
@@ -373,25 +331,28 @@ class FormProgress(object):
         # eg _get_metric((SomeFormModel, "progress"), fred, None)
         # or _get_metric("diagnosis_current", fred, context23) etc
 
-        if self.loaded_data is None:
-            self._load(patient_model, context_model)
+        data = self.preloaded.get((patient_model.pk, context_model.pk if context_model else None))
+        if data is None:
+            if self.loaded_data is None:
+                self._load(patient_model, context_model)
+            data = self.loaded_data
 
         if metric == "diagnosis_group_progress":
-            return self.loaded_data.get("diagnosis_group_progress", 0)
+            return data.get("diagnosis_group_progress", 0)
         elif metric == "diagnosis_group_current":
-            return self.loaded_data.get("diagnosis_group_current", False)
+            return data.get("diagnosis_group_current", False)
         elif metric == "genetic_group_has_data":
-            return self.loaded_data.get("genetic_group_has_data", False)
+            return data.get("genetic_group_has_data", False)
         elif isinstance(metric, tuple):
             form_model, tag = metric
             if tag == "progress":
-                return self.loaded_data.get(form_model.name + "_form_progress", {})
+                return data.get(form_model.name + "_form_progress", {})
             elif tag == "current":
-                return self.loaded_data.get(form_model.name + "_form_current", False)
+                return data.get(form_model.name + "_form_current", False)
             elif tag == "cdes_status":
                 initial_completion_status_cdes = {cde_model.name: False for cde_model
                                                   in form_model.complete_form_cdes.all()}
-                return self.loaded_data.get(
+                return data.get(
                     form_model.name + "_form_cdes_status",
                     initial_completion_status_cdes)
             else:
@@ -413,10 +374,62 @@ class FormProgress(object):
                 return self.context_model.context_form_group
         return self.registry_model
 
+    def _first_records(self, collection, keys):
+        # the data of the first record in collection for each (patient id, context id) key
+        # a context id of None matches any context, as in _get_query
+        patient_ids = list(set(patient_id for patient_id, _ in keys))
+        records = ClinicalData.objects.collection(self.registry_model.code, collection) \
+                                      .filter(django_model="Patient", django_id__in=patient_ids) \
+                                      .values_list("django_id", "context_id", "data")
+        found = {}
+        for patient_id, context_id, data in records:
+            for key in ((patient_id, context_id), (patient_id, None)):
+                if key in keys and key not in found:
+                    found[key] = data
+        return found
+
+    def _calculate_batch(self, patients, keys):
+        cdes_records = self._first_records("cdes", keys)
+        current_patient = self.current_patient
+        result = {}
+        for key in keys:
+            self.progress_data = {}
+            dynamic_data = cdes_records.get(key)
+            if dynamic_data:
+                self._calculate(dynamic_data, patients[key[0]])
+            result[key] = self.progress_data
+        # _calculate changes the current patient
+        self.current_patient = current_patient
+        self.progress_data = {}
+        return result
+
     # Public API
     def reset(self):
         self.loaded_data = None
 
+    def preload(self, patients_and_contexts):
+        """
+        Loads the progress of a batch of (patient, context) pairs in one query
+        so that the getters below are served from memory for them. A context
+        of None stands for the patient's first progress record, as it does
+        for the getters.
+        Progress that has never been saved is calculated from the clinical
+        records, which are also loaded in one query.
+        """
+        patients = {}
+        keys = set()
+        for patient_model, context_model in patients_and_contexts:
+            patients[patient_model.pk] = patient_model
+            keys.add((patient_model.pk, context_model.pk if context_model else None))
+        keys = keys - set(self.preloaded.keys())
+        if not keys:
+            return
+        found = self._first_records("progress", keys)
+        missing = keys - set(found.keys())
+        if missing:
+            found.update(self._calculate_batch(patients, missing))
+        self.preloaded.update(found)
+
     def get_form_progress_dict(self, form_model, patient_model, context_model=None):
         # returns a dict of required filled percentage numbers
         return self._get_metric((form_model, "progress"), patient_model, context_model)
@@ -493,6 +506,9 @@ class FormProgress(object):
                                          data=ctx)
         record.data.update(self.progress_data)
         record.save()
+        if not self.registry_model.has_feature("contexts"):
+            from registry.patients.models import PatientSummary
+            PatientSummary.update_from_progress(self.registry_model, patient_model, record.data)
         return self.progress_data
 
     # a convenience method
@@ -9,7 +9,7 @@ from django.forms.widgets import ClearableFileInput
 
 import re
 import logging
-from rdrf.models.definition.models import CommonDataElement
+from rdrf.helpers import metadata_cache
 from registry.patients.models import PatientConsent
 import pycountry
 
@@ -347,7 +347,7 @@ class PositiveIntegerInput(widgets.TextInput):
 
     def _get_value_range(self, cde_name):
         cde_code = cde_name.split("____")[2]
-        cde = CommonDataElement.objects.get(code=cde_code)
+        cde = metadata_cache.load_cde(cde_code)
         max_value = cde.max_value if cde.max_value else 2147483647
         min_value = cde.min_value if cde.min_value else 0
         return min_value, max_value
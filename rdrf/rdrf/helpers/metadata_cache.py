@@ -0,0 +1,311 @@
+"""
+In-memory cache of registry definition models.
+
+Registry definitions (forms, sections, cdes, permitted value groups and cde
+policies) change rarely but are read for every value touched when rendering
+forms and reports. The definition of a registry is loaded here in a few bulk
+queries and lookups are then served from memory.
+
+The cache is held per process and pinned to a definition "version" stored in
+the django cache. The version is checked once at the start of each request
+(see MetadataCacheMiddleware) and at most every VERSION_CHECK_SECONDS outside
+of requests (celery tasks, management commands).
+Saving or deleting any definition model bumps the version, so every process
+reloads the definition the next time it checks.
+"""
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "rdrf_definition_version"
+VERSION_CHECK_SECONDS = 30
+
+_lock = threading.RLock()
+_state = {"version": None, "checked": 0.0, "definitions": None, "deferred": 0, "dirty": False}
+
+
+class RegistryDefinition(object):
+    """
+    The forms, cde policies and completion cdes of one registry.
+    Sections and cdes are shared between registries so they live on
+    DefinitionCache.
+    """
+
+    def __init__(self, registry_model, definitions):
+        from rdrf.models.definition.models import RegistryForm, CdePolicy
+        self.registry_model = registry_model
+        self.forms = list(RegistryForm.objects.filter(registry=registry_model)
+                                              .order_by("position")
+                                              .prefetch_related("complete_form_cdes"))
+        self.forms_by_name = {form_model.name: form_model for form_model in self.forms}
+        self.forms_by_id = {form_model.pk: form_model for form_model in self.forms}
+        self.complete_form_cde_codes = {form_model.name: set(cde.code for cde in form_model.complete_form_cdes.all())
+                                        for form_model in self.forms}
+        self.cde_policies = {policy.cde_id: policy for policy in
+                             CdePolicy.objects.filter(registry=registry_model).prefetch_related("groups_allowed")}
+
+        section_codes = set()
+        for form_model in self.forms:
+            section_codes.update(form_model.get_sections())
+        sections = definitions.get_sections(section_codes)
+        cde_codes = set()
+        for section_model in sections.values():
+            cde_codes.update(section_model.get_elements())
+        definitions.get_cdes(cde_codes)
+
+
+class DefinitionCache(object):
+
+    def __init__(self):
+        self.registries = {}
+        self.sections = {}
+        self.cdes = {}
+        self.permitted_values = {}
+        self.indexed_cdes = {}
+        # compiled section forms, see dynamic_forms.create_form_class_for_section
+        self.form_classes = {}
+        # compiled form rules, see rules_engine.get_compiled_rules
+        self.rules = {}
+        # parsed field expressions, see GeneralisedFieldExpressionParser.parse
+        self.field_expressions = {}
+
+    def get_registry(self, registry_model):
+        definition = self.registries.get(registry_model.code)
+        if definition is None:
+            definition = RegistryDefinition(registry_model, self)
+            self.registries[registry_model.code] = definition
+        return definition
+
+    def get_sections(self, codes):
+        """
+        Returns a dict of code -> Section for those codes that exist
+        """
+        from rdrf.models.definition.models import Section
+        missing = [code for code in codes if code not in self.sections]
+        if missing:
+            found = {s.code: s for s in Section.objects.filter(code__in=missing)}
+            for code in missing:
+                # cache misses too so that bad codes don't requery
+                self.sections[code] = found.get(code)
+        return {code: self.sections[code] for code in codes if self.sections[code] is not None}
+
+    def get_cdes(self, codes):
+        """
+        Returns a dict of code -> CommonDataElement for those codes that exist
+        """
+        from rdrf.models.definition.models import CommonDataElement
+        missing = [code for code in codes if code not in self.cdes]
+        if missing:
+            found = {c.code: c for c in CommonDataElement.objects.filter(code__in=missing)}
+            for code in missing:
+                self.cdes[code] = found.get(code)
+            self._load_permitted_values([c.pv_group_id for c in found.values() if c.pv_group_id])
+        return {code: self.cdes[code] for code in codes if self.cdes[code] is not None}
+
+    def get_indexed_cdes(self, registry_code):
+        from rdrf.models.definition.models import Registry
+        if registry_code not in self.indexed_cdes:
+            registry_model = Registry.objects.filter(code=registry_code).first()
+            self.indexed_cdes[registry_code] = registry_model.indexed_cdes if registry_model else []
+        return self.indexed_cdes[registry_code]
+
+    def _load_permitted_values(self, pv_group_codes):
+        from rdrf.models.definition.models import CDEPermittedValue
+        missing = set(code for code in pv_group_codes if code not in self.permitted_values)
+        if not missing:
+            return
+        for code in missing:
+            self.permitted_values[code] = []
+        for pv in CDEPermittedValue.objects.filter(pv_group_id__in=missing).order_by("position", "pk"):
+            self.permitted_values[pv.pv_group_id].append(pv)
+
+    def get_permitted_values(self, pv_group_code):
+        self._load_permitted_values([pv_group_code])
+        return self.permitted_values[pv_group_code]
+
+
+def _shared_version():
+    try:
+        return cache.get(VERSION_KEY)
+    except Exception as ex:
+        logger.warning("could not read definition version: %s" % ex)
+        return None
+
+
+def _check_version(force=False):
+    now = time.time()
+    if not force and now - _state["checked"] < VERSION_CHECK_SECONDS:
+        return
+    version = _shared_version()
+    with _lock:
+        _state["checked"] = now
+        if version != _state["version"]:
+            _state["version"] = version
+            _state["definitions"] = None
+
+
+def get_definitions():
+    with _lock:
+        _check_version()
+        if _state["definitions"] is None:
+            _state["definitions"] = DefinitionCache()
+        return _state["definitions"]
+
+
+def begin_request():
+    _check_version(force=True)
+
+
+def invalidate():
+    """
+    Drop the cached definitions here and in every other process.
+    Inside deferred_invalidation() this only marks the cache dirty.
+    """
+    with _lock:
+        _state["definitions"] = None
+        if _state["deferred"]:
+            _state["dirty"] = True
+            return
+    # other processes must not reload before the change is visible to them
+    transaction.on_commit(_publish_version)
+
+
+def _publish_version():
+    version = str(uuid.uuid4())
+    with _lock:
+        _state["definitions"] = None
+        _state["version"] = version
+        _state["checked"] = time.time()
+    try:
+        cache.set(VERSION_KEY, version, None)
+    except Exception as ex:
+        logger.warning("could not publish definition version: %s" % ex)
+
+
+@contextmanager
+def deferred_invalidation():
+    """
+    Collapse the invalidations from many definition saves ( e.g. a registry
+    import ) into one at the end of the block.
+    """
+    with _lock:
+        _state["deferred"] += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _state["deferred"] -= 1
+            flush = _state["deferred"] == 0 and _state["dirty"]
+            if flush:
+                _state["dirty"] = False
+        if flush:
+            invalidate()
+
+
+class MetadataCacheMiddleware(object):
+    """
+    Pins the definition cache for the duration of a request
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        begin_request()
+        return self.get_response(request)
+
+
+# Lookup API
+
+
+def get_registry_definition(registry_model):
+    return get_definitions().get_registry(registry_model)
+
+
+def get_forms(registry_model):
+    return list(get_registry_definition(registry_model).forms)
+
+
+def get_form(registry_model, form_name):
+    return get_registry_definition(registry_model).forms_by_name.get(form_name)
+
+
+def get_form_by_id(registry_model, form_id):
+    return get_registry_definition(registry_model).forms_by_id.get(form_id)
+
+
+def get_complete_form_cde_codes(registry_model, form_name):
+    return get_registry_definition(registry_model).complete_form_cde_codes.get(form_name, set())
+
+
+def get_cde_policy(registry_model, cde_model):
+    return get_registry_definition(registry_model).cde_policies.get(cde_model.pk)
+
+
+def get_section(code):
+    return get_definitions().get_sections([code]).get(code)
+
+
+def get_sections(codes):
+    """
+    Sections for codes in the given order, skipping those that don't exist
+    """
+    found = get_definitions().get_sections(codes)
+    return [found[code] for code in codes if code in found]
+
+
+def get_cde(code):
+    return get_definitions().get_cdes([code]).get(code)
+
+
+def get_cdes(codes):
+    return get_definitions().get_cdes(codes)
+
+
+def get_permitted_values(pv_group_code):
+    return get_definitions().get_permitted_values(pv_group_code)
+
+
+def get_form_class_cache():
+    return get_definitions().form_classes
+
+
+def get_field_expression_cache():
+    return get_definitions().field_expressions
+
+
+def get_rules_cache():
+    return get_definitions().rules
+
+
+def get_indexed_cdes(registry_code):
+    return get_definitions().get_indexed_cdes(registry_code)
+
+
+def load_section(code):
+    """
+    Like Section.objects.get(code=code) but served from the cache
+    """
+    from rdrf.models.definition.models import Section
+    section_model = get_section(code)
+    if section_model is None:
+        raise Section.DoesNotExist("Section %s does not exist" % code)
+    return section_model
+
+
+def load_cde(code):
+    """
+    Like CommonDataElement.objects.get(code=code) but served from the cache
+    """
+    from rdrf.models.definition.models import CommonDataElement
+    cde_model = get_cde(code)
+    if cde_model is None:
+        raise CommonDataElement.DoesNotExist("CommonDataElement %s does not exist" % code)
+    return cde_model
@@ -54,22 +54,12 @@ def mongo_key_from_models(form_model, section_model, cde_model):
 
 
 def models_from_mongo_key(registry_model, delimited_key):
-    from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
+    from rdrf.helpers import metadata_cache
     form_name, section_code, cde_code = get_form_section_code(delimited_key)
-    try:
-        form_model = RegistryForm.objects.get(
-            name=form_name, registry=registry_model)
-    except RegistryForm.DoesNotExist:
-        raise BadKeyError()
-
-    try:
-        section_model = Section.objects.get(code=section_code)
-    except Section.DoesNotExist:
-        raise BadKeyError()
-
-    try:
-        cde_model = CommonDataElement.objects.get(code=cde_code)
-    except CommonDataElement.DoesNotExist:
+    form_model = metadata_cache.get_form(registry_model, form_name)
+    section_model = metadata_cache.get_section(section_code)
+    cde_model = metadata_cache.get_cde(cde_code)
+    if form_model is None or section_model is None or cde_model is None:
         raise BadKeyError()
 
     return form_model, section_model, cde_model
@@ -205,17 +195,16 @@ def get_cached_instance(klass, *args, **kwargs):
 
 
 def is_multisection(code):
-    try:
-        from rdrf.models.definition.models import Section
-        section_model = Section.objects.get(code=code)
-        return section_model.allow_multiple
-    except Section.DoesNotExist:
+    from rdrf.helpers.metadata_cache import get_section
+    section_model = get_section(code)
+    if section_model is None:
         return False
+    return section_model.allow_multiple
 
 
 def get_cde(code):
-    from rdrf.models.definition.models import CommonDataElement
-    return CommonDataElement.objects.filter(code=code).first()
+    from rdrf.helpers.metadata_cache import get_cde as get_cached_cde
+    return get_cached_cde(code)
 
 
 def is_file_cde(code):
@@ -355,31 +344,36 @@ def timed(func):
 
 
 def get_cde_value2(form_name, section_code, cde_code, patient_record):
-    from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
-    form_model = RegistryForm.objects.get(name=form_name)
-    section_model = Section.objects.get(code=section_code)
-    cde_model = CommonDataElement.objects.get(code=cde_code)
-    return get_cde_value(form_model, section_model, cde_model, patient_record)
+    # only the names are needed to find the value so don't load the models
+    return _get_cde_value(form_name, section_code, cde_code, patient_record)
 
 
 def get_cde_value(form_model, section_model, cde_model, patient_record):
     # should refactor code everywhere to use this func
+    return _get_cde_value(form_model.name, section_model.code, cde_model.code, patient_record)
+
+
+def _get_cde_value(form_name, section_code, cde_code, patient_record):
+    # patient_record may be a nested record or an already indexed ClinicalDocument
+    from rdrf.db.clinical_document import ClinicalDocument
     if patient_record is None:
         return None
+    if isinstance(patient_record, ClinicalDocument):
+        return patient_record.lookup(form_name, section_code, cde_code)
     for form_dict in patient_record["forms"]:
-        if form_dict["name"] == form_model.name:
+        if form_dict["name"] == form_name:
             for section_dict in form_dict["sections"]:
-                if section_dict["code"] == section_model.code:
+                if section_dict["code"] == section_code:
                     if not section_dict["allow_multiple"]:
                         for cde_dict in section_dict["cdes"]:
-                            if cde_dict["code"] == cde_model.code:
+                            if cde_dict["code"] == cde_code:
                                 return cde_dict["value"]
                     else:
                         values = []
                         items = section_dict["cdes"]
                         for item in items:
                             for cde_dict in item:
-                                if cde_dict['code'] == cde_model.code:
+                                if cde_dict['code'] == cde_code:
                                     values.append(cde_dict["value"])
                         return values
 
@@ -600,7 +594,22 @@ class HistoryTimeStripper(TimeStripper):
 
     def munge_data(self, data):
         # History embeds the full forms dictionary in the record key
-        return super().munge_data(data["record"])
+        if "record" in data:
+            return super().munge_data(data["record"])
+        # or, stored as a delta, the forms and sections changed since its checkpoint
+        updated = False
+        for form in data.get("delta", {}).get("forms", []):
+            if "full" in form:
+                updated = super().munge_data({"forms": [form["full"]]}) or updated
+            for section in form.get("sections", []):
+                if "full" in section:
+                    updated = super().munge_data({"forms": [{"sections": [section["full"]]}]}) or updated
+                for code, value in section.get("cdes", {}).items():
+                    cde = {"code": code, "value": value}
+                    if self.is_date_cde(cde) and self.update_cde(cde):
+                        section["cdes"][code] = cde["value"]
+                        updated = True
+        return updated
 
 
 # Python 3.5 doesn't raises run time error when lists which contain None values are sorted
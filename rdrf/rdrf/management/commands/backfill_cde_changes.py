@@ -0,0 +1,61 @@
+from django.core.management import BaseCommand
+from django.db import router, transaction
+from rdrf.db import change_log
+from rdrf.db import history as history_storage
+from rdrf.models.definition.models import CDEChange, ClinicalData, Registry
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    """
+    (re)-creates the cde change log from the existing history
+    """
+    help = "Writes the per cde change log of the existing history snapshots"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry-code", dest="registry_code", default=None,
+                            help="Only this registry")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help="Snapshots read per query")
+
+    def handle(self, *args, **options):
+        snapshots = ClinicalData.objects.filter(collection="history", django_model="Patient",
+                                                data__record_type="snapshot")
+        changes = CDEChange.objects.all()
+        if options["registry_code"]:
+            snapshots = snapshots.filter(registry_code=options["registry_code"])
+            changes = changes.filter(registry_code=options["registry_code"])
+        snapshots = snapshots.order_by("registry_code", "django_id", "context_id", "pk")
+
+        with transaction.atomic(using=router.db_for_write(CDEChange)):
+            deleted, _ = changes.delete()
+            created = 0
+            group_key = None
+            group = []
+            for snapshot in snapshots.iterator(chunk_size=options["batch_size"]):
+                key = (snapshot.registry_code, snapshot.django_id, snapshot.context_id)
+                if key != group_key:
+                    created += self._log_group(group)
+                    group_key, group = key, []
+                group.append(snapshot)
+            created += self._log_group(group)
+            # the history view reads the change log from now on
+            if options["registry_code"]:
+                change_log.mark_logged([options["registry_code"]])
+            else:
+                change_log.mark_logged(Registry.objects.values_list("code", flat=True))
+        self.stdout.write("%s changes written, %s deleted" % (created, deleted))
+
+    def _log_group(self, group):
+        # the snapshots of one patient context in pk order
+        if not group:
+            return 0
+        by_pk = {snapshot.pk: snapshot for snapshot in group}
+        previous_record = None
+        changes = []
+        for pk, data in history_storage.expand_group((snapshot.pk, snapshot.data) for snapshot in group):
+            changes.extend(change_log.make_changes(by_pk[pk], data, previous_record))
+            previous_record = data["record"]
+        CDEChange.objects.bulk_create(changes)
+        return len(changes)
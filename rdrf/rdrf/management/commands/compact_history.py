@@ -0,0 +1,87 @@
+import json
+
+from django.core.management import BaseCommand
+from django.db import router, transaction
+from rdrf.db import history as history_storage
+from rdrf.models.definition.models import ClinicalData, clinical_data_bulk_saved
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    """
+    Rewrites the existing history snapshots as checkpoints and deltas
+    ( or back to full snapshots ), see rdrf.db.history
+    """
+    help = "Converts the clinical data history between full snapshots and checkpoints plus deltas"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry-code", dest="registry_code", default=None,
+                            help="Only this registry")
+        parser.add_argument("--to", dest="to", choices=[history_storage.DELTA, history_storage.FULL],
+                            default=history_storage.DELTA, help="Storage to convert to")
+        parser.add_argument("--interval", type=int, default=None,
+                            help="Snapshots per checkpoint, HISTORY_CHECKPOINT_INTERVAL by default")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help="Snapshots written per transaction")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+                            help="Only report the sizes before and after")
+
+    def handle(self, *args, **options):
+        interval = options["interval"] or history_storage.checkpoint_interval()
+        snapshots = ClinicalData.objects.filter(collection="history", data__record_type="snapshot")
+        if options["registry_code"]:
+            snapshots = snapshots.filter(registry_code=options["registry_code"])
+        snapshots = snapshots.order_by("registry_code", "django_model", "django_id", "context_id", "pk")
+        rows = snapshots.values_list("pk", "registry_code", "django_model", "django_id", "context_id", "data")
+
+        self.size_before = self.size_after = self.converted = 0
+        pending = []
+        group_key = None
+        group = []
+        for pk, registry_code, django_model, django_id, context_id, data in rows.iterator(chunk_size=options["batch_size"]):
+            key = (registry_code, django_model, django_id, context_id)
+            if key != group_key:
+                pending.extend(self._convert(group, options["to"], interval))
+                group_key, group = key, []
+                # a group is written in one transaction so its deltas never
+                # reference a checkpoint which is not one yet
+                if len(pending) >= options["batch_size"]:
+                    self._write(pending, options["dry_run"])
+                    pending = []
+            group.append((pk, data))
+        pending.extend(self._convert(group, options["to"], interval))
+        self._write(pending, options["dry_run"])
+
+        self.stdout.write("%s snapshots %s: %s bytes -> %s bytes" % (
+            self.converted, "to convert" if options["dry_run"] else "converted", self.size_before, self.size_after))
+
+    def _convert(self, group, to, interval):
+        # the snapshots of one patient context in pk order -> changed ClinicalData
+        changed = []
+        checkpoint_id = checkpoint_record = None
+        count = 0
+        originals = dict(group)
+        for pk, full in history_storage.expand_group(group):
+            data = originals[pk]
+            if to == history_storage.FULL or checkpoint_id is None or count + 1 >= interval:
+                new_data = full
+                checkpoint_id, checkpoint_record, count = pk, full["record"], 0
+            else:
+                count += 1
+                new_data = history_storage.to_delta(full, checkpoint_id, checkpoint_record, count)
+
+            if new_data != data:
+                self.converted += 1
+                self.size_before += len(json.dumps(data))
+                self.size_after += len(json.dumps(new_data))
+                changed.append(ClinicalData(pk=pk, data=new_data))
+        return changed
+
+    def _write(self, records, dry_run):
+        if dry_run or not records:
+            return
+        using = router.db_for_write(ClinicalData)
+        with transaction.atomic(using=using):
+            ClinicalData.objects.bulk_update(records, ["data"])
+            clinical_data_bulk_saved(records, using)
@@ -1,8 +1,9 @@
+from django.contrib.contenttypes.models import ContentType
 from django.core.management import BaseCommand
-from rdrf.models.definition.models import Registry
+from rdrf.models.definition.models import Registry, RDRFContext, ClinicalData
 from registry.patients.models import Patient
 from explorer.models import FieldValue
-from explorer.utils import create_field_values
+from explorer.utils import FieldValueProjector, FIELD_VALUE_BATCH_SIZE
 
 
 class Command(BaseCommand):
@@ -11,12 +12,56 @@ class Command(BaseCommand):
     """
     help = "Creates field values for reporting"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--registry-code", dest="registry_code", default=None,
+                            help="Only this registry")
+        parser.add_argument("--batch-size", type=int, default=FIELD_VALUE_BATCH_SIZE,
+                            help="Patient contexts projected per transaction")
+
     def handle(self, *args, **options):
-        for registry_model in Registry.objects.all():
-            FieldValue.objects.filter(registry=registry_model).delete()
-            for patient_model in Patient.objects.filter(rdrf_registry__in=[registry_model]):
-                for context_model in patient_model.context_models:
-                    if context_model.registry.code == registry_model.code:
-                        create_field_values(registry_model,
-                                            patient_model,
-                                            context_model)
+        registries = Registry.objects.all()
+        if options["registry_code"]:
+            registries = registries.filter(code=options["registry_code"])
+        for registry_model in registries:
+            created, updated, deleted = self._project_registry(registry_model, options["batch_size"])
+            self.stdout.write("%s: %s field values created, %s updated, %s deleted" % (
+                registry_model.code, created, updated, deleted))
+
+    def _project_registry(self, registry_model, batch_size):
+        projector = FieldValueProjector(registry_model)
+        patient_ids = set(Patient.objects.filter(rdrf_registry__in=[registry_model]).values_list("id", flat=True))
+        contexts = {context_model.pk: context_model for context_model in
+                    RDRFContext.objects.filter(registry=registry_model,
+                                               content_type=ContentType.objects.get_for_model(Patient))
+                    if context_model.object_id in patient_ids}
+        totals = [0, 0, 0]
+
+        def project(batch):
+            for i, count in enumerate(projector.project_many(batch)):
+                totals[i] += count
+
+        records = ClinicalData.objects.collection(registry_model.code, "cdes").filter(
+            django_model="Patient", context_id__in=list(contexts.keys())).values_list("django_id", "context_id", "data")
+        seen = set()
+        batch = []
+        # ordered by pk: the first record of a context is the one the forms show
+        for patient_id, context_id, data in records.iterator(chunk_size=batch_size):
+            context_model = contexts[context_id]
+            if context_model.object_id != patient_id or context_id in seen:
+                continue
+            seen.add(context_id)
+            batch.append((patient_id, context_model, data))
+            if len(batch) == batch_size:
+                project(batch)
+                batch = []
+        # contexts without clinical data have no field values
+        batch.extend((context_model.object_id, context_model, None)
+                     for context_id, context_model in contexts.items() if context_id not in seen)
+        for i in range(0, len(batch), batch_size):
+            project(batch[i:i + batch_size])
+
+        # rows of contexts that no longer belong to the registry's patients
+        stale, _ = FieldValue.objects.filter(registry=registry_model).exclude(
+            context_id__in=list(contexts.keys())).delete()
+        totals[2] += stale
+        return totals
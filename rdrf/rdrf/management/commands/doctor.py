@@ -3,6 +3,7 @@ import json
 from django.core.management.base import BaseCommand
 from rdrf.helpers.utils import catch_and_log_exceptions
 from rdrf.models.definition.models import ClinicalData, RegistryForm, CommonDataElement, Section
+from rdrf.db import history as history_storage
 
 # do not display debug information for the node js call.
 import logging
@@ -115,7 +116,10 @@ class Command(BaseCommand):
         clinicaldatas = ClinicalData.objects.all()
         for clinicaldata in clinicaldatas:
             if clinicaldata.collection == "history":
-                bad_codes = self.get_bad_codes_from_collection(clinicaldata.data, form_names, section_codes, cde_codes, bad_codes)
+                # deltas are checked as the records they stand for
+                for data in history_storage.load_snapshots([clinicaldata.data]):
+                    if "record" in data:
+                        bad_codes = self.get_bad_codes_from_collection(data, form_names, section_codes, cde_codes, bad_codes)
 
         return bad_codes
 
@@ -0,0 +1,38 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from rdrf.models.definition.models import Registry
+from rdrf.reports.generator import BATCH_SIZE
+from rdrf.reports.parquet_export import ParquetExportError, export_registry, export_registry_zip
+
+
+class Command(BaseCommand):
+    help = "Exports the clinical data of a registry as parquet files, one per form and multisection"
+
+    def add_arguments(self, parser):
+        parser.add_argument("registry_code")
+        parser.add_argument("output",
+                            help="Directory to write the files to, or a .zip file")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help="Clinical records fetched and rows written per batch")
+
+    def handle(self, registry_code, output, **options):
+        try:
+            registry_model = Registry.objects.get(code=registry_code)
+        except Registry.DoesNotExist:
+            raise CommandError("Unknown registry code: %s" % registry_code)
+
+        try:
+            if output.endswith(".zip"):
+                with open(output, "wb") as zip_file:
+                    export_registry_zip(registry_model, zip_file, options["batch_size"])
+                self.stdout.write("Parquet export written to %s" % output)
+            else:
+                os.makedirs(output, exist_ok=True)
+                paths = export_registry(registry_model, output, options["batch_size"], self._show_progress)
+                self.stdout.write("%s parquet files written to %s" % (len(paths), output))
+        except ParquetExportError as ex:
+            raise CommandError(str(ex))
+
+    def _show_progress(self, done, total):
+        self.stdout.write("Processed %s/%s clinical records" % (done, total))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from rdrf.models.definition.models import Registry
+from rdrf.reports.generator import Generator, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Builds the reporting tables for a registry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("registry_code")
+        parser.add_argument("--db", default="reporting",
+                            help="Database to write the tables to: reporting | clinical | default")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help="Clinical records fetched and rows inserted per batch")
+        parser.add_argument("--by-patient", action="store_true",
+                            help="Extract patient by patient instead of in batches "
+                                 "( --incremental still extracts the changed contexts in batches )")
+        parser.add_argument("--incremental", action="store_true",
+                            help="Only refresh the rows of patient contexts changed since the last run")
+
+    def handle(self, registry_code, **options):
+        try:
+            registry_model = Registry.objects.get(code=registry_code)
+        except Registry.DoesNotExist:
+            raise CommandError("Unknown registry code: %s" % registry_code)
+
+        batch_size = None if options["by_patient"] else options["batch_size"]
+        generator = Generator(registry_model,
+                              db=options["db"],
+                              batch_size=batch_size,
+                              progress_callback=self._show_progress)
+        if options["incremental"]:
+            generator.refresh_tables()
+            self.stdout.write("Reporting tables refreshed OK")
+        else:
+            generator.create_tables()
+            self.stdout.write("Reporting tables generated OK")
+
+    def _show_progress(self, done, total):
+        self.stdout.write("Processed %s/%s clinical records" % (done, total))
@@ -20,6 +20,12 @@ class Command(BaseCommand):
                             choices=['yaml', 'json'],
                             help='Import format: yaml or json')
 
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            dest='dry_run',
+                            default=False,
+                            help='Report the changes the import would make and roll it back')
+
     def handle(self, *args, **options):
         file_name = options.get("registry_file")
         if file_name is None:
@@ -34,4 +40,9 @@ class Command(BaseCommand):
                 raise NotImplementedError("%s not supported yet" % import_format)
 
             with transaction.atomic():
-                importer.create_registry()
+                importer.create_registry(dry_run=options["dry_run"])
+
+        if options["dry_run"]:
+            self.stdout.write("Dry run - nothing was imported")
+        for line in importer.change_summary():
+            self.stdout.write(line)
@@ -1,10 +1,22 @@
+import copy
+import json
+import multiprocessing
+import os
 import time
 from datetime import datetime
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from rdrf.models.definition.models import ClinicalData, CommonDataElement, RegistryForm, Section, RDRFContext, ContextFormGroupItem
+from django.db import connections, router, transaction
+from django.utils import timezone
+from rdrf.models.definition.models import CDEChange, ClinicalData, CommonDataElement, RegistryForm, Section, RDRFContext, ContextFormGroupItem
+from rdrf.models.definition.models import clinical_data_bulk_saved
 from registry.patients.models import Patient, DynamicDataWrapper
 from rdrf.helpers.utils import catch_and_log_exceptions
+from rdrf.db.change_log import cde_values, parse_timestamp
+from rdrf.forms.fields import calculated_functions
+from rdrf.forms.fields.calculation_graph import get_graph, get_form_values, get_patient_values
+from rdrf.forms.fields.calculation_graph import get_section_value, set_section_value
+from rdrf.forms.progress.form_progress import FormProgress
 
 # do not display debug information for the node js call.
 import logging
@@ -13,6 +25,15 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+# patients per shard in the --workers mode; changed records of a shard are
+# written in one transaction
+SHARD_SIZE = 200
+# the serial mode reruns a patient at most this many times
+MAX_PASSES = 10
+# options a worker process needs to rebuild the calculation state
+WORKER_OPTIONS = ['registry_code', 'context_id', 'form_name', 'section_code', 'cde_code', 'depends_on', 'dry_run']
+
+
 class ScriptUser:
     username = 'Calculated field script'
 
@@ -33,12 +54,25 @@ class Command(BaseCommand):
                             help='Only calculate the fields for a specific section')
         parser.add_argument('--cde_code', action='append', type=str,
                             help='Only calculate the fields for a specific CDE')
+        parser.add_argument('--depends_on', action='append', type=str,
+                            help='Only calculate the fields depending directly or indirectly on this CDE')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Recalculate in bulk, sharding the patients over this many processes')
+        parser.add_argument('--shard_size', type=int, default=SHARD_SIZE,
+                            help='Number of patients per shard in the bulk mode')
+        parser.add_argument('--checkpoint', type=str, default=None,
+                            help='File recording the completed shards so an interrupted bulk run can resume')
+        parser.add_argument('--dry_run', action='store_true',
+                            help='Bulk mode: only report how many values would change')
 
         # Test command line example
         # django-admin update_calculated_fields --patient_id=2 --registry_code=fh --form_name=ClinicalData --section_code=SEC0007 --context_id=2 --cde_code=CDEfhDutchLipidClinicNetwork
 
     @catch_and_log_exceptions
     def handle(self, *args, **options):
+        if options.get('workers') is not None or options.get('dry_run') or options.get('checkpoint'):
+            return self._handle_bulk(options)
+
         start = time.time()
         modified_patients = []
 
@@ -52,6 +86,7 @@ class Command(BaseCommand):
         else:
             # Retrieve all calculated fields.
             calculated_cde_models = CommonDataElement.objects.filter(datatype='calculated')
+        calculated_cde_models = in_evaluation_order(calculated_cde_models, options)
 
         # Cache the cde models in a tree format
         # We will use this tree format:
@@ -144,6 +179,280 @@ class Command(BaseCommand):
                 logger.error(f"[LIKELY A BUG] We tried to recalculate the patient {getattr(modified_patient_model, settings.LOG_PATIENT_FIELDNAME)} more the 10 times. "
                              f"We stopped this patient calculated field update.")
 
+    def _handle_bulk(self, options):
+        start = time.time()
+        worker_options = {key: options.get(key) for key in WORKER_OPTIONS}
+        # validates the options before any process is started
+        updater = CalculatedFieldsUpdater(worker_options, self)
+        if not updater.cde_models_tree:
+            self.stdout.write("No calculated fields to update")
+            return
+
+        patients = Patient.objects.filter(rdrf_registry__code__in=list(updater.cde_models_tree.keys()))
+        if options['patient_id']:
+            patients = patients.filter(id__in=options['patient_id'])
+        patient_ids = sorted(set(patients.values_list('id', flat=True)))
+        shard_size = max(options['shard_size'] or SHARD_SIZE, 1)
+        shards = [patient_ids[i:i + shard_size] for i in range(0, len(patient_ids), shard_size)]
+
+        checkpoint = Checkpoint(options['checkpoint'])
+        pending = [shard for shard in shards if shard_key(shard) not in checkpoint.done]
+        if len(pending) < len(shards):
+            self.stdout.write(f"Resuming: {len(shards) - len(pending)} of {len(shards)} shards already done")
+
+        totals = {"records": 0, "values": 0}
+
+        def shard_done(key, records_changed, values_changed):
+            totals["records"] += records_changed
+            totals["values"] += values_changed
+            if not options['dry_run']:
+                checkpoint.mark_done(key)
+            self.stdout.write(f"Shard {key} done: {records_changed} records, {values_changed} values changed")
+
+        workers = options['workers'] or 1
+        if workers == 1:
+            for shard in pending:
+                shard_done(shard_key(shard), *updater.process(shard))
+        else:
+            # the workers must not share the parent's database connections
+            connections.close_all()
+            pool = multiprocessing.get_context("fork").Pool(workers,
+                                                            initializer=_init_worker,
+                                                            initargs=(worker_options,))
+            try:
+                for key, records_changed, values_changed in pool.imap_unordered(_process_shard, pending):
+                    shard_done(key, records_changed, values_changed)
+            finally:
+                pool.close()
+                pool.join()
+
+        verb = "would change" if options['dry_run'] else "changed"
+        self.stdout.write(self.style.SUCCESS(f"{len(patient_ids)} patients: {totals['records']} records and "
+                                             f"{totals['values']} calculated values {verb} "
+                                             f"in {time.time() - start:.1f} seconds."))
+
+
+def in_evaluation_order(calculated_cde_models, options):
+    # inputs before the calculations reading them, so that a single pass
+    # sees the new values of the calculations it depends on
+    graph = get_graph()
+    if options.get('depends_on'):
+        calculated_cde_models = calculated_cde_models.filter(code__in=graph.affected(options['depends_on']))
+    cde_models = {cde_model.code: cde_model for cde_model in calculated_cde_models}
+    return [cde_models[code] for code in graph.sort(cde_models.keys())]
+
+
+def shard_key(shard):
+    return "%s-%s" % (shard[0], shard[-1])
+
+
+class Checkpoint:
+    """
+    The keys of the shards completed by a bulk run, kept in a json file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.done = set(json.load(checkpoint_file).get("done", []))
+
+    def mark_done(self, key):
+        self.done.add(key)
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump({"done": sorted(self.done)}, checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+
+_worker_updater = None
+
+
+def _init_worker(worker_options):
+    global _worker_updater
+    connections.close_all()
+    _worker_updater = CalculatedFieldsUpdater(worker_options)
+
+
+def _process_shard(shard):
+    records_changed, values_changed = _worker_updater.process(shard)
+    return shard_key(shard), records_changed, values_changed
+
+
+class CalculatedFieldsUpdater:
+    """
+    Bulk mode of the command: recalculates the calculated cdes of a shard of
+    patients from their records loaded in one query, evaluating every
+    calculated cde of a form in the same pass (repeated until the values
+    settle, as the serial mode does by rerunning changed patients), and
+    writes the changed records, their snapshots and progress together.
+    """
+
+    def __init__(self, options, command=None):
+        if options['cde_code']:
+            if not options['form_name'] or not options['section_code']:
+                raise Exception("You must provide a form_name and section_code when providing a cde_code")
+            calculated_cde_models = CommonDataElement.objects.filter(code__in=options['cde_code'])
+        else:
+            calculated_cde_models = CommonDataElement.objects.filter(datatype='calculated')
+        calculated_cde_models = in_evaluation_order(calculated_cde_models, options)
+        if options['form_name'] and not options['registry_code']:
+            raise Exception("You must provide a registry_code when providing a form_name")
+
+        self.calculated_codes = [cde_model.code for cde_model in calculated_cde_models]
+        self.cde_models_tree = build_cde_models_tree(calculated_cde_models, options, command)
+        self.functions = {}
+        for code in self.calculated_codes:
+            func = getattr(calculated_functions, code, None)
+            if not func:
+                raise Exception(f"Trying to call unknown calculated function {code}()")
+            self.functions[code] = func
+        self.context_ids = options['context_id']
+        self.dry_run = options['dry_run']
+        self.form_progress = {}
+
+    def process(self, patient_ids):
+        """
+        Returns the number of records and values changed
+        """
+        patients = {patient_model.pk: patient_model for patient_model in
+                    Patient.objects.filter(id__in=patient_ids).prefetch_related("rdrf_registry")}
+        registry_codes = {patient_id: set(r.code for r in patient_model.rdrf_registry.all())
+                          for patient_id, patient_model in patients.items()}
+        records = ClinicalData.objects.filter(collection="cdes",
+                                              django_model="Patient",
+                                              django_id__in=list(patients.keys()),
+                                              registry_code__in=list(self.cde_models_tree.keys())).order_by("pk")
+        changed = []
+        values_changed = 0
+        seen = set()
+        for record in records:
+            key = (record.django_id, record.registry_code, record.context_id)
+            # the serial mode only ever updates the first record of a context
+            if key in seen:
+                continue
+            seen.add(key)
+            if record.registry_code not in registry_codes[record.django_id]:
+                continue
+            if self.context_ids and record.context_id not in self.context_ids:
+                continue
+            changes = self._recalculate(patients[record.django_id], record)
+            if changes:
+                changed.append((patients[record.django_id], record, changes))
+                values_changed += sum(len(form_changes) for form_changes in changes.values())
+
+        if changed and not self.dry_run:
+            self._save(changed)
+        return len(changed), values_changed
+
+    def _recalculate(self, patient_model, record):
+        # form name -> {cde code: new value}, updating record.data in place
+        registry_tree = self.cde_models_tree[record.registry_code]
+        changes = {}
+        for form_dict in record.data.get("forms", []):
+            form_name = form_dict.get("name")
+            if form_name in registry_tree:
+                form_changes = self._recalculate_form(patient_model, record.registry_code,
+                                                      form_dict, registry_tree[form_name])
+                if form_changes:
+                    changes[form_name] = form_changes
+        return changes
+
+    def _recalculate_form(self, patient_model, registry_code, form_dict, form_tree):
+        patient_values = get_patient_values(patient_model, registry_code)
+        calculations = [(section_code, code) for code in self.calculated_codes
+                        for section_code, section_cdes in form_tree.items() if code in section_cdes]
+        changes = {}
+        # the calculations are in evaluation order and each new value is
+        # visible to the next ones, so one pass normally suffices; the second
+        # one confirms nothing else changes
+        for _ in range(MAX_PASSES):
+            pass_changed = False
+            for section_code, code in calculations:
+                new_value = self.functions[code](dict(patient_values), get_form_values(form_dict))
+                if get_section_value(form_dict, section_code, code) != new_value:
+                    set_section_value(form_dict, section_code, code, new_value)
+                    changes[code] = new_value
+                    pass_changed = True
+            if not pass_changed:
+                return changes
+        logger.error(f"[LIKELY A BUG] The calculated fields of form {form_dict.get('name')} for patient "
+                     f"{getattr(patient_model, settings.LOG_PATIENT_FIELDNAME)} did not settle "
+                     f"after {MAX_PASSES} passes.")
+        return changes
+
+    def _get_form_progress(self, registry_model):
+        if registry_model.code not in self.form_progress:
+            self.form_progress[registry_model.code] = FormProgress(registry_model)
+        return self.form_progress[registry_model.code]
+
+    def _save(self, changed):
+        now = datetime.now()
+        snapshots = []
+        for patient_model, record, changes in changed:
+            record.data["timestamp"] = now
+            for form_name in changes:
+                record.data["%s_timestamp" % form_name] = now
+            # bulk_update does not apply auto_now
+            record.last_updated = timezone.now()
+            for form_name in changes:
+                snapshots.append((self._make_snapshot(record, form_name, now), changes[form_name]))
+
+        records = [record for _, record, _ in changed]
+        using = router.db_for_write(ClinicalData)
+        with transaction.atomic(using=using):
+            ClinicalData.objects.bulk_update(records, ["data", "last_updated"])
+            clinical_data_bulk_saved(records, using)
+            ClinicalData.objects.bulk_create([snapshot for snapshot, _ in snapshots])
+            CDEChange.objects.bulk_create([self._make_change(snapshot, key, value)
+                                           for snapshot, form_changes in snapshots
+                                           for key, value in cde_values(snapshot.data["record"]).items()
+                                           if key[0] == snapshot.data["form_name"] and key[2] in form_changes])
+
+        context_models = RDRFContext.objects.select_related("registry").in_bulk([r.context_id for r in records])
+        for patient_model, record, changes in changed:
+            context_model = context_models.get(record.context_id)
+            if context_model is not None:
+                form_progress = self._get_form_progress(context_model.registry)
+                form_progress.save_progress(patient_model, record.data, context_model)
+            logger.info(f"UPDATING DB: These are the new values {changes} - registry: {record.registry_code} - "
+                        f"patient: {getattr(patient_model, settings.LOG_PATIENT_FIELDNAME)} - context: {record.context_id}")
+
+    def _make_snapshot(self, record, form_name, now):
+        # as DynamicDataWrapper.save_snapshot
+        snapshot = {"django_id": record.django_id,
+                    "django_model": record.django_model,
+                    "registry_code": record.registry_code,
+                    "record_type": "snapshot",
+                    "username": ScriptUser.username,
+                    "timestamp": str(now),
+                    "form_user": ScriptUser.username,
+                    "form_name": form_name,
+                    "record": copy.deepcopy(record.data),
+                    "context_id": record.context_id}
+        return ClinicalData(registry_code=record.registry_code,
+                            collection="history",
+                            django_id=record.django_id,
+                            django_model=record.django_model,
+                            context_id=record.context_id,
+                            data=snapshot)
+
+    def _make_change(self, snapshot, key, value):
+        form_name, section_code, cde_code = key
+        return CDEChange(registry_code=snapshot.registry_code,
+                         patient_id=snapshot.django_id,
+                         context_id=snapshot.context_id,
+                         form_name=form_name,
+                         section_code=section_code,
+                         cde_code=cde_code,
+                         value=value,
+                         username=ScriptUser.username,
+                         timestamp=parse_timestamp(snapshot.data["timestamp"]),
+                         snapshot_id=snapshot.pk)
+
 
 def calculate_cde(patient_model, registry_code, form_cde_values, calculated_cde_model):
     patient_values = {'date_of_birth': patient_model.date_of_birth,
@@ -157,8 +466,7 @@ def calculate_cde(patient_model, registry_code, form_cde_values, calculated_cde_
             if type(cde) is not list:
                 form_values = {**form_values, cde["code"]: cde["value"]}
 
-    mod = __import__('rdrf.forms.fields.calculated_functions', fromlist=['object'])
-    func = getattr(mod, calculated_cde_model.code)
+    func = getattr(calculated_functions, calculated_cde_model.code, None)
     if func:
         return func(patient_values, form_values)
     else:
@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand
+from rdrf.db import cde_index
+from rdrf.models.definition.models import Registry
+
+
+class Command(BaseCommand):
+    """
+    (re)-create the index of the indexed cdes of the registries
+    """
+    help = "Rebuilds the clinical value index of the registries' indexed cdes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry-code", dest="registry_code", default=None,
+                            help="Only this registry")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Index rows written per insert")
+
+    def handle(self, *args, **options):
+        registries = Registry.objects.all()
+        if options["registry_code"]:
+            registries = registries.filter(code=options["registry_code"])
+        for registry_model in registries:
+            written = cde_index.rebuild(registry_model, options["batch_size"])
+            self.stdout.write("%s: %s cdes indexed, %s values" % (
+                registry_model.code, len(registry_model.indexed_cdes), written))
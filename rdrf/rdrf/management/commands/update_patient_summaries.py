@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from rdrf.models.definition.models import Registry, ClinicalData
+from registry.patients.models import Patient, PatientSummary
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the patient listing summaries of a registry from the saved form progress"
+
+    def add_arguments(self, parser):
+        parser.add_argument("registry_code")
+
+    def handle(self, registry_code, **options):
+        try:
+            registry_model = Registry.objects.get(code=registry_code)
+        except Registry.DoesNotExist:
+            raise CommandError("Unknown registry code: %s" % registry_code)
+
+        if registry_model.has_feature("contexts"):
+            raise CommandError("The patient listing does not show summaries for registries with contexts")
+
+        patients = {p.pk: p for p in Patient.objects.filter(rdrf_registry__in=[registry_model])}
+        progress_records = ClinicalData.objects.collection(registry_code, "progress") \
+                                               .filter(django_model="Patient", django_id__in=list(patients.keys())) \
+                                               .values_list("django_id", "data")
+        updated = set()
+        for patient_id, data in progress_records.iterator():
+            # the listing shows the first progress record of a patient
+            if patient_id not in updated:
+                PatientSummary.update_from_progress(registry_model, patients[patient_id], data)
+                updated.add(patient_id)
+
+        self.stdout.write("Updated %s patient summaries" % len(updated))
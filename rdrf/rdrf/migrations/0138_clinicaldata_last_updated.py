@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0137_auto_20201021_1419'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clinicaldata',
+            name='last_updated',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True),
+        ),
+    ]
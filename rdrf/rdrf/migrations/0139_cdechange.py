@@ -0,0 +1,34 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:02
+
+from django.db import migrations, models
+import rdrf.forms.fields.jsonb
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0138_clinicaldata_last_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CDEChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('patient_id', models.IntegerField()),
+                ('context_id', models.IntegerField(blank=True, null=True)),
+                ('form_name', models.CharField(max_length=80)),
+                ('section_code', models.CharField(max_length=100)),
+                ('cde_code', models.CharField(max_length=30)),
+                ('value', rdrf.forms.fields.jsonb.DataField(blank=True, default=dict, null=True)),
+                ('username', models.CharField(blank=True, max_length=254, null=True)),
+                ('timestamp', models.DateTimeField()),
+                ('snapshot_id', models.IntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cdechange',
+            index=models.Index(fields=['registry_code', 'patient_id', 'form_name', 'section_code', 'cde_code', 'timestamp'], name='rdrf_cdecha_registr_d816d1_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0139_cdechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CDEIndexValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('patient_id', models.IntegerField()),
+                ('context_id', models.IntegerField(blank=True, null=True)),
+                ('form_name', models.CharField(max_length=80)),
+                ('section_code', models.CharField(max_length=100)),
+                ('cde_code', models.CharField(max_length=30)),
+                ('item', models.IntegerField(default=0)),
+                ('value_text', models.CharField(blank=True, max_length=255, null=True)),
+                ('value_number', models.FloatField(blank=True, null=True)),
+                ('value_date', models.DateField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cdeindexvalue',
+            index=models.Index(fields=['registry_code', 'cde_code', 'value_text'], name='rdrf_cdeind_registr_4c25c9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cdeindexvalue',
+            index=models.Index(fields=['registry_code', 'cde_code', 'value_number'], name='rdrf_cdeind_registr_a54989_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cdeindexvalue',
+            index=models.Index(fields=['registry_code', 'cde_code', 'value_date'], name='rdrf_cdeind_registr_9eff09_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cdeindexvalue',
+            index=models.Index(fields=['registry_code', 'patient_id', 'context_id'], name='rdrf_cdeind_registr_85e3ce_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0140_cdeindexvalue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CDEChangeBackfill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10, unique=True)),
+                ('backfilled_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 14:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0141_cdechangebackfill'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customaction',
+            name='action_type',
+            field=models.CharField(choices=[('PR', 'Patient Report'), ('SR', 'Patient Status Report'), ('DE', 'Deidentified Data Extract'), ('PQ', 'Parquet Export')], max_length=2),
+        ),
+    ]
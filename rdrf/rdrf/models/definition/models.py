@@ -14,7 +14,7 @@ from django.urls import reverse
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.db import models
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_save, post_delete, m2m_changed
 from django.dispatch.dispatcher import receiver
 from django.forms.models import model_to_dict
 from django.utils.safestring import mark_safe
@@ -78,9 +78,9 @@ class Section(models.Model):
 
     @property
     def cde_models(self):
+        from rdrf.helpers.metadata_cache import get_cdes
         codes = self.get_elements()
-        qs = CommonDataElement.objects.filter(code__in=codes)
-        cdes = {cde.code: cde for cde in qs}
+        cdes = get_cdes(codes)
         return [cdes[code] for code in codes]
 
     def get_cde(self, code):
@@ -434,7 +434,8 @@ class Registry(models.Model):
 
     @property
     def forms(self):
-        return [f for f in RegistryForm.objects.filter(registry=self).order_by('position')]
+        from rdrf.helpers.metadata_cache import get_forms
+        return get_forms(self)
 
     def has_feature(self, feature):
         if "features" in self.metadata:
@@ -498,6 +499,18 @@ class Registry(models.Model):
                 raise ValidationError("metadata json field should be a valid json dictionary")
         except ValueError:
             raise ValidationError("metadata json field should be a valid json dictionary")
+        for key in value.get("indexed_cdes", []):
+            if not isinstance(key, str) or len(key.split(settings.FORM_SECTION_DELIMITER)) != 3:
+                raise ValidationError("indexed_cdes should be a list of form%ssection%scde keys" % (
+                    settings.FORM_SECTION_DELIMITER, settings.FORM_SECTION_DELIMITER))
+
+    @property
+    def indexed_cdes(self):
+        """
+        ( form name, section code, cde code ) of the cdes listed as delimited
+        keys in the "indexed_cdes" metadata, see rdrf.db.cde_index
+        """
+        return [tuple(key.split(settings.FORM_SECTION_DELIMITER)) for key in self.metadata.get("indexed_cdes", [])]
 
     @property
     def proms_system_url(self):
@@ -694,14 +707,13 @@ class CommonDataElement(models.Model):
         elif stored_value == "NaN":
             # the DataTable was not escaping this value and interpreting it as NaN
             return ":NaN"
-        elif self.pv_group:
+        elif self.pv_group_id:
             # if a range, return the display value
+            from rdrf.helpers.metadata_cache import get_permitted_values
             try:
-                values_dict = self.pv_group.as_dict()
-                for value_dict in values_dict["values"]:
-                    if value_dict["code"] == stored_value:
-                        display_value = value_dict["value"]
-                        return display_value
+                for permitted_value in get_permitted_values(self.pv_group_id):
+                    if permitted_value.code == stored_value:
+                        return permitted_value.value
 
             except Exception as ex:
                 logger.error("bad value for cde %s %s: %s" % (self.code,
@@ -983,14 +995,8 @@ class RegistryForm(models.Model):
 
     @property
     def section_models(self):
-        models = []
-        for section_code in self.get_sections():
-            try:
-                section_model = Section.objects.get(code=section_code)
-                models.append(section_model)
-            except Section.DoesNotExist:
-                pass
-        return models
+        from rdrf.helpers.metadata_cache import get_sections
+        return get_sections(self.get_sections())
 
     def get_section_model(self, code):
         for section_model in self.section_models:
@@ -1829,6 +1835,8 @@ class ClinicalData(models.Model):
     active = models.BooleanField(
         default=True, help_text="Indicate whether an entity is active or not")
     metadata = models.TextField(blank=True, null=True)
+    # null for records last saved before this was tracked
+    last_updated = models.DateTimeField(auto_now=True, blank=True, null=True, db_index=True)
 
     objects = ClinicalDataQuerySet.as_manager()
 
@@ -1876,18 +1884,23 @@ class ClinicalData(models.Model):
         self.metadata = json.dumps(metadata)
         self.save()
 
+    @property
+    def document(self):
+        """
+        Indexed view of data, built on first access and reset on save
+        """
+        if getattr(self, "_document", None) is None:
+            from rdrf.db.clinical_document import ClinicalDocument
+            self._document = ClinicalDocument(self.data)
+        return self._document
+
     def cde_val(self, form_name, section_code, cde_code):
-        forms = self.data.get("forms", [])
-        form_map = {f.get("name"): f for f in forms}
-        sections = form_map.get(form_name, {}).get("sections", [])
-        section_map = {s.get("code"): s for s in sections}
-        cdes = section_map.get(section_code, {}).get("cdes", [])
-        cde_map = {c.get("code"): c for c in cdes}
-        return cde_map.get(cde_code, {}).get("value")
+        return self.document.value(form_name, section_code, cde_code)
 
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
+        self._document = None
 
     def clean(self):
         self._clean_registry_code()
@@ -1928,6 +1941,93 @@ class ClinicalData(models.Model):
                 raise ValidationError({"data": e})
 
 
+class CDEChange(models.Model):
+    """
+    A cde value changed by a form save, see rdrf.db.change_log.
+    Lives in the clinical database next to the history it indexes.
+    """
+    registry_code = models.CharField(max_length=10)
+    patient_id = models.IntegerField()
+    context_id = models.IntegerField(blank=True, null=True)
+    form_name = models.CharField(max_length=80)
+    section_code = models.CharField(max_length=100)
+    cde_code = models.CharField(max_length=30)
+    value = DataField(blank=True, null=True)
+    username = models.CharField(max_length=254, blank=True, null=True)
+    timestamp = models.DateTimeField()
+    # the history record the change was read from
+    snapshot_id = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["registry_code", "patient_id", "form_name", "section_code", "cde_code", "timestamp"]),
+        ]
+
+    def __str__(self):
+        return "%s %s %s/%s/%s = %s" % (self.registry_code, self.patient_id, self.form_name,
+                                        self.section_code, self.cde_code, self.value)
+
+
+class CDEChangeBackfill(models.Model):
+    """
+    The change log of the registry holds its history from before the log
+    existed ( written by backfill_cde_changes )
+    """
+    registry_code = models.CharField(max_length=10, unique=True)
+    backfilled_at = models.DateTimeField()
+
+    def __str__(self):
+        return "%s backfilled at %s" % (self.registry_code, self.backfilled_at)
+
+
+class CDEIndexValue(models.Model):
+    """
+    A value of one of the indexed cdes of a registry, see rdrf.db.cde_index.
+    Only the column matching the cde datatype is set.
+    """
+    registry_code = models.CharField(max_length=10)
+    patient_id = models.IntegerField()
+    context_id = models.IntegerField(blank=True, null=True)
+    form_name = models.CharField(max_length=80)
+    section_code = models.CharField(max_length=100)
+    cde_code = models.CharField(max_length=30)
+    # position in a multisection
+    item = models.IntegerField(default=0)
+    value_text = models.CharField(max_length=255, blank=True, null=True)
+    value_number = models.FloatField(blank=True, null=True)
+    value_date = models.DateField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["registry_code", "cde_code", "value_text"]),
+            models.Index(fields=["registry_code", "cde_code", "value_number"]),
+            models.Index(fields=["registry_code", "cde_code", "value_date"]),
+            models.Index(fields=["registry_code", "patient_id", "context_id"]),
+        ]
+
+
+@receiver(post_save, sender=ClinicalData)
+def clinical_data_indexed(sender, instance, **kwargs):
+    from rdrf.db import cde_index
+    cde_index.update_record(instance)
+
+
+def clinical_data_bulk_saved(records, using):
+    """
+    bulk_update sends no post_save - sends it for the records written
+    with it so the receivers ( cde index, report field values ) run
+    """
+    for record in records:
+        post_save.send(sender=ClinicalData, instance=record, created=False, raw=False, using=using,
+                       update_fields=None)
+
+
+@receiver(post_delete, sender=ClinicalData)
+def clinical_data_unindexed(sender, instance, **kwargs):
+    from rdrf.db import cde_index
+    cde_index.delete_record(instance)
+
+
 def file_upload_to(instance, filename):
     return "/".join(filter(bool, [
         instance.registry_code,
@@ -1961,6 +2061,24 @@ def fileuploaditem_delete(sender, instance, **kwargs):
     instance.item.delete(False)
 
 
+def definition_changed(sender, **kwargs):
+    from rdrf.helpers.metadata_cache import invalidate
+    invalidate()
+
+
+for definition_model in (Registry, RegistryForm, Section, CommonDataElement,
+                         CDEPermittedValueGroup, CDEPermittedValue, CdePolicy, ConsentSection, ConsentQuestion):
+    post_save.connect(definition_changed, sender=definition_model,
+                      dispatch_uid="definition_saved_%s" % definition_model.__name__)
+    post_delete.connect(definition_changed, sender=definition_model,
+                        dispatch_uid="definition_deleted_%s" % definition_model.__name__)
+
+m2m_changed.connect(definition_changed, sender=RegistryForm.complete_form_cdes.through,
+                    dispatch_uid="definition_m2m_complete_form_cdes")
+m2m_changed.connect(definition_changed, sender=CdePolicy.groups_allowed.through,
+                    dispatch_uid="definition_m2m_cde_policy_groups")
+
+
 class FileStorage(models.Model):
     """
     This model is used only when the database file storage backend is
@@ -1978,7 +2096,8 @@ class CustomAction(models.Model):
     """
     ACTION_TYPES = (("PR", "Patient Report"),
                     ("SR", "Patient Status Report"),
-                    ("DE", "Deidentified Data Extract"))
+                    ("DE", "Deidentified Data Extract"),
+                    ("PQ", "Parquet Export"))
 
     SCOPES = (("U", "Universal"),
               ("P", "Patient"))
@@ -2128,7 +2247,7 @@ class CustomAction(models.Model):
             logger.info("CUSTOMACTION %s %s by user %s on patient %s" % (self.registry.code,
                                                                          self.name,
                                                                          user.username,
-                                                                         patient_model.pk))
+                                                                         patient_model.pk if patient_model else "cohort"))
             return result
         elif self.action_type == "SR":
             from rdrf.services.io.actions import patient_status_report
@@ -2146,6 +2265,11 @@ class CustomAction(models.Model):
             logger.info("CUSTOMACTION DE %s %s" % (self.registry.code,
                                                    user.username))
             return deidentified_data_extract.execute(self, user)
+        elif self.action_type == "PQ":
+            from rdrf.services.io.actions import parquet_extract
+            logger.info("CUSTOMACTION PQ %s %s" % (self.registry.code,
+                                                   user.username))
+            return parquet_extract.execute(self, user, run_async=self.asynchronous)
 
         else:
             raise NotImplementedError("Unknown action type: %s" % self.action_type)
@@ -1,10 +1,10 @@
 from django.db import models
 from django.utils.translation import ugettext as _
 
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.models import Registry
 from rdrf.models.definition.models import RegistryForm
 from rdrf.models.definition.models import Section
-from rdrf.models.definition.models import CommonDataElement
 from rdrf.models.definition.models import RDRFContext
 from rdrf.helpers.utils import generate_token
 from rdrf.helpers.utils import check_models
@@ -152,8 +152,8 @@ class TargetUpdater:
                 registry_model = self.review_item.review.registry
                 form_model = RegistryForm.objects.get(name=form_name,
                                                       registry=registry_model)
-                section_model = Section.objects.get(code=section_code)
-                cde_model = CommonDataElement.objects.get(code=cde_code)
+                section_model = metadata_cache.load_section(section_code)
+                cde_model = metadata_cache.load_cde(cde_code)
 
                 check_models(registry_model, form_model, section_model, cde_model)
 
@@ -176,8 +176,8 @@ def parse_appearance_condition(condition):
         return None
     form_name, section_code, cde_code = spec.strip().split(".")
     form_model = RegistryForm.objects.get(name=form_name)
-    section_model = Section.objects.get(code=section_code)
-    cde_model = CommonDataElement.objects.get(code=cde_code)
+    section_model = metadata_cache.load_section(section_code)
+    cde_model = metadata_cache.load_cde(cde_code)
     value = value.strip()
     datatype = cde_model.datatype.lower().strip()
     if datatype == "integer":
@@ -601,8 +601,8 @@ class ReviewItem(models.Model):
             target_dict = field_dict["target"]
             form_model = RegistryForm.objects.get(registry=registry_model,
                                                   name=target_dict["form"])
-            section_model = Section.objects.get(code=target_dict["section"])
-            cde_model = CommonDataElement.objects.get(code=target_dict["cde"])
+            section_model = metadata_cache.load_section(target_dict["section"])
+            cde_model = metadata_cache.load_cde(target_dict["cde"])
             return form_model, section_model, cde_model
 
         for field_dict in metadata:
@@ -1,17 +1,25 @@
 import sqlalchemy as alc
 from sqlalchemy import create_engine, MetaData
 from django.conf import settings
+from django.utils import timezone
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.models import ContextFormGroup
-from rdrf.models.definition.models import CommonDataElement
 from rdrf.models.definition.models import ClinicalData
 from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.db.clinical_document import ClinicalDocument
 from rdrf.forms.progress.form_progress import FormProgress
 from rdrf.helpers.utils import cached
 from registry.patients.models import Patient
 import logging
 from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
+from django.db.models.functions import Coalesce
+import hashlib
+import json
 import re
+import time
+from datetime import timedelta
 from functools import lru_cache
 from operator import attrgetter
 
@@ -19,6 +27,16 @@ logger = logging.getLogger(__name__)
 
 MAX_TABLE_NAME_LENGTH = 63
 
+# number of clinical records fetched per round trip from the server side
+# cursor and the number of rows buffered per table before they are inserted
+BATCH_SIZE = 500
+
+# incremental refreshes reprocess records saved this long before the last
+# run started, to cover transactions that were still open at the time
+REFRESH_OVERLAP = timedelta(minutes=5)
+REFRESH_STATE_TABLE = "reporting_refresh_state"
+STAGING_SUFFIX = "_staging"
+
 
 def unambigious_name(section_code, cde_code):
     return no_space_lower(section_code + "_" + cde_code)
@@ -101,9 +119,17 @@ def get_form_group(context_model):
         return context_model.context_form_group.direct_name
 
 
+def get_timestamp_value(timestamp):
+    # form timestamps are stored either as a value or as {"timestamp": value}
+    if timestamp:
+        if isinstance(timestamp, dict):
+            return timestamp.get("timestamp")
+        return timestamp
+
+
 @cached
 def get_cde_model(code):
-    return CommonDataElement.objects.get(code=code)
+    return metadata_cache.load_cde(code)
 
 
 @cached
@@ -122,17 +148,35 @@ def nice_name(s):
 
 
 @lru_cache(maxsize=100)
-def get_clinical_data(registry_code, patient_id, context_id):
+def get_nested_clinical_data(registry_code, patient_id, context_id):
     patient_model = Patient.objects.get(pk=patient_id)
     wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
-    return wrapper.load_dynamic_data(registry_code, "cdes")
+    return wrapper.load_dynamic_data(registry_code, "cdes", flattened=False)
 
 
 @lru_cache(maxsize=100)
-def get_nested_clinical_data(registry_code, patient_id, context_id):
-    patient_model = Patient.objects.get(pk=patient_id)
-    wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
-    return wrapper.load_dynamic_data(registry_code, "cdes", flattened=False)
+def get_clinical_document(registry_code, patient_id, context_id):
+    # every column of a row reads from the same record so index it once
+    return ClinicalDocument(get_nested_clinical_data(registry_code, patient_id, context_id))
+
+
+class ExtractedRecord:
+    """
+    The clinical record of one patient context together with the
+    progress and last editing users of its forms, gathered up front by the
+    batch extraction so that building rows makes no queries.
+    """
+
+    def __init__(self, patient_id, context_model, form_group, document, progress, users):
+        self.patient_id = patient_id
+        self.context_model = context_model
+        self.form_group = form_group
+        self.document = document
+        self.progress = progress
+        self.users = users
+
+    def get_form_timestamp(self, form_model):
+        return get_timestamp_value(self.document.data.get(form_model.name + "_timestamp"))
 
 
 class DataSource:
@@ -205,8 +249,9 @@ class DataSource:
         snapshots = sorted([s for s in snapshots],
                            key=attrgetter("pk"), reverse=True)
         for snapshot in snapshots:
-            if snapshot.data and "record" in snapshot.data:
-                record = snapshot.data["record"]
+            if snapshot.data:
+                # deltas keep the context id at the top level only
+                record = snapshot.data.get("record", snapshot.data)
                 if "context_id" in record:
                     if context_model.pk == record["context_id"]:
                         if "form_name" in snapshot.data:
@@ -215,24 +260,44 @@ class DataSource:
                                 if "form_user" in snapshot.data:
                                     return snapshot.data["form_user"]
 
+    def get_record_value(self, record):
+        """
+        Like get_value but reads from a preloaded ExtractedRecord
+        """
+        if not self.field:
+            return self._get_document_value(record.document)
+        elif self.field == "patient_id":
+            return record.patient_id
+        elif self.field == "form":
+            return self.form_model.name
+        elif self.field == "context_id":
+            return record.context_model.pk
+        elif self.field == "section":
+            return self.section_model.display_name
+        elif self.field == "form_group":
+            return record.form_group
+        elif self.field == "username":
+            return record.users.get(self.form_model.name)
+        elif self.field == "timestamp":
+            return record.get_form_timestamp(self.form_model)
+        elif self.field == "progress":
+            return record.progress.get(self.form_model.name, 0)
+        else:
+            raise Exception("Unknown field: %s" % self.field)
+
     def _get_cde_value(self, patient_model, context_model):
-        try:
-            data = get_clinical_data(self.registry_model.code,
-                                     patient_model.pk,
-                                     context_model.pk)
-
-            raw_value = patient_model.get_form_value(self.registry_model.code,
-                                                     self.form_model.name,
-                                                     self.section_model.code,
-                                                     self.cde_model.code,
-                                                     False,
-                                                     context_id=context_model.pk,
-                                                     clinical_data=data)
-
-        except KeyError:
+        document = get_clinical_document(self.registry_model.code,
+                                         patient_model.pk,
+                                         context_model.pk)
+        return self._get_document_value(document)
+
+    def _get_document_value(self, document):
+        key = (self.form_model.name, self.section_model.code, self.cde_model.code)
+        if key not in document:
             # the dynamic data record is empty
             return None
 
+        raw_value = document.value(*key)
         value = self.cde_model.get_display_value(raw_value)
         return fix_display_value(self.cde_model.datatype, value)
 
@@ -320,6 +385,8 @@ class ClinicalTable:
         self.columns = columns
         self.form_model = form_model
         self.section_model = section_model
+        # the table rows are written to - a staging table during a rebuild
+        self.target = table
 
     @property
     def is_multisection(self):
@@ -337,32 +404,41 @@ class MultiSectionExtractor:
 
     def get_rows(self, patient_model, context_model):
 
-        nested_clinical_data = get_nested_clinical_data(self.registry_model.code,
-                                                        patient_model.pk,
-                                                        context_model.pk)
+        document = get_clinical_document(self.registry_model.code,
+                                         patient_model.pk,
+                                         context_model.pk)
 
-        items_list = patient_model.evaluate_field_expression(self.registry_model,
-                                                             self.field_expression,
-                                                             clinical_data=nested_clinical_data)
+        items_list = document.items(self.clinical_table.form_model.name,
+                                    self.clinical_table.section_model.code)
 
         return self._convert_to_rows(patient_model, context_model, items_list)
 
+    def get_record_rows(self, record):
+        items_list = record.document.items(self.clinical_table.form_model.name,
+                                           self.clinical_table.section_model.code)
+        if not items_list:
+            return []
+        form_timestamp = record.get_form_timestamp(self.clinical_table.form_model)
+        return self._item_rows(record.patient_id, record.context_model.pk, form_timestamp, items_list)
+
     def _convert_to_rows(self, patient_model, context_model, items_list):
         form_timestamp = patient_model.get_form_timestamp(
             self.clinical_table.form_model, context_model=context_model)
+        return self._item_rows(patient_model.pk, context_model.pk, form_timestamp, items_list)
 
+    def _item_rows(self, patient_id, context_id, form_timestamp, items_list):
         for index, item_dict in enumerate(items_list):
             item_number = index + 1
             row_dict = {}
             row_dict["form"] = self.clinical_table.form_model.name
             row_dict["section"] = self.clinical_table.section_model.display_name
             row_dict["item"] = item_number
-            row_dict["patient_id"] = patient_model.pk
-            row_dict["context_id"] = context_model.pk
+            row_dict["patient_id"] = patient_id
+            row_dict["context_id"] = context_id
             row_dict["timestamp"] = form_timestamp
 
             for cde_code in item_dict:
-                cde_model = CommonDataElement.objects.get(code=cde_code)
+                cde_model = metadata_cache.load_cde(cde_code)
                 is_file = lower_strip(cde_model.datatype) == "file"
                 # column_name = no_space_lower(cde_code)
                 column_name = unambigious_name(self.clinical_table.section_model.code, cde_code)
@@ -393,8 +469,30 @@ class MultiSectionExtractor:
 
 
 class Generator:
-    def __init__(self, registry_model, db="reporting"):
+    """
+    Builds reporting tables for a registry.
+
+    By default the clinical data is extracted in batches: the cdes records of
+    the registry are streamed through a server side cursor batch_size at a
+    time, joined in memory to the patients, contexts, form progress and
+    last editing users that are loaded once up front, and the rows are
+    written with multi-row inserts. Peak memory is bounded by batch_size
+    rather than the size of the registry.
+    Pass batch_size=None to extract patient by patient instead.
+
+    progress_callback, if given, is called as progress_callback(done, total)
+    with the number of clinical records processed so far.
+
+    working_groups, if given, restricts the extract to the patients of those
+    working groups.
+    """
+
+    def __init__(self, registry_model, db="reporting", batch_size=BATCH_SIZE, progress_callback=None,
+                 working_groups=None):
         self.registry_model = registry_model
+        self.working_groups = working_groups
+        self.batch_size = batch_size
+        self.progress_callback = progress_callback
         self.clinical_engine = self._create_engine("clinical")
         self.default_engine = self._create_engine("default")
         self.has_form_groups = ContextFormGroup.objects.filter(
@@ -430,7 +528,11 @@ class Generator:
 
     def _create_engine(self, db_name="default"):
         # we should probably add a reporting db ...
-        return create_engine(pg_uri(settings.DATABASES[db_name]))
+        # executemany_mode="values" turns executemany inserts into multi-row
+        # INSERT .. VALUES statements
+        return create_engine(pg_uri(settings.DATABASES[db_name]),
+                             executemany_mode="values",
+                             executemany_values_page_size=BATCH_SIZE)
 
     def _get_table_for_model(self, model, db_name="default"):
 
@@ -550,15 +652,88 @@ class Generator:
         self._copy_table_data(source_engine, target_engine, table)
 
     def create_tables(self):
+        """
+        Rebuilds all the reporting tables. The clinical tables are filled under
+        staging names and swapped in within one transaction, so readers see
+        the previous tables until the new ones are complete.
+        """
         if self.reporting_engine is not self.default_engine:
             self._create_demographic_tables()
 
+        self._define_clinical_tables()
+        for clinical_table in self.clinical_tables:
+            clinical_table.target = self._create_staging_table(clinical_table.table)
+
+        refresh_started = timezone.now()
+        self._extract_clinical_data()
+
+        with self.reporting_engine.begin() as conn:
+            for clinical_table in self.clinical_tables:
+                self._swap_table(conn, clinical_table)
+            self._save_refresh_state(conn, refresh_started)
+
+    def export(self, writer):
+        """
+        Extracts the clinical tables through writer ( e.g. a
+        parquet_export.ParquetWriter ) instead of the reporting database
+        """
+        self._define_clinical_tables()
+        writer.open([clinical_table.table for clinical_table in self.clinical_tables])
+        context_ids = None
+        if self.working_groups is not None:
+            # only the clinical records of those patients are read
+            context_ids = set(self._load_contexts(set(self.patients.values_list("pk", flat=True))))
+        self._extract_clinical_data_in_batches(writer=writer, context_ids=context_ids)
+
+    def refresh_tables(self):
+        """
+        Updates the clinical tables in place from the clinical records and
+        contexts changed since the last run. Rows of changed and deleted
+        contexts are deleted and the changed ones rewritten in a single
+        transaction, so readers never see a partial refresh.
+        Falls back to create_tables if there is no previous run or the
+        registry definition has changed since.
+        """
+        self._define_clinical_tables()
+        state = self._load_refresh_state()
+        if state is None or state["schema_signature"] != self._schema_signature() or not self._tables_exist():
+            logger.info("reporting tables for %s need a full rebuild" % self.registry_model.code)
+            self.clinical_tables = []
+            self.column_map = {}
+            return self.create_tables()
+
+        if self.reporting_engine is not self.default_engine:
+            self._create_demographic_tables()
+
+        refresh_started = timezone.now()
+        since = state["high_water_mark"] - REFRESH_OVERLAP
+        current_context_ids = list(self._load_contexts(set(self.patients.values_list("pk", flat=True))).keys())
+        changed_context_ids = self._changed_context_ids(since) & set(current_context_ids)
+        logger.info("refreshing reporting tables for %s: %s changed contexts" % (self.registry_model.code,
+                                                                                 len(changed_context_ids)))
+
+        with self.reporting_engine.begin() as conn:
+            for clinical_table in self.clinical_tables:
+                table = clinical_table.table
+                if current_context_ids:
+                    conn.execute(table.delete().where(~table.c.context_id.in_(current_context_ids)))
+                else:
+                    conn.execute(table.delete())
+                if changed_context_ids:
+                    conn.execute(table.delete().where(table.c.context_id.in_(list(changed_context_ids))))
+
+            if changed_context_ids:
+                self._extract_clinical_data_in_batches(writer=BatchWriter(conn, self.chunk_size),
+                                                       context_ids=changed_context_ids)
+            self._save_refresh_state(conn, refresh_started)
+
+    def _define_clinical_tables(self):
         for form_model in self.registry_model.forms:
             if form_model.name.startswith("GeneratedQuestionnaire"):
                 continue
 
             columns = self._create_form_columns(form_model)
-            table = self._create_table(form_model.name, columns)
+            table = self._define_table(form_model.name, columns)
 
             single_form_table = ClinicalTable(TableType.CLINICAL_FORM,
                                               table,
@@ -580,7 +755,7 @@ class Generator:
                     if "!" in table_name:
                         table_name = table_name.replace("!", "")
 
-                    table = self._create_table(table_name, columns)
+                    table = self._define_table(table_name, columns)
                     multisection_table = ClinicalTable(TableType.MULTISECTION,
                                                        table,
                                                        columns,
@@ -589,13 +764,71 @@ class Generator:
 
                     self.clinical_tables.append(multisection_table)
 
-        self._extract_clinical_data()
+    def _schema_signature(self):
+        schema = [[clinical_table.table.name, [[column.name, str(column.type)]
+                                               for column in clinical_table.table.columns]]
+                  for clinical_table in self.clinical_tables]
+        return hashlib.md5(json.dumps(schema).encode("utf-8")).hexdigest()
+
+    def _tables_exist(self):
+        return all(self.reporting_engine.has_table(clinical_table.table.name)
+                   for clinical_table in self.clinical_tables)
+
+    def _get_refresh_state_table(self):
+        table = alc.Table(REFRESH_STATE_TABLE, MetaData(self.reporting_engine),
+                          alc.Column("registry_code", alc.String, primary_key=True),
+                          alc.Column("high_water_mark", alc.DateTime, nullable=False),
+                          alc.Column("schema_signature", alc.String, nullable=False))
+        table.create(checkfirst=True)
+        return table
+
+    def _load_refresh_state(self):
+        table = self._get_refresh_state_table()
+        row = self.reporting_engine.execute(
+            table.select().where(table.c.registry_code == self.registry_model.code)).first()
+        return dict(row) if row is not None else None
+
+    def _save_refresh_state(self, conn, high_water_mark):
+        table = self._get_refresh_state_table()
+        conn.execute(table.delete().where(table.c.registry_code == self.registry_model.code))
+        conn.execute(table.insert().values(registry_code=self.registry_model.code,
+                                           high_water_mark=high_water_mark,
+                                           schema_signature=self._schema_signature()))
+
+    def _changed_context_ids(self, since):
+        from rdrf.models.definition.models import RDRFContext
+        # saving cdes, progress or a history snapshot all touch last_updated
+        changed = set(ClinicalData.objects.filter(registry_code=self.registry_model.code,
+                                                  django_model="Patient",
+                                                  last_updated__gte=since)
+                                          .values_list("context_id", flat=True)
+                                          .distinct())
+        changed.update(RDRFContext.objects.filter(registry=self.registry_model,
+                                                  last_updated__gte=since).values_list("pk", flat=True))
+        changed.discard(None)
+        return changed
+
+    @property
+    def chunk_size(self):
+        # records fetched and rows written at a time in the batched extract,
+        # which refresh_tables also uses when extracting patient by patient
+        return self.batch_size or BATCH_SIZE
 
     @property
     def patients(self):
-        return Patient.objects.filter(rdrf_registry__in=[self.registry_model])
+        from registry.patients.search import working_group_patients
+        patients = Patient.objects.filter(rdrf_registry__in=[self.registry_model])
+        if self.working_groups is not None:
+            patients = working_group_patients(patients, self.working_groups)
+        return patients
 
     def _extract_clinical_data(self):
+        if self.batch_size:
+            self._extract_clinical_data_in_batches()
+        else:
+            self._extract_clinical_data_by_patient()
+
+    def _extract_clinical_data_by_patient(self):
         form_tables = [
             t for t in self.clinical_tables if not t.is_multisection]
         multi_tables = [t for t in self.clinical_tables if t.is_multisection]
@@ -610,7 +843,7 @@ class Generator:
                             row = {ds.column_name: ds.get_value(
                                 patient_model, context_model) for ds in datasources}
                             self.reporting_engine.execute(
-                                clinical_table.table.insert().values(**row))
+                                clinical_table.target.insert().values(**row))
                             row_count += 1
 
         for clinical_table in multi_tables:
@@ -629,9 +862,155 @@ class Generator:
                                     patient_model, context_model):
                                 self._clean_row(item_row, current_column_names)
                                 self.reporting_engine.execute(
-                                    clinical_table.table.insert().values(**item_row))
+                                    clinical_table.target.insert().values(**item_row))
                                 row_count += 1
 
+    def _extract_clinical_data_in_batches(self, writer=None, context_ids=None):
+        """
+        Writes the rows of all contexts of the registry's patients, or only
+        those in context_ids
+        """
+        start = time.time()
+        form_tables = [t for t in self.clinical_tables if not t.is_multisection]
+        multi_tables = [t for t in self.clinical_tables if t.is_multisection]
+        form_datasources = {t.table.name: [self.column_map[column] for column in t.columns]
+                            for t in form_tables}
+        extractors = {t.table.name: MultiSectionExtractor(self.registry_model, t, None)
+                      for t in multi_tables}
+
+        patient_ids = set(self.patients.values_list("pk", flat=True))
+        contexts = self._load_contexts(patient_ids)
+        if context_ids is not None:
+            contexts = {pk: context_model for pk, context_model in contexts.items() if pk in context_ids}
+        context_forms = self._load_context_form_ids(contexts.values())
+        form_names = set(t.form_model.name for t in self.clinical_tables)
+        progress = self._load_progress(form_names, context_ids)
+        users = self._load_last_users(context_ids)
+
+        form_groups = {}
+        for context_model in contexts.values():
+            if context_model.context_form_group_id not in form_groups:
+                form_groups[context_model.context_form_group_id] = get_form_group(context_model)
+
+        if writer is None:
+            writer = BatchWriter(self.reporting_engine, self.chunk_size)
+
+        def extract(record):
+            context_form_ids = context_forms.get(record.context_model.context_form_group_id)
+            for clinical_table in self.clinical_tables:
+                if context_form_ids is not None and clinical_table.form_model.pk not in context_form_ids:
+                    continue
+                if clinical_table.is_multisection:
+                    for row in extractors[clinical_table.table.name].get_record_rows(record):
+                        writer.add(clinical_table.target, row)
+                else:
+                    datasources = form_datasources[clinical_table.table.name]
+                    writer.add(clinical_table.target,
+                               {ds.column_name: ds.get_record_value(record) for ds in datasources})
+
+        def make_record(patient_id, context_id, data):
+            context_model = contexts[context_id]
+            return ExtractedRecord(patient_id,
+                                   context_model,
+                                   form_groups[context_model.context_form_group_id],
+                                   ClinicalDocument(data),
+                                   progress.get((patient_id, context_id), {}),
+                                   users.get((patient_id, context_id), {}))
+
+        cdes_records = self._patient_records("cdes", context_ids).values_list("django_id", "context_id", "data")
+        total = cdes_records.count()
+        done = 0
+        seen = set()
+        # iterator() uses a server side cursor on postgres
+        for patient_id, context_id, data in cdes_records.iterator(chunk_size=self.chunk_size):
+            done += 1
+            # the first record of a context is the one load_dynamic_data returns
+            context_model = contexts.get(context_id)
+            if context_model is not None and context_model.object_id == patient_id \
+                    and (patient_id, context_id) not in seen:
+                seen.add((patient_id, context_id))
+                extract(make_record(patient_id, context_id, data))
+            if done % self.chunk_size == 0:
+                self._report_progress(done, total)
+
+        # contexts without clinical data still get a row in each form table
+        for context_id, context_model in contexts.items():
+            if (context_model.object_id, context_id) not in seen:
+                extract(make_record(context_model.object_id, context_id, {}))
+
+        writer.flush()
+        self._report_progress(done, total)
+        logger.info("reporting extract for %s: %s records, %s rows in %.1f seconds" % (self.registry_model.code,
+                                                                                       done,
+                                                                                       writer.row_count,
+                                                                                       time.time() - start))
+
+    def _report_progress(self, done, total):
+        logger.info("reporting extract for %s: %s/%s records" % (self.registry_model.code, done, total))
+        if self.progress_callback is not None:
+            self.progress_callback(done, total)
+
+    def _load_contexts(self, patient_ids):
+        from rdrf.models.definition.models import RDRFContext
+        content_type = ContentType.objects.get_for_model(Patient)
+        contexts = RDRFContext.objects.filter(registry=self.registry_model,
+                                              content_type=content_type).select_related("context_form_group") \
+                                                                        .order_by("created_at")
+        return {context_model.pk: context_model for context_model in contexts
+                if context_model.object_id in patient_ids}
+
+    def _load_context_form_ids(self, context_models):
+        # context form group id -> ids of the forms in the group
+        # contexts without a group contain all forms ( see in_context )
+        from rdrf.models.definition.models import ContextFormGroupItem
+        group_ids = set(c.context_form_group_id for c in context_models if c.context_form_group_id)
+        context_forms = {group_id: set() for group_id in group_ids}
+        for group_id, form_id in ContextFormGroupItem.objects.filter(
+                context_form_group__in=group_ids).values_list("context_form_group_id", "registry_form_id"):
+            context_forms[group_id].add(form_id)
+        return context_forms
+
+    def _patient_records(self, collection, context_ids=None):
+        records = ClinicalData.objects.collection(self.registry_model.code, collection).filter(django_model="Patient")
+        if context_ids is not None:
+            records = records.filter(context_id__in=list(context_ids))
+        return records
+
+    def _load_progress(self, form_names, context_ids=None):
+        # (patient id, context id) -> form name -> progress percentage
+        progress = {}
+        records = self._patient_records("progress", context_ids).values_list("django_id", "context_id", "data")
+        for patient_id, context_id, data in records.iterator(chunk_size=self.chunk_size):
+            key = (patient_id, context_id)
+            if key in progress:
+                continue
+            form_progress = {}
+            for form_name in form_names:
+                progress_dict = data.get(form_name + "_form_progress") or {}
+                form_progress[form_name] = progress_dict.get("percentage", 0)
+            progress[key] = form_progress
+        return progress
+
+    def _load_last_users(self, context_ids=None):
+        # (patient id, context id) -> form name -> last user to save the form
+        users = {}
+        snapshots = self._patient_records("history", context_ids).filter(data__record_type="snapshot")
+        # deltas keep the context id at the top level only
+        snapshots = snapshots.annotate(snapshot_context_id=Coalesce(KeyTextTransform("context_id", KeyTransform("record", "data")),
+                                                                    KeyTextTransform("context_id", "data")),
+                                       snapshot_form_name=KeyTextTransform("form_name", "data"),
+                                       snapshot_form_user=KeyTextTransform("form_user", "data"))
+        snapshots = snapshots.values_list("django_id",
+                                          "snapshot_context_id",
+                                          "snapshot_form_name",
+                                          "snapshot_form_user")
+        # ordered by pk so later snapshots win
+        for patient_id, context_id, form_name, form_user in snapshots.iterator(chunk_size=self.chunk_size):
+            if context_id is None or form_name is None or form_user is None:
+                continue
+            users.setdefault((patient_id, int(context_id)), {})[form_name] = form_user
+        return users
+
     def _clean_row(self, row, current_column_names):
         bad_keys = set(row.keys()) - current_column_names
         if bad_keys:
@@ -671,17 +1050,27 @@ class Generator:
     def _get_table_name(self, name):
         return no_space_lower(name)
 
-    def _create_table(self, table_code, columns):
+    def _define_table(self, table_code, columns):
         table_name = self._get_table_name(table_code)
         if "!" in table_name:
             table_name = table_name.replace("!", "")
 
-        self._drop_table(table_name)
-        table = alc.Table(table_name, MetaData(
+        return alc.Table(table_name, MetaData(
             self.reporting_engine), *columns, schema=None)
-        table.create()
-        # these cause failures in migration ...
-        return table
+
+    def _create_staging_table(self, table):
+        staging_name = table.name[:MAX_TABLE_NAME_LENGTH - len(STAGING_SUFFIX)] + STAGING_SUFFIX
+        self._drop_table(staging_name)
+        staging_table = table.tometadata(MetaData(self.reporting_engine), name=staging_name)
+        staging_table.create()
+        return staging_table
+
+    def _swap_table(self, conn, clinical_table):
+        quote = self.reporting_engine.dialect.identifier_preparer.quote
+        conn.execute("DROP TABLE IF EXISTS %s CASCADE" % quote(clinical_table.table.name))
+        conn.execute("ALTER TABLE %s RENAME TO %s" % (quote(clinical_table.target.name),
+                                                      quote(clinical_table.table.name)))
+        clinical_table.target = clinical_table.table
 
     def _drop_table(self, table_name):
         drop_table_sql = "DROP TABLE IF EXISTS %s CASCADE" % table_name
@@ -693,3 +1082,44 @@ class Generator:
                                                             ex))
 
         conn.close()
+
+
+class BatchWriter:
+    """
+    Buffers rows per table and inserts them batch_size at a time through
+    connectable - an engine, or a connection to write inside its transaction
+    """
+
+    def __init__(self, connectable, batch_size):
+        self.connectable = connectable
+        self.batch_size = batch_size
+        self.tables = {}
+        self.buffers = {}
+        self.row_count = 0
+
+    def add(self, table, row):
+        buffer = self.buffers.setdefault(table.name, [])
+        self.tables[table.name] = table
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self._flush_table(table.name)
+
+    def flush(self):
+        for table_name in list(self.buffers.keys()):
+            self._flush_table(table_name)
+
+    def _flush_table(self, table_name):
+        rows = self.buffers.pop(table_name, [])
+        if not rows:
+            return
+        table = self.tables[table_name]
+        column_names = [column.name for column in table.columns]
+        bad_keys = set()
+        for row in rows:
+            bad_keys.update(set(row.keys()) - set(column_names))
+        if bad_keys:
+            logger.warning("BAD COLUMNS IN DATA: %s" % bad_keys)
+        # every row of a multi-row insert must supply the same columns
+        rows = [{column_name: row.get(column_name) for column_name in column_names} for row in rows]
+        self.connectable.execute(table.insert(), rows)
+        self.row_count += len(rows)
@@ -0,0 +1,199 @@
+"""
+Columnar ( Parquet ) export of the clinical data of a registry.
+
+The tables and columns are those the reporting Generator builds: one table
+per form and one per multisection, with the cde columns named as
+generator.Column names them and typed from the cde datatype ( see
+generator.TYPE_MAP ). Each table is written to its own parquet file in row
+groups of batch_size rows, so memory use is bounded as for the reporting
+extract.
+
+It is run by the export_parquet management command and by the "Parquet
+Export" custom action ( rdrf.services.io.actions.parquet_extract ), which
+exports the patients of the user's working groups.
+
+pyarrow is installed with rdrf ( setup.py ); where it is missing, e.g. in a
+partial development environment, the export raises ParquetExportError.
+"""
+from datetime import date, datetime
+import logging
+import os
+import re
+import tempfile
+import shutil
+import zipfile
+
+import sqlalchemy as alc
+
+from rdrf.reports.generator import Generator, BATCH_SIZE
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+class ParquetExportError(Exception):
+    pass
+
+
+def check_available():
+    if pyarrow is None:
+        raise ParquetExportError("The parquet export requires the pyarrow package")
+
+
+def arrow_type(column_type):
+    if isinstance(column_type, alc.Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, alc.Float):
+        return pyarrow.float64()
+    if isinstance(column_type, alc.DateTime):
+        return pyarrow.timestamp("us")
+    if isinstance(column_type, alc.Date):
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for date_format in ("%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(str(value)[:10], date_format).date()
+        except ValueError:
+            pass
+    return None
+
+
+def convert_value(column_type, value):
+    """
+    The reporting value converted to the python type of the column, None if
+    it does not convert
+    """
+    if value is None or value == "":
+        return None
+    try:
+        if isinstance(column_type, alc.Integer):
+            return int(float(value))
+        if isinstance(column_type, alc.Float):
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(column_type, alc.DateTime):
+        return _to_datetime(value)
+    if isinstance(column_type, alc.Date):
+        return _to_date(value)
+    return str(value)
+
+
+def file_name(table_name):
+    return re.sub(r"[^\w.-]", "_", table_name) + ".parquet"
+
+
+class ParquetWriter:
+    """
+    Same interface as generator.BatchWriter: buffers the rows of each table
+    and writes them as a parquet row group every batch_size rows
+    """
+
+    def __init__(self, directory, batch_size=BATCH_SIZE):
+        check_available()
+        self.directory = directory
+        self.batch_size = batch_size
+        self.tables = {}
+        self.schemas = {}
+        self.writers = {}
+        self.buffers = {}
+        self.paths = []
+        self.row_count = 0
+
+    def open(self, tables):
+        # every table gets a file, even if it has no rows
+        for table in tables:
+            self.tables[table.name] = table
+            self.schemas[table.name] = pyarrow.schema([(column.name, arrow_type(column.type))
+                                                       for column in table.columns])
+            path = os.path.join(self.directory, file_name(table.name))
+            self.writers[table.name] = pyarrow.parquet.ParquetWriter(path, self.schemas[table.name])
+            self.paths.append(path)
+
+    def add(self, table, row):
+        buffer = self.buffers.setdefault(table.name, [])
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self._flush_table(table.name)
+
+    def flush(self):
+        for table_name in list(self.buffers.keys()):
+            self._flush_table(table_name)
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def _flush_table(self, table_name):
+        rows = self.buffers.pop(table_name, [])
+        if not rows:
+            return
+        table = self.tables[table_name]
+        arrays = [pyarrow.array([convert_value(column.type, row.get(column.name)) for row in rows],
+                                type=arrow_type(column.type))
+                  for column in table.columns]
+        batch = pyarrow.Table.from_arrays(arrays, schema=self.schemas[table_name])
+        self.writers[table_name].write_table(batch)
+        self.row_count += len(rows)
+
+
+def export_registry(registry_model, directory, batch_size=BATCH_SIZE, progress_callback=None, working_groups=None):
+    """
+    Writes the parquet files of the registry into directory and returns
+    their paths. working_groups restricts the export to their patients
+    """
+    check_available()
+    generator = Generator(registry_model,
+                          db="default",
+                          batch_size=batch_size,
+                          progress_callback=progress_callback,
+                          working_groups=working_groups)
+    writer = ParquetWriter(directory, batch_size)
+    try:
+        generator.export(writer)
+    finally:
+        writer.close()
+    logger.info("parquet export of %s: %s files, %s rows" % (registry_model.code,
+                                                             len(writer.paths),
+                                                             writer.row_count))
+    return writer.paths
+
+
+def export_registry_zip(registry_model, fileobj, batch_size=BATCH_SIZE, progress_callback=None, working_groups=None):
+    """
+    Writes a zip of the parquet files of the registry to fileobj
+    """
+    directory = tempfile.mkdtemp(suffix="parquet")
+    try:
+        paths = export_registry(registry_model, directory, batch_size, progress_callback, working_groups)
+        # parquet files are already compressed
+        with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_STORED) as zf:
+            for path in paths:
+                zf.write(path, os.path.basename(path))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
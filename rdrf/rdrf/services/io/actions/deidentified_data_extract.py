@@ -1,16 +1,21 @@
 from datetime import datetime
+import io
 import json
+import tempfile
 import zipfile
 from zipfile import ZipFile
 import uuid
-from io import BytesIO
 from django.db import connections
-from django.http import HttpResponse
+from django.http import FileResponse
 from django.conf import settings
 
 import logging
 logger = logging.getLogger(__name__)
 
+# rows fetched from the server side cursor at a time: the extract holds at
+# most this many clinical records in memory
+CHUNK_SIZE = 500
+
 
 def security_check(custom_action, user):
     return user.in_registry(custom_action.registry)
@@ -25,13 +30,13 @@ class SQL:
 class PipeLine:
     VERSION = "1.0"
 
-    def __init__(self, custom_action):
+    def __init__(self, custom_action, chunk_size=CHUNK_SIZE):
         self.custom_action = custom_action
+        self.chunk_size = chunk_size
         self.conn_clin = connections['clinical']
         self.conn_demo = connections['default']
-        self.data = []
-        self.sr_data = []
         self.id_map = self._construct_deident_map()
+        self.blacklisted_forms = self._get_blacklisted_forms()
 
     def _raw_sql(self, conn, sql):
         with conn.cursor() as c:
@@ -39,13 +44,31 @@ class PipeLine:
             rows = c.fetchall()
         return rows
 
+    def _iter_sql(self, conn, sql):
+        # named ( server side ) cursor so rows arrive chunk by chunk
+        with conn.chunked_cursor() as c:
+            c.execute(sql)
+            while True:
+                rows = c.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                yield from rows
+
     def _construct_deident_map(self):
         return {row[0]: row[1] for row in self._raw_sql(self.conn_demo, SQL.id_query)}
 
-    def deidentify(self):
-        self.data = [self._deidentify_row(row) for row in
-                     self._raw_sql(self.conn_clin, SQL.clinical_data_query)
-                     if row[0] in self.id_map]
+    def _get_blacklisted_forms(self):
+        if self.custom_action is None:
+            return []
+        return self.custom_action.action_data.get("blacklist", [])
+
+    def rows(self):
+        """
+        The deidentified clinical records, one at a time
+        """
+        for row in self._iter_sql(self.conn_clin, SQL.clinical_data_query):
+            if row[0] in self.id_map:
+                yield self._remove_blacklisted(self._deidentify_row(row))
 
     def _deidentify_row(self, row):
         d = {}
@@ -58,60 +81,79 @@ class PipeLine:
         d["data"] = data
         return d
 
-    def remove_blacklisted(self):
-        action_data = self.custom_action.action_data
-        blacklisted_forms = action_data.get("blacklist", [])
-        if not blacklisted_forms:
-            return
-        for row in self.data:
-            if "data" in row and "forms" in row["data"]:
-                row["data"]["forms"] = [form_dict for form_dict in row["data"]
-                                        ["forms"] if form_dict["name"] not in blacklisted_forms]
+    def _remove_blacklisted(self, row):
+        if self.blacklisted_forms and row["data"] and "forms" in row["data"]:
+            row["data"]["forms"] = [form_dict for form_dict in row["data"]["forms"]
+                                    if form_dict["name"] not in self.blacklisted_forms]
+        return row
 
-    def get_srs(self):
-        def make_dict(row):
-            return {"id": row[0],
-                    "survey_name": row[1],
-                    "updated": row[2],
-                    "channel": row[3],
-                    "state": row[4]}
-
-        self.srs = [make_dict(row) for row in self._raw_sql(self.conn_demo, SQL.sr_query)]
+    def srs(self):
+        for row in self._iter_sql(self.conn_demo, SQL.sr_query):
+            yield {"id": row[0],
+                   "survey_name": row[1],
+                   "updated": row[2],
+                   "channel": row[3],
+                   "state": row[4]}
 
 
 def extract_data(custom_action):
     p = PipeLine(custom_action)
-    p.deidentify()
-    p.remove_blacklisted()
-    p.get_srs()
-    return p.data, p.srs
+    return list(p.rows()), list(p.srs())
+
+
+def _write_array(stream, items):
+    stream.write("[")
+    for i, item in enumerate(items):
+        if i:
+            stream.write(", ")
+        stream.write(json.dumps(item))
+    stream.write("]")
+
+
+def write_extract(fileobj, json_name, manifest, pipeline):
+    """
+    Writes the extract as one json document into a zip, encoding it record by
+    record so that memory use is bounded by the pipeline chunk size
+    """
+    with ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(json_name, 'w', force_zip64=True) as member:
+            stream = io.TextIOWrapper(member, encoding="utf-8")
+            stream.write('{"manifest": %s, "data": ' % json.dumps(manifest))
+            _write_array(stream, pipeline.rows())
+            stream.write(', "srs": ')
+            _write_array(stream, pipeline.srs())
+            stream.write("}")
+            stream.flush()
+            stream.detach()
 
 
 def execute(custom_action, user, create_bytes_io=False):
+    """
+    The zip is written to a temporary file: returns ( zip name, file ) when
+    create_bytes_io is set, a streaming download response otherwise
+    """
     a = datetime.now()
     timestamp = datetime.timestamp(a)
     guid = str(uuid.uuid1())
-    results = extract_data(custom_action)
-    data = {}
-    data["manifest"] = {"site": settings.DEIDENTIFIED_SITE_ID,
-                        "timestamp": timestamp,
-                        "version": PipeLine.VERSION,
-                        "guid": guid}
-    data["data"] = results[0]
-    data["srs"] = results[1]
-    json_data = json.dumps(data)
-    if create_bytes_io:
-        obj = BytesIO()
-    else:
-        obj = HttpResponse(content_type="application/zip")
-
-    zf = ZipFile(obj, 'w', zipfile.ZIP_DEFLATED)
+    manifest = {"site": settings.DEIDENTIFIED_SITE_ID,
+                "timestamp": timestamp,
+                "version": PipeLine.VERSION,
+                "guid": guid}
     name = settings.DEIDENTIFIED_SITE_ID + "_" + a.strftime("%Y%m%d%H%M%S")
     zip_name = name + ".zip"
     json_name = name + ".json"
-    zf.writestr(json_name, json_data)
+
+    obj = tempfile.TemporaryFile()
+    try:
+        write_extract(obj, json_name, manifest, PipeLine(custom_action))
+    except Exception:
+        obj.close()
+        raise
+    obj.seek(0)
+
     if not create_bytes_io:
-        obj['Content-Disposition'] = 'attachment; filename=%s' % zip_name
-        return obj
+        response = FileResponse(obj, content_type="application/zip")
+        response['Content-Disposition'] = 'attachment; filename=%s' % zip_name
+        return response
 
     return zip_name, obj
@@ -0,0 +1,65 @@
+import logging
+import os.path
+import tempfile
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+
+from rdrf.helpers.utils import generate_token
+from rdrf.reports.parquet_export import ParquetExportError, export_registry_zip
+
+logger = logging.getLogger(__name__)
+
+
+def get_working_groups(user, registry_model):
+    """
+    The working groups whose patients the user exports, None for all the
+    patients of the registry
+    """
+    if user.is_superuser:
+        return None
+    return user.working_groups.filter(registry=registry_model)
+
+
+def _task_progress(done, total):
+    from celery import current_task
+    if current_task and current_task.request.id:
+        current_task.update_state(state="PROGRESS", meta={"done": done, "total": total})
+
+
+def execute(custom_action, user, run_async=False):
+    """
+    A zip of the parquet files of the registry: a download response, or
+    the task result dict when run in a celery task ( with an "error" message
+    instead of a file if the export failed )
+    """
+    registry_model = custom_action.registry
+    working_groups = get_working_groups(user, registry_model)
+    filename = "%s_parquet.zip" % registry_model.code
+    if not run_async:
+        output = tempfile.TemporaryFile()
+        try:
+            export_registry_zip(registry_model, output, working_groups=working_groups)
+        except ParquetExportError as ex:
+            output.close()
+            return HttpResponse(str(ex), status=501)
+        output.seek(0)
+        response = FileResponse(output, content_type="application/zip")
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
+    filepath = os.path.join(settings.TASK_FILE_DIRECTORY, generate_token())
+    try:
+        with open(filepath, "wb") as f:
+            export_registry_zip(registry_model, f, progress_callback=_task_progress, working_groups=working_groups)
+    except ParquetExportError as ex:
+        os.remove(filepath)
+        logger.error("parquet export of %s failed: %s" % (registry_model.code, ex))
+        # shown on the polling page ( see TaskInfoView )
+        return {"error": str(ex)}
+    return {"filepath": filepath,
+            "content_type": "application/zip",
+            "username": user.username,
+            "user_id": user.id,
+            "filename": filename,
+            }
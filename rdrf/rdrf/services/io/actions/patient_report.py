@@ -1,15 +1,22 @@
+from django.conf import settings
 from django.http import HttpResponse
 from datetime import datetime
 from datetime import date
+import io
+import multiprocessing
 import pycountry
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.models import RegistryForm
-from rdrf.models.definition.models import Section
-from rdrf.models.definition.models import CommonDataElement
 from rdrf.helpers.utils import format_date
 
 import logging
 logger = logging.getLogger(__name__)
 
+# patients whose clinical data is loaded per query in a batch report
+BATCH_SIZE = 200
+
 
 class ParseException(Exception):
     pass
@@ -108,52 +115,125 @@ def human_value(cde_model, raw_value, is_list=False):
 
 
 @nice
-def retrieve(registry_model, field, patient_model, clinical_data):
-    if FieldSpec.PATH_DELIMITER not in field:
-        # e.g. {{ CDECODE }}
-        for form_model in registry_model.forms:
-            for section_model in form_model.section_models:
-                if not section_model.allow_multiple:
-                    for cde_model in section_model.cde_models:
-                        if cde_model.code == field:
-                            form_value = patient_model.get_form_value(registry_model.code,
-                                                                      form_model.name,
-                                                                      section_model.code,
-                                                                      cde_model.code,
-                                                                      clinical_data=clinical_data)
-                            if cde_model.allow_multiple and type(form_value) is list:
-                                return human_value(cde_model, form_value, is_list=True)
-                            return human_value(cde_model, form_value)
-        return "ERROR"
-
-    form, section, cde = field.split(FieldSpec.PATH_DELIMITER)
-    form_model = RegistryForm.objects.get(registry=registry_model,
-                                          name=form)
-    section_model = Section.objects.get(code=section)
-    cde_model = CommonDataElement.objects.get(code=cde)
-
-    form_value = patient_model.get_form_value(registry_model.code,
-                                              form_model.name,
-                                              section_model.code,
-                                              cde_model.code)
+def retrieve(patient_model, registry_code, field_path, clinical_data):
+    form_name, section_code, cde_model, list_values = field_path
+    form_value = patient_model.get_form_value(registry_code,
+                                              form_name,
+                                              section_code,
+                                              cde_model.code,
+                                              clinical_data=clinical_data)
+    if list_values and cde_model.allow_multiple and type(form_value) is list:
+        return human_value(cde_model, form_value, is_list=True)
     return human_value(cde_model, form_value)
 
 
+def markdown_to_pdf(markdown_content, dest):
+    import markdown
+    from xhtml2pdf import pisa
+    html_content = markdown.markdown(markdown_content, extensions=['tables'])
+    _ = pisa.CreatePDF(html_content, dest=dest)
+    return dest
+
+
+def pdf_content(markdown_content):
+    # run in the report processes so it must not touch the database
+    return markdown_to_pdf(markdown_content, io.BytesIO()).getvalue()
+
+
 class Report:
     def __init__(self, content, content_type):
         self.content = content
         self.content_type = content_type
 
 
+class ReportTemplate:
+    """
+    A report spec ( a django template producing markdown ) parsed once, its
+    variables resolved to the demographics fields or cdes they show
+    """
+
+    def __init__(self, registry_model, report_spec):
+        from django.template import Template
+        self.registry_model = registry_model
+        self.template = Template(report_spec)
+        self.variables = [node.filter_expression.token for node in self.template.nodelist
+                          if node.__class__.__name__ == 'VariableNode']
+        # variable -> ( form name, section code, cde model, list values ), None for demographics
+        self.field_paths = {variable: self._resolve(variable) for variable in self.variables}
+
+    def _resolve(self, variable):
+        if variable in DEMOGRAPHICS_VARIABLES:
+            return None
+        if FieldSpec.PATH_DELIMITER not in variable:
+            # e.g. {{ CDECODE }}
+            for form_model in self.registry_model.forms:
+                for section_model in form_model.section_models:
+                    if not section_model.allow_multiple:
+                        for cde_model in section_model.cde_models:
+                            if cde_model.code == variable:
+                                return form_model.name, section_model.code, cde_model, True
+            return "ERROR"
+
+        form, section, cde = variable.split(FieldSpec.PATH_DELIMITER)
+        form_model = RegistryForm.objects.get(registry=self.registry_model,
+                                              name=form)
+        section_model = metadata_cache.load_section(section)
+        cde_model = metadata_cache.load_cde(cde)
+        return form_model.name, section_model.code, cde_model, False
+
+    def _get_variable_value(self, variable, patient_model, clinical_data):
+        field_path = self.field_paths[variable]
+        if field_path is None:
+            value = getattr(patient_model, variable)
+            if isinstance(value, datetime) or isinstance(value, date):
+                value = format_date(value)
+            if variable == "country_of_birth":
+                value = get_country(value)
+            return value
+        if field_path == "ERROR":
+            return field_path
+        return retrieve(patient_model, self.registry_model.code, field_path, clinical_data)
+
+    def get_markdown(self, patient_model, clinical_data):
+        from django.template import Context
+        context = {}
+        for variable in self.variables:
+            context[variable] = self._get_variable_value(variable, patient_model, clinical_data)
+        return self.template.render(Context(context))
+
+
+def load_clinical_data(registry_model, patient_models):
+    """
+    patient id -> flattened cdes record of the patient's default context,
+    for a batch of patients in two queries
+    """
+    from rdrf.db.contexts_api import get_default_contexts
+    from rdrf.db.dynamic_data import build_form_data
+    from rdrf.models.definition.models import ClinicalData
+    contexts = get_default_contexts(registry_model, [patient_model.pk for patient_model in patient_models])
+    records = {}
+    if contexts:
+        cdes = ClinicalData.objects.collection(registry_model.code, "cdes").filter(
+            django_model="Patient", context_id__in=[context_model.pk for context_model in contexts.values()])
+        # ordered by pk: the first record of a context is the one the forms show
+        for patient_id, data in cdes.values_list("django_id", "data"):
+            if patient_id not in records:
+                records[patient_id] = build_form_data(data)
+    # patients with a default context but no data yet get an empty record
+    return {patient_id: records.get(patient_id, {}) for patient_id in contexts}
+
+
 class ReportParser:
-    def __init__(self, registry_model, report_name, report_spec, user, patient_model):
+    def __init__(self, registry_model, report_name, report_spec, user, patient_model, template=None,
+                 clinical_data=None):
         self.registry_model = registry_model
         self.report_name = report_name
         self.report_spec = report_spec  # a django template that will create the markdown
+        self.template = template or ReportTemplate(registry_model, report_spec)
         self.user = user
         self.patient_model = patient_model
         self.data = {}
-        self.clinical_data = self._load()
+        self.clinical_data = self._load() if clinical_data is None else clinical_data
 
     @property
     def filename(self):
@@ -162,62 +242,131 @@ class ReportParser:
                                  self.patient_model.pk)
 
     def _load(self):
-        if not self.registry_model.has_feature("contexts"):
-            return self.patient_model.get_dynamic_data(self.registry_model)
-        else:
-            for context_model in self.patient_model.context_models:
-                if context_model.context_form_group:
-                    if context_model.context_form_group.is_default:
-                        return self.patient_model.get_dynamic_data(self.registry_model,
-                                                                   context_id=context_model.id,
-                                                                   flattened=True)
-        raise Exception("can't load clinical data")
+        records = load_clinical_data(self.registry_model, [self.patient_model])
+        if self.patient_model.pk not in records:
+            raise Exception("can't load clinical data")
+        return records[self.patient_model.pk]
 
     def generate_report(self):
-        import markdown
-        from xhtml2pdf import pisa
         markdown_content = self.get_markdown()
-        html_content = markdown.markdown(markdown_content, extensions=['tables'])
         response = HttpResponse(content_type="application/pdf")
         response['Content-Disposition'] = 'attachment; filename="%s"' % self.filename
-        _ = pisa.CreatePDF(html_content, dest=response)
-        return response
-
-    def _get_variable_value(self, variable):
-        value = "TODO"
-        if variable in DEMOGRAPHICS_VARIABLES:
-            value = getattr(self.patient_model, variable)
-            if isinstance(value, datetime) or isinstance(value, date):
-                value = format_date(value)
-            if variable == "country_of_birth":
-                value = get_country(value)
-        else:
-            value = retrieve(self.registry_model,
-                             variable,
-                             self.patient_model,
-                             self.clinical_data)
-        return value
+        return markdown_to_pdf(markdown_content, response)
 
     def get_markdown(self):
-        from django.template import Context, Template
-        template_text = self.report_spec
-        markdown_template = Template(template_text)
-        variables = self._get_variable_names(markdown_template)
-        context = {}
-        for variable in variables:
-            value = self._get_variable_value(variable)
-            context[variable] = value
-        template_context = Context(context)
-        markdown = markdown_template.render(template_context)
-        return markdown
+        return self.template.get_markdown(self.patient_model, self.clinical_data)
+
 
-    def _get_variable_names(self, template_object):
-        vars = [node.filter_expression.token for node in template_object.nodelist
-                if node.__class__.__name__ == 'VariableNode']
-        return vars
+class BatchReport:
+    """
+    The report of every patient of a cohort as one zip of pdfs. The
+    template is resolved once, the clinical data loaded BATCH_SIZE patients
+    at a time and the pdfs rendered in settings.PATIENT_REPORT_PROCESSES
+    processes.
+    """
+
+    def __init__(self, registry_model, report_name, report_spec, user, patients, progress=None):
+        self.registry_model = registry_model
+        self.report_name = report_name
+        self.template = ReportTemplate(registry_model, report_spec)
+        self.user = user
+        self.patients = patients
+        # called with ( reports done, total )
+        self.progress = progress
+
+    def write(self, stream):
+        patient_models = list(self.patients)
+        total = len(patient_models)
+        done = 0
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zip_file, self._executor() as executor:
+            for start in range(0, total, BATCH_SIZE):
+                batch = patient_models[start:start + BATCH_SIZE]
+                markdowns = self._get_markdowns(batch)
+                mapper = executor.map if executor else map
+                for (filename, _), content in zip(markdowns, mapper(pdf_content, [m for _, m in markdowns])):
+                    zip_file.writestr(filename, content)
+                done += len(batch)
+                if self.progress:
+                    self.progress(done, total)
+        return stream
+
+    def _get_markdowns(self, patient_models):
+        records = load_clinical_data(self.registry_model, patient_models)
+        markdowns = []
+        for patient_model in patient_models:
+            if patient_model.pk not in records:
+                logger.warning("no clinical data for patient %s in report %s" % (patient_model.pk, self.report_name))
+                continue
+            parser = ReportParser(self.registry_model, self.report_name, None, self.user, patient_model,
+                                  template=self.template, clinical_data=records[patient_model.pk])
+            markdowns.append((parser.filename, parser.get_markdown()))
+        return markdowns
+
+    def _executor(self):
+        processes = getattr(settings, "PATIENT_REPORT_PROCESSES", 1)
+        # a daemonic process ( eg a prefork celery worker ) can't have children
+        if processes <= 1 or multiprocessing.current_process().daemon:
+            return _NoExecutor()
+        return ProcessPoolExecutor(max_workers=processes)
+
+
+class _NoExecutor:
+    # renders in this process
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+def get_cohort(registry_model, user, runtime_spec):
+    """
+    The patients of the registry the user may see, restricted to the
+    "working_groups" ( names ) of the runtime spec if given
+    """
+    from registry.patients.models import Patient
+    patients = Patient.objects.filter(rdrf_registry=registry_model)
+    if not user.is_superuser:
+        patients = patients.filter(working_groups__in=user.working_groups.all())
+    working_group_names = (runtime_spec or {}).get("working_groups")
+    if working_group_names:
+        patients = patients.filter(working_groups__name__in=working_group_names)
+    return patients.distinct().order_by("pk")
+
+
+def _task_progress(done, total):
+    from celery import current_task
+    if current_task and current_task.request.id:
+        current_task.update_state(state="PROGRESS", meta={"done": done, "total": total})
+
+
+def execute_batch(registry_model, report_name, report_spec, user, run_async=False, runtime_spec={}):
+    patients = get_cohort(registry_model, user, runtime_spec)
+    filename = "%s-%s.zip" % (registry_model.code, report_name)
+    if not run_async:
+        response = HttpResponse(content_type="application/zip")
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return BatchReport(registry_model, report_name, report_spec, user, patients).write(response)
+
+    import os.path
+    from rdrf.helpers.utils import generate_token
+    filepath = os.path.join(settings.TASK_FILE_DIRECTORY, generate_token())
+    with open(filepath, "wb") as f:
+        BatchReport(registry_model, report_name, report_spec, user, patients, progress=_task_progress).write(f)
+    return {"filepath": filepath,
+            "content_type": "application/zip",
+            "username": user.username,
+            "user_id": user.id,
+            "filename": filename,
+            }
 
 
 def execute(registry_model, report_name, report_spec, user, patient_model, run_async=False, runtime_spec={}):
+    if patient_model is None:
+        # a universal action reports on the user's cohort
+        return execute_batch(registry_model, report_name, report_spec, user, run_async=run_async,
+                             runtime_spec=runtime_spec)
     parser = ReportParser(registry_model, report_name, report_spec, user, patient_model)
     report = parser.generate_report()
     if report:
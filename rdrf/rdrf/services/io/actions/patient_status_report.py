@@ -1,14 +1,17 @@
 import logging
 import csv
 import json
+from collections import defaultdict
 from time import time
 from datetime import date
-from django.http import HttpResponse
+from django.contrib.contenttypes.models import ContentType
+from django.http import StreamingHttpResponse
+from rdrf.helpers import metadata_cache
+from rdrf.db.cde_index import CDEQuery
 from rdrf.models.definition.models import RegistryForm
-from rdrf.models.definition.models import Section
-from rdrf.models.definition.models import CommonDataElement
 from rdrf.models.definition.models import ContextFormGroup
 from rdrf.models.definition.models import ClinicalData
+from rdrf.models.definition.models import RDRFContext
 from rdrf.helpers.utils import cde_completed
 from rdrf.helpers.utils import format_date
 from rdrf.helpers.utils import parse_iso_date
@@ -18,6 +21,9 @@ from registry.patients.models import ConsentValue
 
 logger = logging.getLogger(__name__)
 
+# patients whose contexts, clinical data and consents are loaded per query
+BATCH_SIZE = 500
+
 
 class Dates:
     FAR_FUTURE = date(2100, 1, 1)
@@ -69,13 +75,21 @@ def get_date(datetime_string):
     return dt.date()
 
 
-def get_timestamp(clinical_data):
-    if not clinical_data:
-        return None
-    if not clinical_data.data:
+def get_timestamp(data):
+    if not data:
         return None
 
-    return parse_iso_datetime(clinical_data.data.get("timestamp", None))
+    return parse_iso_datetime(data.get("timestamp", None))
+
+
+class Echo:
+    """
+    A file-like object whose writes return the line, for streaming a csv
+    writer into a response
+    """
+
+    def write(self, value):
+        return value
 
 
 class ReportGenerator:
@@ -108,6 +122,14 @@ class ReportGenerator:
         self.has_valid_filter = False
         self._setup_inputs()
         self._set_formats()
+        # models of the report columns, resolved once ( see _preload for the patient data )
+        self._cde_columns = {}
+        self._form_cdes = {}
+        self._consent_questions = None
+        self._context_form_groups = {}
+        self._contexts = {}
+        self._records = {}
+        self._consent_values = {}
 
     def _setup_spec(self):
         if self.custom_action.include_all:
@@ -174,6 +196,12 @@ class ReportGenerator:
         writer.writerows(self.report)
         return stream
 
+    def streaming_response(self):
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse((writer.writerow(row) for row in self.report), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="{self.report_name}.csv"'
+        return response
+
     @property
     def task_result(self):
         import os.path
@@ -196,7 +224,7 @@ class ReportGenerator:
         # get the fixed context associated with the context
         # form group specified in the report spec.
         # there should only be one for each patient
-        context_models = patient_model.context_models
+        context_models = self._contexts.get(patient_model.pk, [])
         return self._get_fixed_context(context_models)
 
     def _get_fixed_context(self, context_models):
@@ -218,12 +246,27 @@ class ReportGenerator:
 
     def generate_report(self):
         self._security_check()
-        return self._run_report()
+        # the rows are produced as the report is written
+        self.report = self._run_report()
 
     def _run_report(self):
-        rows = [self._get_header()]
-        for patient_model in self._get_patients():
+        yield self._get_header()
+        patients, filter_patients = self._get_patients()
+        batch = []
+        for patient_model in patients.iterator(chunk_size=BATCH_SIZE):
+            batch.append(patient_model)
+            if len(batch) == BATCH_SIZE:
+                yield from self._run_batch(batch, filter_patients)
+                batch = []
+        if batch:
+            yield from self._run_batch(batch, filter_patients)
+
+    def _run_batch(self, patient_models, filter_patients):
+        self._preload(patient_models)
+        for patient_model in patient_models:
             try:
+                if filter_patients and not self._include_patient(patient_model):
+                    continue
                 # the context needs to be determined by the report spec
                 # as it contains the context_form_group name
                 context_model = self._get_context(patient_model)
@@ -235,10 +278,52 @@ class ReportGenerator:
                     column_value = self._get_column_value(patient_model, data, column)
                     row.append(column_value)
                 if any(row):
-                    rows.append(row)
+                    yield row
             except Exception as ex:
                 logger.error("%s report error pid %s: %s" % (self.report_name, patient_model.pk, ex))
-        self.report = rows
+
+    def _preload(self, patient_models):
+        """
+        Loads the contexts, clinical data and consents of a batch of patients
+        in a fixed number of queries
+        """
+        patient_ids = [patient_model.pk for patient_model in patient_models]
+        self._contexts = defaultdict(list)
+        for context_model in RDRFContext.objects.filter(registry=self.registry_model,
+                                                        content_type=ContentType.objects.get_for_model(Patient),
+                                                        object_id__in=patient_ids) \
+                                                .select_related("context_form_group") \
+                                                .order_by("created_at"):
+            self._contexts[context_model.object_id].append(context_model)
+
+        self._records = defaultdict(list)
+        records = ClinicalData.objects.filter(collection="cdes",
+                                              registry_code=self.registry_model.code,
+                                              django_model="Patient",
+                                              django_id__in=patient_ids).order_by("pk")
+        for context_id, data in records.values_list("context_id", "data"):
+            self._records[context_id].append(data)
+
+        self._consent_values = {}
+        consent_questions = [question for question in self._get_consent_questions().values()]
+        if consent_questions:
+            for consent_value in ConsentValue.objects.filter(patient__in=patient_ids,
+                                                             consent_question__in=consent_questions):
+                self._consent_values[(consent_value.patient_id, consent_value.consent_question_id)] = consent_value
+
+    def _get_consent_questions(self):
+        # ( consent section code, consent question code ) -> question of the consent columns
+        if self._consent_questions is None:
+            codes = set(tuple(column["name"].split("/")) for column in self.report_spec["columns"]
+                        if column["type"] in (ColumnType.CONSENT, ColumnType.CONSENT_DATE))
+            self._consent_questions = {}
+            if codes:
+                for consent_section in self.registry_model.consent_sections.all().prefetch_related("questions"):
+                    for consent_question in consent_section.questions.all():
+                        key = (consent_section.code, consent_question.code)
+                        if key in codes and key not in self._consent_questions:
+                            self._consent_questions[key] = consent_question
+        return self._consent_questions
 
     def _get_header(self):
         def header(col):
@@ -289,27 +374,23 @@ class ReportGenerator:
                            patient_model,
                            context_form_group_name,
                            form_name):
-        from rdrf.models.definition.models import ContextFormGroup
-        cfg = ContextFormGroup.objects.get(registry=self.registry_model,
-                                           name=context_form_group_name)
+        if context_form_group_name not in self._context_form_groups:
+            self._context_form_groups[context_form_group_name] = ContextFormGroup.objects.get(
+                registry=self.registry_model, name=context_form_group_name)
+        cfg = self._context_form_groups[context_form_group_name]
         # find the last/latest context containing the form
-        context_models = [c for c in patient_model.context_models
-                          if c.registry.pk == self.registry_model.pk and c.context_form_group and c.context_form_group.pk == cfg.pk]
+        context_models = [c for c in self._contexts.get(patient_model.pk, [])
+                          if c.context_form_group and c.context_form_group.pk == cfg.pk]
         if not context_models:
             return ""
         latest_date = None
         for context_model in context_models:
-            # get the associated clinical data and check the timestamp
-            try:
-                clinical_data = ClinicalData.objects.get(context_id=context_model.pk,
-                                                         django_model="Patient",
-                                                         collection="cdes",
-                                                         django_id=patient_model.pk)
-                timestamp = get_timestamp(clinical_data)
-                if latest_date is None or timestamp > latest_date:
+            # the associated clinical data and its timestamp
+            records = self._records.get(context_model.pk)
+            if records:
+                timestamp = get_timestamp(records[0])
+                if timestamp is not None and (latest_date is None or timestamp > latest_date):
                     latest_date = timestamp
-            except ClinicalData.DoesNotExist:
-                pass
         if latest_date is None:
             return ""
         return format_date(latest_date)
@@ -319,27 +400,21 @@ class ReportGenerator:
                      consent_section_code,
                      consent_code,
                      get_date=False):
-        for consent_section in self.registry_model.consent_sections.all():
-            if consent_section.code == consent_section_code:
-                for consent_question in consent_section.questions.all():
-                    if consent_question.code == consent_code:
-                        try:
-                            consent_value = ConsentValue.objects.get(patient=patient_model,
-                                                                     consent_question=consent_question)
-                            if get_date:
-                                first_save = consent_value.first_save
-                                last_update = consent_value.last_update
-                                if not last_update:
-                                    return format_date(first_save)
-                                return format_date(last_update)
-                            return "True" if consent_value else "False"
-                        except ConsentValue.DoesNotExist:
-                            if get_date:
-                                return ""
-                            return "False"
+        consent_question = self._get_consent_questions().get((consent_section_code, consent_code))
+        consent_value = None
+        if consent_question is not None:
+            consent_value = self._consent_values.get((patient_model.pk, consent_question.pk))
+        if consent_value is None:
+            if get_date:
+                return ""
+            return "False"
         if get_date:
-            return ""
-        return "False"
+            first_save = consent_value.first_save
+            last_update = consent_value.last_update
+            if not last_update:
+                return format_date(first_save)
+            return format_date(last_update)
+        return "True"
 
     def get_formatted_date(self, value, date_format="%d-%m-%Y"):
         """
@@ -347,15 +422,26 @@ class ReportGenerator:
         """
         return value.strftime(date_format)
 
+    def _get_cde_column(self, cde_path):
+        if cde_path not in self._cde_columns:
+            if "/" in cde_path:
+                form_name, section_code, cde_code = cde_path.split("/")
+                form_model = self._get_form(form_name)
+                section_model = metadata_cache.load_section(section_code)
+                cde_model = metadata_cache.load_cde(cde_code)
+                self._cde_columns[cde_path] = form_model, section_model, cde_model
+            else:
+                self._cde_columns[cde_path] = self._find_cde(cde_path)
+        return self._cde_columns[cde_path]
+
+    def _get_form(self, form_name):
+        form_model = metadata_cache.get_form(self.registry_model, form_name)
+        if form_model is None:
+            raise RegistryForm.DoesNotExist("Form %s does not exist" % form_name)
+        return form_model
+
     def _get_cde(self, patient_model, cde_path, data):
-        if "/" in cde_path:
-            form_name, section_code, cde_code = cde_path.split("/")
-            form_model = RegistryForm.objects.get(name=form_name,
-                                                  registry=self.registry_model)
-            section_model = Section.objects.get(code=section_code)
-            cde_model = CommonDataElement.objects.get(code=cde_code)
-        else:
-            form_model, section_model, cde_model = self._find_cde(cde_path)
+        form_model, section_model, cde_model = self._get_cde_column(cde_path)
 
         context_id = data["context_id"]
         raw_value = patient_model.get_form_value(self.registry_model.code,
@@ -398,53 +484,63 @@ class ReportGenerator:
             return transform(raw_value)
 
     def _load_patient_data(self, patient_model, context_id):
-        return patient_model.get_dynamic_data(self.registry_model,
-                                              context_id=context_id)
+        # the first record of a context is the one the forms show
+        records = self._records.get(context_id)
+        return records[0] if records else None
+
+    def _get_form_cdes(self, form_name):
+        # form model and ( section model, cde model ) pairs of its non multisections
+        if form_name not in self._form_cdes:
+            form_model = self._get_form(form_name)
+            self._form_cdes[form_name] = form_model, [(section_model, cde_model)
+                                                      for section_model in form_model.section_models
+                                                      if not section_model.allow_multiple
+                                                      for cde_model in section_model.cde_models]
+        return self._form_cdes[form_name]
 
     def _completed(self, patient_model, form_name, data, percentage=False):
-        form_model = RegistryForm.objects.get(name=form_name,
-                                              registry=self.registry_model)
+        form_model, form_cdes = self._get_form_cdes(form_name)
         if not percentage:
-            for section_model in form_model.section_models:
-                if not section_model.allow_multiple:
-                    for cde_model in section_model.cde_models:
-                        if not cde_completed(self.registry_model,
-                                             form_model,
-                                             section_model,
-                                             cde_model,
-                                             patient_model,
-                                             data):
-                            return False
-            return True
-        # percentage
-        num_cdes = 0.0
-        num_completed = 0.0
-        for section_model in form_model.section_models:
-            if not section_model.allow_multiple:
-                for cde_model in section_model.cde_models:
-                    num_cdes += 1.0
-                    if cde_completed(self.registry_model,
+            for section_model, cde_model in form_cdes:
+                if not cde_completed(self.registry_model,
                                      form_model,
                                      section_model,
                                      cde_model,
                                      patient_model,
                                      data):
-                        num_completed += 1.0
+                    return False
+            return True
+        # percentage
+        num_cdes = 0.0
+        num_completed = 0.0
+        for section_model, cde_model in form_cdes:
+            num_cdes += 1.0
+            if cde_completed(self.registry_model,
+                             form_model,
+                             section_model,
+                             cde_model,
+                             patient_model,
+                             data):
+                num_completed += 1.0
         value = 100.0 * (num_completed / num_cdes)
         return round(value, 0)
 
     def _get_patients(self):
+        """
+        The patients queryset and whether the date filter is still to be
+        applied to them ( from the preloaded data, see _include_patient )
+        """
         user_working_groups = self.user.working_groups.all()
+        patients = Patient.objects.filter(rdrf_registry__code__in=[self.registry_model.code],
+                                          working_groups__in=user_working_groups).order_by("pk")
         if not self.has_filter or not self.has_valid_filter:
-            return Patient.objects.filter(rdrf_registry__code__in=[self.registry_model.code],
-                                          working_groups__in=user_working_groups)
-        else:
-            def patient_iterator():
-                for patient_model in Patient.objects.filter(rdrf_registry__code__in=[self.registry_model.code],
-                                                            working_groups__in=user_working_groups):
-                    if self._include_patient(patient_model):
-                        yield patient_model
-            return patient_iterator()
+            return patients, False
+        filter_key = (self.filter_form.name, self.filter_section.code, self.filter_cde.code)
+        if CDEQuery.is_indexed(self.registry_model, filter_key):
+            query = CDEQuery(self.registry_model).filter(filter_key, "gte", self.start_value) \
+                                                 .filter(filter_key, "lte", self.end_value)
+            return query.filter_patients(patients), False
+        return patients, True
 
     def _include_patient(self, patient_model):
         filter_value = self._get_filter_value(patient_model)
@@ -453,7 +549,11 @@ class ReportGenerator:
         return filter_value >= self.start_value and filter_value <= self.end_value
 
     def _get_filter_value(self, patient_model):
-        cds = patient_model.get_clinical_data_for_form_group(self.context_form_group.name)
+        # the clinical data of the patient's contexts in the report context form group
+        cds = [data
+               for context_model in self._contexts.get(patient_model.pk, [])
+               if context_model.context_form_group and context_model.context_form_group.name == self.context_form_group.name
+               for data in self._records.get(context_model.pk, [])]
         if cds:
             if len(cds) > 1:
                 raise ValueError("There should only be one clinical data object")
@@ -463,10 +563,10 @@ class ReportGenerator:
             # No data saved at all for any of forms in this form group
             return None
 
-    def _get_filter_field_value(self, clinical_data):
+    def _get_filter_field_value(self, data):
         assert self.filter_form is not None, "Filter form is None"
-        if clinical_data.data:
-            forms = clinical_data.data["forms"]
+        if data:
+            forms = data["forms"]
             for form_dict in forms:
                 if form_dict["name"] == self.filter_form.name:
                     for section_dict in form_dict["sections"]:
@@ -488,8 +588,6 @@ def execute(custom_action, registry_model, report_name, report_spec, user, input
     parser = ReportGenerator(custom_action, registry_model, report_name, report_spec, user, input_data, run_async)
     parser.generate_report()
     if not run_async:
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="{report_name}.csv"'
-        return parser.dump_csv(response)
+        return parser.streaming_response()
     else:
         return parser.task_result
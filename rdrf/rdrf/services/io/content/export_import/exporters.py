@@ -1,13 +1,18 @@
 from collections import defaultdict, OrderedDict
+import hashlib
+import itertools
+import json
 import os
 from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.apps import apps
 
 from .utils import DelegateMixin
 from .utils import app_schema_version
-from .utils import file_checksum
 from .utils import maybe_indent
-from functools import reduce
+
+# objects serialised ( and queried ) at a time
+CHUNK_SIZE = 1000
 
 
 class DataGroupExporter(DelegateMixin):
@@ -92,7 +97,10 @@ class ModelExporter(object):
         self.meta_collector = ModelMetaInfo(self, maybe_indent(logger))
         self.exporter_context = {}
         self.export_finished = False
-        self.format = 'json'
+        # JSON Lines: one serialised object per line
+        self.format = 'jsonl'
+        self.object_count = 0
+        self.checksum = None
 
     @property
     def queryset(self):
@@ -111,15 +119,31 @@ class ModelExporter(object):
         self.workdir = self.exporter_context['workdir']
         self.filename = '%s.%s' % (self.model._meta.db_table, self.format)
 
-        with open(self.full_filename, 'w') as out:
-            serializers.serialize(self.format, self.queryset,
-                                  use_natural_primary_keys=True,
-                                  use_natural_foreign_keys=True,
-                                  indent=2,
-                                  stream=out)
+        # the count and checksum are taken as the file is written
+        md5 = hashlib.md5()
+        with open(self.full_filename, 'wb') as out:
+            for chunk in self.chunks():
+                for obj in serializers.serialize('python', chunk,
+                                                 use_natural_primary_keys=True,
+                                                 use_natural_foreign_keys=True):
+                    line = (json.dumps(obj, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n').encode('utf-8')
+                    md5.update(line)
+                    out.write(line)
+                    self.object_count += 1
+        self.checksum = md5.hexdigest()
         self.export_finished = True
         return True
 
+    def chunks(self):
+        queryset = self.queryset
+        # some exporters yield their objects rather than returning a queryset
+        objects = queryset.iterator(chunk_size=CHUNK_SIZE) if hasattr(queryset, 'iterator') else iter(queryset)
+        while True:
+            chunk = list(itertools.islice(objects, CHUNK_SIZE))
+            if not chunk:
+                return
+            yield chunk
+
     def get_meta_info(self):
         if not self.export_finished:
             raise ValueError(
@@ -137,13 +161,11 @@ class BaseMetaInfo(DelegateMixin):
     def collect(self):
         return {
             'file_name': self.filename,
-            'object_count': self.count_objects_in_file(),
-            'md5_checksum': file_checksum(self.full_filename),
+            'format': self.format,
+            'object_count': self.object_count,
+            'md5_checksum': self.checksum,
         }
 
-    def count_objects_in_file(self):
-        raise NotImplementedError()
-
 
 class ModelMetaInfo(BaseMetaInfo):
 
@@ -155,14 +177,6 @@ class ModelMetaInfo(BaseMetaInfo):
         d.update(BaseMetaInfo.collect(self))
         return d
 
-    def count_objects_in_file(self):
-        def count_generator_items(gen):
-            return reduce(lambda count, _: count + 1, gen, 0)
-
-        with open(self.full_filename) as data:
-            count = count_generator_items(serializers.deserialize(self.format, data))
-            return count
-
 
 def omit_empty(xs):
     return [x for x in xs if x[1]]
@@ -1,8 +1,13 @@
 from functools import wraps
+import hashlib
+import itertools
+import json
 import logging
 import os
 from django.core import serializers
 from django.apps import apps
+from django.db import router, transaction
+from django.db.models import signals
 
 from .utils import file_checksum, maybe_indent
 from .exceptions import ImportError
@@ -10,6 +15,9 @@ from .exceptions import ImportError
 
 logger = logging.getLogger(__name__)
 
+# objects inserted per bulk_create
+BATCH_SIZE = 1000
+
 
 def allow_if_forced(checkfn):
     @wraps(checkfn)
@@ -74,8 +82,7 @@ class DataGroupImporter(object):
 class ModelImporter(object):
 
     @allow_if_forced
-    def check_checksum(self, file_name, expected_checksum):
-        actual_checksum = file_checksum(file_name)
+    def check_checksum(self, file_name, expected_checksum, actual_checksum):
         if actual_checksum != expected_checksum:
             raise ImportError("Invalid checksum on file '%s'. Actual: '%s', expected: '%s'" %
                               (file_name, actual_checksum, expected_checksum))
@@ -89,7 +96,7 @@ class ModelImporter(object):
     @allow_if_forced
     def check_no_data_in_table(self, model_name):
         model = apps.get_model(model_name)
-        if model.objects.count() > 0:
+        if model.objects.exists():
             raise ImportError(
                 "Refusing to import over existing data for model '%s'." %
                 model_name)
@@ -111,24 +118,83 @@ class ModelImporter(object):
         checksum = get_meta_value(model_meta, 'md5_checksum')
         object_count = get_meta_value(model_meta, 'object_count')
 
-        self.check_checksum(file_name, checksum)
-
         self.check_no_data_in_table(model_name)
 
-        with open(file_name) as f:
-            if simulate:
-                # We can't deserialize objects when simulating, because FK
-                # references to models we only simulated to save will fail.
-                # We could model.save() all models in a transaction that we
-                # we roll back, but that feels too dangerous
-                f.read()
-                return
-
-            actual_object_count = 0
-            for model in serializers.deserialize('json', f.read()):
-                model.save()
-                actual_object_count += 1
-            self.check_object_count(model_name, object_count, actual_object_count)
+        if simulate:
+            # We can't deserialize objects when simulating, because FK
+            # references to models we only simulated to save will fail.
+            # We could model.save() all models in a transaction that we
+            # we roll back, but that feels too dangerous
+            self.check_checksum(file_name, checksum, file_checksum(file_name))
+            return
+
+        with open(file_name, 'rb') as f:
+            # the checksum is taken as the lines are read
+            md5 = hashlib.md5()
+            if model_meta.get('format', 'json') == 'jsonl':
+                objects = serializers.deserialize('python', (json.loads(line) for line in read_lines(f, md5)))
+            else:
+                # exports before JSON Lines are a single json list
+                content = f.read()
+                md5.update(content)
+                objects = serializers.deserialize('json', content.decode('utf-8'))
+
+            model = apps.get_model(model_name)
+            # the model may be in another database than the import transaction:
+            # a bad checksum or count rolls back its rows too
+            with transaction.atomic(using=router.db_for_write(model)):
+                actual_object_count = 0
+                while True:
+                    batch = list(itertools.islice(objects, BATCH_SIZE))
+                    if not batch:
+                        break
+                    self.save_batch(model, batch)
+                    actual_object_count += len(batch)
+                self.check_checksum(file_name, checksum, md5.hexdigest())
+                self.check_object_count(model_name, object_count, actual_object_count)
+
+    def save_batch(self, model, deserialized_objects):
+        """
+        Inserts the deserialised objects with one bulk_create, sending the
+        signals a raw save would
+        """
+        if model._meta.parents:
+            # bulk_create can't insert multi-table inherited models
+            for deserialized_object in deserialized_objects:
+                deserialized_object.save()
+            return
+
+        using = router.db_for_write(model)
+        instances = [deserialized_object.object for deserialized_object in deserialized_objects]
+        send_signals = signals.pre_save.has_listeners(model) or signals.post_save.has_listeners(model)
+        if send_signals:
+            for instance in instances:
+                signals.pre_save.send(sender=model, instance=instance, raw=True, using=using, update_fields=None)
+        timestamp_fields = [field for field in model._meta.concrete_fields
+                            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+        exported = [[getattr(instance, field.attname) for field in timestamp_fields] for instance in instances]
+        model.objects.using(using).bulk_create(instances)
+        if timestamp_fields:
+            # bulk_create sets auto_now / auto_now_add fields to the current
+            # time; bulk_update ( a filter(pk__in=..).update(..) ) puts the
+            # exported values back
+            for instance, values in zip(instances, exported):
+                for field, value in zip(timestamp_fields, values):
+                    setattr(instance, field.attname, value)
+            model.objects.using(using).bulk_update(instances, [field.name for field in timestamp_fields])
+        for deserialized_object in deserialized_objects:
+            for accessor_name, object_list in (deserialized_object.m2m_data or {}).items():
+                getattr(deserialized_object.object, accessor_name).set(object_list)
+        if send_signals:
+            for instance in instances:
+                signals.post_save.send(sender=model, instance=instance, created=True, update_fields=None, raw=True,
+                                       using=using)
+
+
+def read_lines(f, md5):
+    for line in f:
+        md5.update(line)
+        yield line
 
 
 def get_meta_value(meta, key, path=None):
@@ -1,4 +1,7 @@
 import logging
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
 from rdrf.models.definition.models import Registry
 from rdrf.models.definition.models import RegistryForm
 from rdrf.models.definition.models import Section
@@ -14,11 +17,13 @@ from registry.groups.models import WorkingGroup
 from explorer.models import Query
 
 from django.contrib.auth.models import Group
-from django.core.exceptions import MultipleObjectsReturned
+from django.core.exceptions import FieldDoesNotExist
 from django.core.exceptions import ValidationError
+from django.db import router, transaction
 
 
 from rdrf.helpers.utils import create_permission
+from rdrf.helpers import metadata_cache
 
 import yaml
 import json
@@ -26,21 +31,41 @@ import json
 logger = logging.getLogger(__name__)
 
 
-def _registries_using_cde(cde_code):
-    registries = set([])
-    for r in Registry.objects.all():
-        for form in RegistryForm.objects.filter(registry=r):
-            for section_code in form.get_sections():
-                try:
-                    section = Section.objects.get(code=section_code)
-                    for cde_code_in_section in section.get_elements():
-                        if cde_code == cde_code_in_section:
-                            registries.add(r.code)
-
-                except Section.DoesNotExist:
-                    pass
-
-    return [code for code in registries]
+def _registries_using_cdes():
+    """
+    cde code -> codes of the registries whose forms use it
+    """
+    section_cdes = {section.code: section.get_elements() for section in Section.objects.all()}
+    registries = defaultdict(set)
+    for form in RegistryForm.objects.select_related("registry"):
+        for section_code in form.get_sections():
+            for cde_code in section_cdes.get(section_code, []):
+                registries[cde_code].add(form.registry.code)
+    return registries
+
+
+def _assign(instance, values):
+    """
+    Sets the field values on a model instance, returning the names of
+    the fields which changed
+    """
+    changed = []
+    for name, value in values.items():
+        try:
+            field = instance._meta.get_field(name)
+            new_value = field.to_python(value)
+        except (FieldDoesNotExist, ValidationError):
+            # not a field ( or not a valid value ) - set as is, as save would
+            setattr(instance, name, value)
+            continue
+        if getattr(instance, field.attname) != new_value:
+            setattr(instance, field.attname, new_value)
+            changed.append(field.attname)
+    return changed
+
+
+class _DryRun(Exception):
+    pass
 
 
 class RegistryImportError(Exception):
@@ -89,6 +114,33 @@ class Importer(object):
         self.check_validity = True
         self.check_soundness = True
         self.abort_on_conflict = False
+        # model name -> Counter of "created", "updated", "unchanged", "deleted"
+        self.changes = defaultdict(Counter)
+        # phase -> seconds
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def _phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - start
+            logger.info("import phase %s took %.2fs" % (name, self.timings[name]))
+
+    def change_summary(self):
+        """
+        lines describing what the import changed ( or would change ) and
+        the time each phase took
+        """
+        lines = []
+        for model_name, counts in self.changes.items():
+            lines.append("%s: %s" % (model_name, ", ".join("%s %s" % (counts[action], action)
+                                                           for action in ["created", "updated", "unchanged", "deleted"]
+                                                           if counts[action])))
+        for phase, seconds in self.timings.items():
+            lines.append("%s took %.2fs" % (phase, seconds))
+        return lines
 
     def load_yaml_from_string(self, yaml_string):
         self.yaml_data_file = "yaml string"
@@ -107,11 +159,27 @@ class Importer(object):
             logger.error("Could not parse yaml data:\n%s\n\nError:\n%s" % (yaml_data_file, ex))
             raise BadDefinitionFile("YAML file is malformed: %s" % ex)
 
-    def create_registry(self):
+    def create_registry(self, dry_run=False):
+        """
+        With dry_run the import is rolled back once done, leaving
+        self.changes and self.timings to show what it would do
+        """
         if self.state == ImportState.MALFORMED:
             logger.error("Cannot create registry as yaml is not well formed: %s" % self.errors)
             return
 
+        # every definition model saved below would otherwise invalidate the
+        # metadata cache - do it once when the import is finished
+        with metadata_cache.deferred_invalidation():
+            try:
+                with transaction.atomic(using=router.db_for_write(Registry)):
+                    self._create_registry()
+                    if dry_run:
+                        raise _DryRun()
+            except _DryRun:
+                logger.info("dry run of import rolled back")
+
+    def _create_registry(self):
         if self.check_validity:
             self._validate()
             if self.state == ImportState.INVALID:
@@ -123,7 +191,8 @@ class Importer(object):
         self._create_registry_objects()
 
         if self.check_soundness:
-            self._check_soundness()
+            with self._phase("soundness"):
+                self._check_soundness()
             if self.state == ImportState.UNSOUND:
                 raise DefinitionFileUnsound(
                     "Definition File refers to CDEs that don't exist: %s" % self.errors)
@@ -155,22 +224,13 @@ class Importer(object):
             self.state = ImportState.VALID
 
     def _check_soundness(self):
-        def exists(cde_code):
-            try:
-                CommonDataElement.objects.get(code=cde_code)
-                return True
-            except CommonDataElement.DoesNotExist:
-                return False
-
         cde_codes = []
-        missing_codes = []
         for frm_map in self.data["forms"]:
             for section_map in frm_map["sections"]:
                 cde_codes.extend(section_map["elements"])
 
-        for cde_code in cde_codes:
-            if not exists(cde_code):
-                missing_codes.append(cde_codes)
+        existing_codes = set(CommonDataElement.objects.filter(code__in=cde_codes).values_list("code", flat=True))
+        missing_codes = [cde_code for cde_code in cde_codes if cde_code not in existing_codes]
 
         if missing_codes:
             self.state = ImportState.UNSOUND
@@ -196,15 +256,18 @@ class Importer(object):
             raise RegistryImportError(
                 "Imported registry has different forms to yaml file: %s" % msg)
 
+    def _imported_forms(self, imported_registry):
+        return [form for form in RegistryForm.objects.filter(registry=imported_registry)
+                if form.name != imported_registry.generated_questionnaire_name]
+
     def _check_sections(self, imported_registry):
-        for form in RegistryForm.objects.filter(registry=imported_registry):
-            if form.name == imported_registry.generated_questionnaire_name:
-                continue
+        forms = self._imported_forms(imported_registry)
+        sections = Section.objects.in_bulk([code for form in forms for code in form.get_sections()],
+                                           field_name="code")
+        for form in forms:
             sections_in_db = set(form.get_sections())
             for section_code in sections_in_db:
-                try:
-                    Section.objects.get(code=section_code)
-                except Section.DoesNotExist:
+                if section_code not in sections:
                     raise RegistryImportError(
                         "Section %s in form %s has not been created?!" %
                         (section_code, form.name))
@@ -223,190 +286,203 @@ class Importer(object):
                     (form.name, msg))
 
     def _check_cdes(self, imported_registry):
-        for form in RegistryForm.objects.filter(registry=imported_registry):
-            if form.name == imported_registry.generated_questionnaire_name:
-                continue
+        forms = self._imported_forms(imported_registry)
+        sections = Section.objects.in_bulk([code for form in forms for code in form.get_sections()],
+                                           field_name="code")
+        cde_codes = set(CommonDataElement.objects.filter(
+            code__in=[code for section in sections.values() for code in section.get_elements()]
+        ).values_list("code", flat=True))
+        for form in forms:
             for section_code in form.get_sections():
-                try:
-                    section = Section.objects.get(code=section_code)
-                    section_cdes = section.get_elements()
-                    imported_section_cdes = set([])
-                    for section_cde_code in section_cdes:
-                        try:
-                            cde_model = CommonDataElement.objects.get(code=section_cde_code)
-                            imported_section_cdes.add(cde_model.code)
-                        except CommonDataElement.DoesNotExist:
-                            raise RegistryImportError(
-                                "CDE %s.%s does not exist" %
-                                (form.name, section_code, section_cde_code))
-
-                    yaml_section_cdes = set([])
-                    for form_map in self.data["forms"]:
-                        if form_map["name"] == form.name:
-                            for section_map in form_map["sections"]:
-                                if section_map["code"] == section.code:
-                                    elements = section_map["elements"]
-                                    for cde_code in elements:
-                                        yaml_section_cdes.add(cde_code)
-                    if yaml_section_cdes != imported_section_cdes:
-                        db_msg = "in DB %s.%s has cdes %s" % (
-                            form.name, section.code, imported_section_cdes)
-                        yaml_msg = "in YAML %s.%s has cdes %s" % (
-                            form.name, section.code, yaml_section_cdes)
-                        msg = "%s\n%s" % (db_msg, yaml_msg)
-
-                        raise RegistryImportError(
-                            "CDE codes on imported registry do not match those specified in data file: %s" % msg)
-
-                except Section.DoesNotExist:
+                if section_code not in sections:
                     raise RegistryImportError(
                         "Section %s in form %s has not been created?!" %
                         (section_code, form.name))
+                section = sections[section_code]
+                imported_section_cdes = set([])
+                for section_cde_code in section.get_elements():
+                    if section_cde_code not in cde_codes:
+                        raise RegistryImportError(
+                            "CDE %s.%s.%s does not exist" %
+                            (form.name, section_code, section_cde_code))
+                    imported_section_cdes.add(section_cde_code)
+
+                yaml_section_cdes = set([])
+                for form_map in self.data["forms"]:
+                    if form_map["name"] == form.name:
+                        for section_map in form_map["sections"]:
+                            if section_map["code"] == section.code:
+                                elements = section_map["elements"]
+                                for cde_code in elements:
+                                    yaml_section_cdes.add(cde_code)
+                if yaml_section_cdes != imported_section_cdes:
+                    db_msg = "in DB %s.%s has cdes %s" % (
+                        form.name, section.code, imported_section_cdes)
+                    yaml_msg = "in YAML %s.%s has cdes %s" % (
+                        form.name, section.code, yaml_section_cdes)
+                    msg = "%s\n%s" % (db_msg, yaml_msg)
+
+                    raise RegistryImportError(
+                        "CDE codes on imported registry do not match those specified in data file: %s" % msg)
+
+    def _bulk_write(self, model, created, updated, update_fields, deleted=None):
+        # bulk writes send no signals, so the definitions are invalidated here
+        model_name = model.__name__
+        if created:
+            model.objects.bulk_create(created)
+        if updated:
+            model.objects.bulk_update(updated, sorted(update_fields))
+        if deleted:
+            model.objects.filter(pk__in=deleted).delete()
+        self.changes[model_name]["created"] += len(created)
+        self.changes[model_name]["updated"] += len(updated)
+        self.changes[model_name]["deleted"] += len(deleted or [])
+        if created or updated or deleted:
+            metadata_cache.invalidate()
 
     def _create_groups(self, permissible_value_group_maps):
+        group_codes = [pvg_map["code"] for pvg_map in permissible_value_group_maps]
+        existing_groups = set(CDEPermittedValueGroup.objects.filter(code__in=group_codes)
+                                                            .values_list("code", flat=True))
+        new_groups = [CDEPermittedValueGroup(code=code) for code in OrderedDict.fromkeys(group_codes)
+                      if code not in existing_groups]
+        self._bulk_write(CDEPermittedValueGroup, new_groups, [], [])
+        self.changes["CDEPermittedValueGroup"]["unchanged"] += len(existing_groups)
+
+        existing_values = {(value.pv_group_id, value.code): value
+                           for value in CDEPermittedValue.objects.filter(pv_group_id__in=existing_groups)}
+        created = OrderedDict()
+        updated = OrderedDict()
+        update_fields = set()
+        imported = set()
         for pvg_map in permissible_value_group_maps:
-            pvg, created = CDEPermittedValueGroup.objects.get_or_create(code=pvg_map["code"])
-            pvg.save()
-            if not created:
-                logger.warning("Import is updating an existing group %s" % pvg.code)
-                existing_values = [pv for pv in CDEPermittedValue.objects.filter(pv_group=pvg)]
-                existing_value_codes = set([pv.code for pv in existing_values])
-                import_value_codes = set([v["code"] for v in pvg_map["values"]])
-                import_missing = existing_value_codes - import_value_codes
-                # ensure applied import "wins" - this potentially could affect other
-                # registries though
-                # but if value sets are inconsistent we can't help it
-
-                for value_code in import_missing:
-                    try:
-                        value = CDEPermittedValue.objects.get(code=value_code, pv_group=pvg)
-                        logger.warning(
-                            "deleting value %s.%s as it is not in import!" %
-                            (pvg.code, value.code))
-                        value.delete()
-                    except CDEPermittedValue.DoesNotExist:
-                        logger.warning(f"CDEPermittedValue value does not exist for pvg {pvg.code} value {value_code}")
-
-                    except Exception as ex:
-                        logger.error("err: %s" % ex)
-                        raise
+            pvg_code = pvg_map["code"]
+            if pvg_code in existing_groups:
+                logger.warning("Import is updating an existing group %s" % pvg_code)
 
             for value_map in pvg_map["values"]:
-                try:
-                    value, created = CDEPermittedValue.objects.get_or_create(
-                        code=value_map["code"], pv_group=pvg)
-                except MultipleObjectsReturned:
-                    raise ValidationError(
-                        "range %s code %s is duplicated" %
-                        (pvg.code, value_map["code"]))
-
-                if not created:
-                    if value.value != value_map["value"]:
-                        logger.warning("Existing value code %s.%s = '%s'" %
-                                       (value.pv_group.code, value.code, value.value))
-                        logger.warning("Import value code %s.%s = '%s'" %
-                                       (pvg_map["code"], value_map["code"], value_map["value"]))
-
-                    if value.desc != value_map["desc"]:
-                        logger.warning("Existing value desc%s.%s = '%s'" %
-                                       (value.pv_group.code, value.code, value.desc))
-                        logger.warning("Import value desc %s.%s = '%s'" %
-                                       (pvg_map["code"], value_map["code"], value_map["desc"]))
-
-                # update the value ...
-                value.value = value_map["value"]
-                value.desc = value_map["desc"]
-
+                key = (pvg_code, value_map["code"])
+                imported.add(key)
+                values = {"value": value_map["value"], "desc": value_map["desc"]}
                 if 'questionnaire_value' in value_map:
-                    value.questionnaire_value = value_map['questionnaire_value']
-
+                    values["questionnaire_value"] = value_map['questionnaire_value']
                 if 'position' in value_map:
-                    value.position = value_map['position']
+                    values["position"] = value_map['position']
 
-                value.save()
+                value = existing_values.get(key)
+                if value is None:
+                    value = created.get(key) or CDEPermittedValue(code=value_map["code"], pv_group_id=pvg_code)
+                    _assign(value, values)
+                    created[key] = value
+                    continue
+
+                if value.value != value_map["value"]:
+                    logger.warning("Existing value code %s.%s = '%s'" % (pvg_code, value.code, value.value))
+                    logger.warning("Import value code %s.%s = '%s'" % (pvg_code, value_map["code"], value_map["value"]))
+                if value.desc != value_map["desc"]:
+                    logger.warning("Existing value desc%s.%s = '%s'" % (pvg_code, value.code, value.desc))
+                    logger.warning("Import value desc %s.%s = '%s'" % (pvg_code, value_map["code"], value_map["desc"]))
+
+                # update the value ...
+                changed = _assign(value, values)
+                if changed:
+                    update_fields.update(changed)
+                    updated[key] = value
+
+        # ensure applied import "wins" - this potentially could affect other
+        # registries though but if value sets are inconsistent we can't help it
+        deleted = []
+        for key, value in existing_values.items():
+            if key not in imported:
+                logger.warning("deleting value %s.%s as it is not in import!" % key)
+                deleted.append(value.pk)
+
+        self._bulk_write(CDEPermittedValue, list(created.values()), list(updated.values()), update_fields, deleted)
+        self.changes["CDEPermittedValue"]["unchanged"] += len(existing_values) - len(updated) - len(deleted)
 
     def _create_cdes(self, cde_maps):
+        existing_cdes = CommonDataElement.objects.in_bulk([cde_map["code"] for cde_map in cde_maps])
+        groups = CDEPermittedValueGroup.objects.in_bulk([cde_map["pv_group"] for cde_map in cde_maps
+                                                         if cde_map["pv_group"]])
+        created = OrderedDict()
+        updated = OrderedDict()
+        update_fields = set()
         for cde_map in cde_maps:
-            cde_model, created = CommonDataElement.objects.get_or_create(code=cde_map["code"])
-
-            if not created:
-                registries_already_using = _registries_using_cde(cde_model)
-                if len(registries_already_using) > 0:
-                    logger.warning("Import is modifying existing CDE %s" % cde_model)
-                    logger.warning(
-                        "This cde is used by the following registries: %s" %
-                        registries_already_using)
-
-            for field in cde_map:
-                if field not in ["code", "pv_group"]:
-                    import_value = cde_map[field]
-                    if not created:
-                        old_value = getattr(cde_model, field)
-                        if old_value != import_value:
-                            logger.warning(
-                                "import will change cde %s: import value = %s new value = %s" %
-                                (cde_model.code, old_value, import_value))
-
-                    setattr(cde_model, field, cde_map[field])
+            code = cde_map["code"]
+            values = {field: cde_map[field] for field in cde_map if field not in ["code", "pv_group"]}
 
             # Assign value group - pv_group will be empty string is not a range
-
             if cde_map["pv_group"]:
-                try:
-                    pvg = CDEPermittedValueGroup.objects.get(code=cde_map["pv_group"])
-                    if not created:
-                        if cde_model.pv_group != pvg:
-                            logger.warning(
-                                "import will change cde %s: old group = %s new group = %s" %
-                                (cde_model.code, cde_model.pv_group, pvg))
-
-                    cde_model.pv_group = pvg
-                except CDEPermittedValueGroup.DoesNotExist as ex:
-                    raise ConsistencyError("Assign of group %s to imported CDE %s failed: %s" %
-                                           (cde_map["pv_group"], cde_model.code, ex))
-
-            cde_model.save()
-
-    def _create_generic_sections(self, generic_section_maps):
-        for section_map in generic_section_maps:
-            s, created = Section.objects.get_or_create(code=section_map["code"])
-            s.code = section_map["code"]
-            s.display_name = section_map["display_name"]
-            s.elements = ",".join(section_map["elements"])
-            s.allow_multiple = section_map["allow_multiple"]
-            if "questionnaire_help" in section_map:
-                s.questionnaire_help = section_map["questionnaire_help"]
-            s.extra = section_map["extra"]
-            s.save()
-            logger.info("saved generic section %s" % s.code)
-
-    def _create_patient_data_section(self, section_map):
-        if section_map:
-            s, created = Section.objects.get_or_create(code=section_map["code"])
-            s.code = section_map["code"]
-            s.display_name = section_map["display_name"]
-            s.elements = ",".join(section_map["elements"])
-            s.allow_multiple = section_map["allow_multiple"]
-            if "questionnaire_help" in section_map:
-                s.questionnaire_help = section_map["questionnaire_help"]
-            s.extra = section_map["extra"]
-            s.save()
-            logger.info("saved patient data section  %s" % s.code)
-            return s
-        else:
-            return None
-
-    def _create_section_model(self, section_map):
-        s, created = Section.objects.get_or_create(code=section_map["code"])
-        s.code = section_map["code"]
-        s.display_name = section_map["display_name"]
-        s.elements = ",".join(section_map["elements"])
-        s.allow_multiple = section_map["allow_multiple"]
-        s.extra = section_map["extra"]
-        if "questionnaire_help" in section_map:
-            s.questionnaire_help = section_map["questionnaire_help"]
-        s.save()
-        logger.info("imported section %s OK" % s.code)
+                if cde_map["pv_group"] not in groups:
+                    raise ConsistencyError("Assign of group %s to imported CDE %s failed: group does not exist" %
+                                           (cde_map["pv_group"], code))
+                values["pv_group_id"] = cde_map["pv_group"]
+
+            cde_model = existing_cdes.get(code)
+            if cde_model is None:
+                cde_model = created.get(code) or CommonDataElement(code=code)
+                _assign(cde_model, values)
+                created[code] = cde_model
+                continue
+
+            old_values = {field: getattr(cde_model, field, None) for field in values}
+            changed = _assign(cde_model, values)
+            for field in changed:
+                logger.warning("import will change cde %s: %s old value = %s new value = %s" %
+                               (code, field, old_values.get(field), getattr(cde_model, field)))
+            if changed:
+                update_fields.update(changed)
+                updated[code] = cde_model
+
+        if updated:
+            registries_using = _registries_using_cdes()
+            for code in updated:
+                if registries_using[code]:
+                    logger.warning("Import is modifying existing CDE %s" % code)
+                    logger.warning("This cde is used by the following registries: %s" % sorted(registries_using[code]))
+
+        self._bulk_write(CommonDataElement, list(created.values()), list(updated.values()), update_fields)
+        self.changes["CommonDataElement"]["unchanged"] += len(existing_cdes) - len(updated)
+
+    def _section_maps(self):
+        # every section of the definition: generic, patient data and form sections
+        section_maps = list(self.data.get("generic_sections") or [])
+        if self.data.get("patient_data_section"):
+            section_maps.append(self.data["patient_data_section"])
+        for frm_map in self.data["forms"]:
+            section_maps.extend(frm_map["sections"])
+        return section_maps
+
+    def _create_sections(self, section_maps):
+        existing_sections = Section.objects.in_bulk([section_map["code"] for section_map in section_maps],
+                                                    field_name="code")
+        created = OrderedDict()
+        updated = OrderedDict()
+        update_fields = set()
+        for section_map in section_maps:
+            code = section_map["code"]
+            values = {"display_name": section_map["display_name"],
+                      "elements": ",".join(section_map["elements"]),
+                      "allow_multiple": section_map["allow_multiple"],
+                      "extra": section_map["extra"]}
+            for field in ["questionnaire_display_name", "questionnaire_help"]:
+                if field in section_map:
+                    values[field] = section_map[field]
+
+            section_model = existing_sections.get(code)
+            if section_model is None:
+                section_model = created.get(code) or Section(code=code)
+                _assign(section_model, values)
+                created[code] = section_model
+            else:
+                changed = _assign(section_model, values)
+                if changed:
+                    update_fields.update(changed)
+                    updated[code] = section_model
+
+        self._bulk_write(Section, list(created.values()), list(updated.values()), update_fields)
+        self.changes["Section"]["unchanged"] += len(existing_sections) - len(updated)
+        logger.info("imported %s sections OK" % len(section_maps))
 
     def _check_metadata_json(self, metadata_json):
         if not metadata_json:
@@ -422,15 +498,22 @@ class Importer(object):
             return False
 
     def _create_registry_objects(self):
-        self._create_groups(self.data["pvgs"])
+        with self._phase("pvgs"):
+            self._create_groups(self.data["pvgs"])
         logger.info("imported pvgs OK")
-        self._create_cdes(self.data["cdes"])
+        with self._phase("cdes"):
+            self._create_cdes(self.data["cdes"])
         logger.info("imported cdes OK")
-        if "generic_sections" in self.data:
-            self._create_generic_sections(self.data["generic_sections"])
+        # all the sections are created before the forms so the form save validation passes
+        with self._phase("sections"):
+            self._create_sections(self._section_maps())
 
-        logger.info("imported generic sections OK")
+        with self._phase("forms"):
+            r = self._create_forms()
+        with self._phase("other definitions"):
+            self._create_other_definitions(r)
 
+    def _create_forms(self):
         r, created = Registry.objects.get_or_create(code=self.data["code"])
 
         original_forms = set([f.name for f in RegistryForm.objects.filter(registry=r)])
@@ -450,9 +533,7 @@ class Importer(object):
         if "patient_data_section" in self.data:
             patient_data_section_map = self.data["patient_data_section"]
             if patient_data_section_map:
-                patient_data_section = self._create_patient_data_section(
-                    patient_data_section_map)
-                r.patient_data_section = patient_data_section
+                r.patient_data_section = Section.objects.get(code=patient_data_section_map["code"])
 
         if "metadata_json" in self.data:
             metadata_json = self.data["metadata_json"]
@@ -470,13 +551,11 @@ class Importer(object):
 
             sections = ",".join([section_map["code"] for section_map in frm_map["sections"]])
 
-            # First create section models so the form save validation passes
-            self._create_form_sections(frm_map)
-
             f, created = RegistryForm.objects.get_or_create(registry=r, name=frm_map["name"],
                                                             defaults={'sections': sections})
             if not created:
                 f.sections = sections
+            self.changes["RegistryForm"]["created" if created else "updated"] += 1
 
             permission_code_name = "form_%s_is_readonly" % f.id
             permission_name = "Form '%s' is readonly (%s)" % (f.name, f.registry.code.upper())
@@ -518,10 +597,13 @@ class Importer(object):
                 assert form_name not in imported_forms
                 logger.info("deleting extra form not present in import file: %s" % form_name)
                 extra_form.delete()
+                self.changes["RegistryForm"]["deleted"] += 1
             except RegistryForm.DoesNotExist:
                 # shouldn't happen but if so just continue
                 pass
+        return r
 
+    def _create_other_definitions(self, r):
         self._create_working_groups(r)
         # create consent sections if they exist
         self._create_consent_sections(r)
@@ -784,21 +866,6 @@ class Importer(object):
                 en.email_templates.add(et)
                 en.save()
 
-    def _create_form_sections(self, frm_map):
-        for section_map in frm_map["sections"]:
-            s, created = Section.objects.get_or_create(code=section_map["code"])
-            s.code = section_map["code"]
-            s.display_name = section_map["display_name"]
-            if "questionnaire_display_name" in section_map:
-                s.questionnaire_display_name = section_map["questionnaire_display_name"]
-            s.elements = ",".join(section_map["elements"])
-            s.allow_multiple = section_map["allow_multiple"]
-            s.extra = section_map["extra"]
-            if "questionnaire_help" in section_map:
-                s.questionnaire_help = section_map["questionnaire_help"]
-            s.save()
-            logger.info("imported section %s OK" % s.code)
-
     def _create_context_form_groups(self, registry):
         from rdrf.models.definition.models import ContextFormGroup, ContextFormGroupItem
 
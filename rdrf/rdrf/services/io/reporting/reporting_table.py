@@ -1,5 +1,6 @@
 import sqlalchemy as alc
 from sqlalchemy import create_engine, MetaData
+from rdrf.helpers import metadata_cache
 from rdrf.helpers.utils import timed
 from datetime import datetime
 from django.conf import settings
@@ -33,7 +34,7 @@ class ColumnLabeller(object):
 
     def _get_label(self, column_name):
         # relies on the encoding of the column names
-        from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
+        from rdrf.models.definition.models import RegistryForm, Section
         try:
             column_tuple = column_name.split("_")
             num_parts = len(column_tuple)
@@ -53,7 +54,7 @@ class ColumnLabeller(object):
 
             form_model = RegistryForm.objects.get(pk=int(form_pk))
             section_model = Section.objects.get(pk=int(section_pk))
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            cde_model = metadata_cache.load_cde(cde_code)
             if column_index:
                 s = form_model.name[:3] + "_" + section_model.display_name[
                     :3] + "_" + cde_model.name[:30] + "_" + column_index
@@ -491,7 +492,6 @@ class MongoFieldSelector(object):
         # the constructed json is independent of db ids ( as these will change
         # is import of registry definition occurs
         import json
-        from rdrf.models.definition.models import CommonDataElement
         from rdrf.models.definition.models import RegistryForm
         from rdrf.models.definition.models import Section
         projection_data = []
@@ -503,7 +503,7 @@ class MongoFieldSelector(object):
 
             form_model = RegistryForm.objects.get(pk=int(form_pk))
             section_model = Section.objects.get(pk=int(section_pk))
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            cde_model = metadata_cache.load_cde(cde_code)
 
             value_dict = {}
             value_dict["registryCode"] = form_model.registry.code
@@ -523,7 +523,6 @@ class MongoFieldSelector(object):
         return json.dumps(projection_data)
 
     def _get_longitudinal_cdes(self):
-        from rdrf.models.definition.models import CommonDataElement
         from rdrf.models.definition.models import RegistryForm
         from rdrf.models.definition.models import Section
         d = {}
@@ -532,7 +531,7 @@ class MongoFieldSelector(object):
                 "_")
             form_model = RegistryForm.objects.get(pk=int(form_pk))
             section_model = Section.objects.get(pk=int(section_pk))
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            cde_model = metadata_cache.load_cde(cde_code)
             d[(form_model.name, section_model.code, cde_model.code)] = True
         return d
 
@@ -1,52 +1,105 @@
 import openpyxl as xl
+from openpyxl.cell import WriteOnlyCell
+from collections import OrderedDict
 import logging
 import json
 import functools
+import sys
+import time
+from rdrf.helpers import metadata_cache
 from rdrf.helpers.utils import get_cde_value
 from rdrf.helpers.utils import cached
 from rdrf.db.dynamic_data import DynamicDataWrapper
-from rdrf.models.definition.models import CommonDataElement, ClinicalData
-from rdrf.db.generalised_field_expressions import GeneralisedFieldExpressionParser
+from rdrf.db import history as history_storage
+from rdrf.models.definition.models import ClinicalData
+from rdrf.db.generalised_field_expressions import GeneralisedFieldExpressionParser, PATIENT_PREFETCH
 from django.conf import settings
+from django.db.models import Count, prefetch_related_objects
 
 logger = logging.getLogger(__name__)
 
+# patients whose current record and snapshots are loaded per query
+PREFETCH_BATCH_SIZE = 200
+# approximate memory the cached patient data may use
+CACHE_BUDGET_BYTES = getattr(settings, "SPREADSHEET_REPORT_CACHE_BYTES", 256 * 1024 * 1024)
 
-class Cache:
-    LIMIT_SNAPSHOT = 2000
-    LIMIT_CURRENT = 2000
 
-    def __init__(self):
-        self.snapshots = {}
-        self.current = {}
+def approximate_size(value):
+    # deep size of the json-like data held for a patient
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
 
-    def _get_data(self, patient, name, cached_data, limit, retriever):
-        if patient.id in cached_data:
-            return cached_data[patient.id]
-        else:
-            if len(cached_data) == self.LIMIT_CURRENT:
-                k = list(cached_data.keys())[0]
-                del cached_data[k]
 
-            patient_data = retriever(patient)
-            cached_data[patient.id] = patient_data
-            return patient_data
+class LRUCache:
+    """
+    Least recently used cache bounded by the approximate size of its values
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        value, _ = self.entries[key]
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        value_size = approximate_size(value)
+        self.entries[key] = (value, value_size)
+        self.size += value_size
+        while self.size > self.budget and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+
+class Cache:
+    def __init__(self, budget=CACHE_BUDGET_BYTES):
+        # the budget is shared between current records and snapshots
+        self.snapshots = LRUCache(budget // 2)
+        self.current = LRUCache(budget // 2)
+
+    def _get_data(self, patient, cached_data, retriever):
+        if patient.id in cached_data:
+            return cached_data.get(patient.id)
+        patient_data = retriever(patient)
+        cached_data.put(patient.id, patient_data)
+        return patient_data
 
     def get_current(self, patient, current_retriever):
-        return self._get_data(
-            patient,
-            "current",
-            self.current,
-            self.LIMIT_CURRENT,
-            current_retriever)
+        return self._get_data(patient, self.current, current_retriever)
 
     def get_snapshots(self, patient, snapshots_retriever):
-        return self._get_data(
-            patient,
-            "snapshots",
-            self.snapshots,
-            self.LIMIT_SNAPSHOT,
-            snapshots_retriever)
+        return self._get_data(patient, self.snapshots, snapshots_retriever)
+
+
+def memory_mb():
+    """
+    ( current, peak ) resident set size of the process in MB, from
+    /proc/self/status ( None off linux )
+    """
+    sizes = {}
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, kilobytes = line.split()[:2]
+                    sizes[name] = int(kilobytes) / 1024.0
+    except OSError:
+        return None
+    if len(sizes) < 2:
+        return None
+    return sizes["VmRSS:"], sizes["VmHWM:"]
 
 
 def attempt(func):
@@ -68,16 +121,24 @@ def default_time_window():
 
 
 class SpreadSheetReport:
+    """
+    Longitudinal spreadsheet report.
+
+    The workbook is written in openpyxl's write-only mode: rows are streamed
+    to the sheets as they are completed. The current records and snapshots of
+    the patients are loaded PREFETCH_BATCH_SIZE patients at a time and kept
+    in a size bounded LRU cache across the sheets.
+    """
+
     def __init__(self, query_model, humaniser):
         self.query_model = query_model
         self.humaniser = humaniser
         self.registry_model = query_model.registry
         self.projection_list = json.loads(query_model.projection)
         self.longitudinal_column_map = self._build_longitudinal_column_map()
-        self.work_book = xl.Workbook()
+        self.work_book = xl.Workbook(write_only=True)
         self.current_sheet = None
-        self.current_row = 1
-        self.current_col = 1
+        self.current_cells = []
         self.time_window = default_time_window()
         self.patient_fields = self._get_patient_fields()
         self.cde_model_map = {}
@@ -89,8 +150,18 @@ class SpreadSheetReport:
 
     # Public interface
     def run(self, output_filename):
+        start = time.time()
+        before = memory_mb()
         self._generate()
         self.work_book.save(output_filename)
+        after = memory_mb()
+        elapsed = time.time() - start
+        if before is None or after is None:
+            logger.info("spreadsheet report %s: %.1f seconds" % (self.query_model.title, elapsed))
+            return
+        # the peak is that of the whole ( worker ) process, not of this report
+        logger.info("spreadsheet report %s: %.1f seconds, RSS %.0f MB -> %.0f MB, process peak %.0f MB" % (
+            self.query_model.title, elapsed, before[0], after[0], after[1]))
 
     # Private
 
@@ -98,7 +169,7 @@ class SpreadSheetReport:
         for cde_code in cde_codes:
             if cde_code not in self.cde_model_map:
                 self.cde_model_map[
-                    cde_code] = CommonDataElement.objects.get(code=cde_code)
+                    cde_code] = metadata_cache.load_cde(cde_code)
 
     def _get_patient_fields(self):
         from registry.patients.models import Patient
@@ -120,29 +191,21 @@ class SpreadSheetReport:
 
     # Movement helper functions
 
-    def _next_cell(self):
-        self.current_col += 1
-
     def _next_row(self):
-        self.current_row += 1
-        self.current_col = 1
-
-    def _reset(self):
-        self.current_col = 1
-        self.current_row = 1
+        # write-only sheets are appended to a complete row at a time
+        self.current_sheet.append(self.current_cells)
+        self.current_cells = []
 
     # Writing
 
     def _write_cell(self, value):
-        # write value at current position
-        cell = self.current_sheet.cell(
-            row=self.current_row, column=self.current_col)
+        # write value at the next position of the current row
         try:
-            cell.value = value
+            cell = WriteOnlyCell(self.current_sheet, value=value)
         except Exception as ex:
             logger.error("error writing value %s to cell: %s" % (value, ex))
-            cell.value = "?ERROR?"
-        self._next_cell()
+            cell = WriteOnlyCell(self.current_sheet, value="?ERROR?")
+        self.current_cells.append(cell)
 
     def _generate(self):
         config = json.loads(self.query_model.sql_query)
@@ -170,7 +233,7 @@ class SpreadSheetReport:
         self._write_header_row(columns)
         self._next_row()
 
-        for patient in self._get_patients():
+        for patient in self._iter_patients(snapshots=False):
             patient_record = self.cache.get_current(patient, self._get_patient_record)
             self._write_row(patient, patient_record, columns)
             self._next_row()
@@ -242,31 +305,18 @@ class SpreadSheetReport:
         sheet_name = self.registry_model.code.upper() + section_model.code
         sheet_name = sheet_name[:30]  # 31 max char sheet name size ...
         self._create_sheet(sheet_name)
-        # this just writes out bit at the beginning
-        self._write_header_universal_columns(universal_columns)
-        first_longitudinal_date_col = self.current_col
-        self._next_row()
-        max_snapshots = 0
         cde_codes = self.longitudinal_column_map.get(
             (form_model.name, section_model.code), [])
 
         self._add_cde_models(cde_codes)
 
-        for patient in self._get_patients():
-            patient_record = self.cache.get_current(patient, self._get_patient_record)
-            self._write_universal_columns(patient, patient_record, universal_columns)
-            num_snapshots = self._write_longitudinal_row(
-                patient, patient_record, form_model, section_model, cde_codes)
-            if num_snapshots > max_snapshots:
-                max_snapshots = num_snapshots
-            self._next_row()
-
-        # write longitudinal header row now we know max width
-        self.current_col = first_longitudinal_date_col
-        self.current_row = 1
+        # the header row comes first in a streamed sheet, so the widest row
+        # is counted up front
+        self._write_header_universal_columns(universal_columns)
         column_prefix = "%s/%s" % (form_model.name.upper(),
                                    section_model.code)
         date_column_name = "DATE_%s" % column_prefix
+        max_snapshots = self._get_max_snapshots()
         if max_snapshots == 0:
             self._write_cell(date_column_name)
             for cde_code in cde_codes:
@@ -278,12 +328,19 @@ class SpreadSheetReport:
                 self._write_cell(date_column_name)
                 for cde_code in cde_codes:
                     self._write_cell(cde_code)
+        self._next_row()
+
+        for patient in self._iter_patients(snapshots=True):
+            patient_record = self.cache.get_current(patient, self._get_patient_record)
+            self._write_universal_columns(patient, patient_record, universal_columns)
+            self._write_longitudinal_row(
+                patient, patient_record, form_model, section_model, cde_codes)
+            self._next_row()
 
     def _create_sheet(self, title):
-        sheet = self.work_book.create_sheet()
-        sheet.title = title
+        sheet = self.work_book.create_sheet(title=title)
         self.current_sheet = sheet
-        self._reset()
+        self.current_cells = []
 
     def _write_header_row(self, columns):
         for column_name in columns:
@@ -299,6 +356,63 @@ class SpreadSheetReport:
         from registry.patients.models import Patient
         return Patient.objects.filter(rdrf_registry__in=[self.registry_model]).order_by("id")
 
+    def _iter_patients(self, snapshots):
+        """
+        The report patients, with the data of each batch loaded into the
+        cache before it is yielded
+        """
+        batch = []
+        for patient in self._get_patients().iterator(chunk_size=PREFETCH_BATCH_SIZE):
+            batch.append(patient)
+            if len(batch) == PREFETCH_BATCH_SIZE:
+                yield from self._prefetched(batch, snapshots)
+                batch = []
+        if batch:
+            yield from self._prefetched(batch, snapshots)
+
+    def _prefetched(self, patients, snapshots):
+        # the relations the field expression columns read, for the whole batch
+        prefetch_related_objects(patients, "next_of_kin_relationship", *PATIENT_PREFETCH)
+        self._prefetch_current([p.id for p in patients if p.id not in self.cache.current])
+        if snapshots:
+            self._prefetch_snapshots([p.id for p in patients if p.id not in self.cache.snapshots])
+        return patients
+
+    def _patient_records(self, collection, patient_ids):
+        return ClinicalData.objects.collection(self.registry_model.code, collection).filter(
+            django_model="Patient", django_id__in=patient_ids)
+
+    def _prefetch_current(self, patient_ids):
+        if not patient_ids:
+            return
+        records = {}
+        # ordered by pk: the first record of a patient is the one load_dynamic_data returns
+        for patient_id, data in self._patient_records("cdes", patient_ids).values_list("django_id", "data"):
+            records.setdefault(patient_id, data)
+        for patient_id in patient_ids:
+            self.cache.current.put(patient_id, records.get(patient_id))
+
+    def _prefetch_snapshots(self, patient_ids):
+        if not patient_ids:
+            return
+        snapshots = {patient_id: [] for patient_id in patient_ids}
+        records = self._patient_records("history", patient_ids).filter(data__record_type="snapshot")
+        # the checkpoints of the deltas of the whole batch in one query
+        for data in history_storage.load_snapshots(records.values_list("data", flat=True)):
+            snapshots[data["django_id"]].append(data)
+        for patient_id in patient_ids:
+            self.cache.snapshots.put(patient_id, snapshots[patient_id])
+
+    def _get_max_snapshots(self):
+        # the clinical data is in another database so no subquery
+        patient_ids = list(self._get_patients().values_list("id", flat=True))
+        counts = self._patient_records("history", patient_ids).filter(data__record_type="snapshot") \
+                                                              .order_by() \
+                                                              .values("django_id") \
+                                                              .annotate(num_snapshots=Count("id")) \
+                                                              .values_list("num_snapshots", flat=True)
+        return max(counts, default=0)
+
     def _get_patient_record(self, patient, collection="cdes"):
         wrapper = DynamicDataWrapper(patient)
         return wrapper.load_dynamic_data(self.registry_model.code, collection, flattened=False)
@@ -397,4 +511,4 @@ class SpreadSheetReport:
         #     if before is not None:
         #         snapshots = snapshots.filter(data__timestamp__lte=before.isoformat())
 
-        return list(snapshots.data())
+        return history_storage.load_snapshots(snapshots.data())
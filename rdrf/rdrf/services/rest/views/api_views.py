@@ -4,7 +4,6 @@ import subprocess
 from datetime import datetime
 import json
 
-from django.db.models import Q
 from django.contrib.auth.mixins import LoginRequiredMixin
 from rest_framework import generics
 from rest_framework import viewsets
@@ -18,6 +17,7 @@ from rest_framework.views import APIView
 from registry.genetic.models import Gene, Laboratory
 from registry.patients.models import Patient, Registry, Doctor, NextOfKinRelationship
 from registry.groups.models import CustomUser, WorkingGroup
+from registry.patients.search import index_patients, search_patients, working_group_patients
 from rdrf.services.rest.serializers import PatientSerializer, RegistrySerializer, WorkingGroupSerializer, CustomUserSerializer, DoctorSerializer, NextOfKinRelationshipSerializer
 from celery.result import AsyncResult
 from django.http import HttpResponse
@@ -289,8 +289,7 @@ class LookupIndex(APIView):
         if not registry.has_feature('family_linkage'):
             return Response([])
 
-        query = (Q(given_names__icontains=term) | Q(family_name__icontains=term)) & \
-            Q(working_groups__in=request.user.working_groups.all(), active=True)
+        patients = index_patients(working_group_patients(Patient.objects.all(), request.user.working_groups.all()))
 
         def to_dict(patient):
             return {
@@ -300,8 +299,7 @@ class LookupIndex(APIView):
                 'label': "%s" % patient,
             }
 
-        return Response(
-            list(map(to_dict, [p for p in Patient.objects.filter(query) if p.is_index])))
+        return Response(list(map(to_dict, search_patients(patients, term))))
 
 
 class CalculatedCdeValue(APIView):
@@ -349,6 +347,12 @@ class TaskInfoView(APIView):
                     result = {"status": "error",
                               "message": "Task failed"}
                     cae.status = "task failed"
+                elif res.successful() and isinstance(res.result, dict) and "error" in res.result:
+                    # the task caught the error and has no file to download
+                    cae.status = "task error"
+                    cae.error_string = res.result["error"]
+                    result = {"status": "error",
+                              "message": res.result["error"]}
                 elif res.successful():
                     cae.status = "task succeeded"
                     task_result = res.result
@@ -359,6 +363,10 @@ class TaskInfoView(APIView):
                 else:
                     result = {"status": "error",
                               "message": status}
+            elif res.state == "PROGRESS":
+                # long running tasks report { "done": .., "total": .. }
+                result = {"status": "waiting",
+                          "progress": res.info}
             else:
                 result = {"status": "waiting"}
 
@@ -27,3 +27,28 @@ def run_custom_action(custom_action_id, user_id, patient_id, input_data):
 
     logger.debug("running custom action execute")
     return custom_action.execute(user, patient_model, input_data)
+
+
+# the side effects of saves are acknowledged once they have run, so a task
+# whose worker dies is delivered again ( they are safe to run twice )
+@app.task(name="rdrf.services.tasks.project_field_values", acks_late=True, reject_on_worker_lost=True)
+def project_field_values(record_id):
+    from explorer.utils import project_field_values as project
+    project(record_id)
+
+
+@app.task(name="rdrf.services.tasks.save_history_snapshot", bind=True, acks_late=True, reject_on_worker_lost=True,
+          max_retries=5, default_retry_delay=30)
+def save_history_snapshot(self, registry_code, patient_id, context_id, snapshot):
+    from rdrf.db.dynamic_data import DynamicDataWrapper
+    from registry.patients.models import Patient
+    patient_model = Patient.objects.filter(id=patient_id).first()
+    if patient_model is None:
+        logger.warning("history snapshot %s: patient %s no longer exists" % (snapshot["save_id"], patient_id))
+        return False
+    wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+    try:
+        return wrapper.save_deferred_snapshot(registry_code, snapshot)
+    except Exception as ex:
+        logger.error("error saving history snapshot %s: %s" % (snapshot["save_id"], ex))
+        raise self.retry(exc=ex)
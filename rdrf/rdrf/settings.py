@@ -172,6 +172,7 @@ MIDDLEWARE = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django_user_agents.middleware.UserAgentMiddleware',
+    'rdrf.helpers.metadata_cache.MetadataCacheMiddleware',
 )
 
 
@@ -696,11 +697,32 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_IMPORTS = ('rdrf.celery', 'rdrf.services.tasks',)
 
+# side effects of form saves: "sync" writes the history snapshot in the
+# request, "async" in a celery task once the save commits ( the field values
+# projection below then defaults to "async" too )
+FORM_SAVE_SIDE_EFFECTS = env.get("form_save_side_effects", "sync")
+
+# explorer report field values follow clinical data saves:
+# "sync" when the save commits, "async" in a celery task, "off" not at all
+FIELD_VALUES_PROJECTION = env.get("field_values_projection", FORM_SAVE_SIDE_EFFECTS)
+
+# clinical data history: "full" stores every snapshot in full, "delta" stores
+# one full checkpoint every HISTORY_CHECKPOINT_INTERVAL snapshots and the
+# changes since it in between ( see rdrf.db.history and compact_history )
+HISTORY_STORAGE = env.get("history_storage", "full")
+HISTORY_CHECKPOINT_INTERVAL = env.get("history_checkpoint_interval", 10)
+
+# most patients a name lookup ( type-ahead ) returns, see registry.patients.search
+PATIENT_SEARCH_LIMIT = env.get("patient_search_limit", 20)
+
 CACHES['search_results'] = CACHES['redis']
 # End Celery
 
 # Downloadable files from custom actions
 TASK_FILE_DIRECTORY = env.get("task_file_directory", "/data/static/tasks")
+# processes rendering the pdfs of a patient report for a cohort ( 1 renders
+# in the request or task process )
+PATIENT_REPORT_PROCESSES = env.get("patient_report_processes", 1)
 
 # CICAP
 CICAP_ADDRESS = env.get("cicap_address", "")
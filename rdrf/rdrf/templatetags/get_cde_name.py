@@ -1,4 +1,5 @@
 from django import template
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.models import CommonDataElement
 
 register = template.Library()
@@ -7,7 +8,7 @@ register = template.Library()
 @register.filter()
 def get_cde_name(cde_code):
     try:
-        cde_model = CommonDataElement.objects.get(code=cde_code)
+        cde_model = metadata_cache.load_cde(cde_code)
         return cde_model.name
     except CommonDataElement.DoesNotExist:
         return "%s does not exist?" % cde_code
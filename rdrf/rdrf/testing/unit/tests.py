@@ -9,7 +9,7 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.forms.models import model_to_dict
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, TransactionTestCase, RequestFactory
 
 from rdrf.services.io.defs.exporter import Exporter, ExportType
 from rdrf.services.io.defs.importer import Importer, ImportState
@@ -19,6 +19,7 @@ from rdrf.models.definition.models import CommonDataElement, InvalidAbnormalityC
 from rdrf.models.definition.models import ClinicalData
 from rdrf.models.proms.models import Survey, SurveyQuestion, Precondition
 from rdrf.views.form_view import FormView
+from rdrf.db.dynamic_data import DynamicDataWrapper
 from registry.patients.models import Patient
 from registry.patients.models import State, PatientAddress, AddressType
 from django.contrib.auth.models import Group
@@ -527,6 +528,45 @@ class ExporterTestCase(RDRFTestCase):
         return values
 
 
+class ModelExportImportTestCase(RDRFTestCase):
+
+    def test_jsonl_round_trip(self):
+        import tempfile
+        from rdrf.services.io.content.export_import.exporters import ModelExporter
+        from rdrf.services.io.content.export_import.importers import ModelImporter
+        from rdrf.services.io.content.export_import.utils import file_checksum
+        values = sorted(CDEPermittedValue.objects.values_list("pv_group_id", "code", "value"))
+        workdir = tempfile.mkdtemp()
+        exporter = ModelExporter("rdrf.CDEPermittedValue", logger)
+        exporter.export(workdir=workdir)
+        meta = exporter.get_meta_info()
+        self.assertEqual(meta["format"], "jsonl")
+        self.assertEqual(meta["object_count"], len(values))
+        self.assertEqual(meta["md5_checksum"], file_checksum(exporter.full_filename))
+        with open(exporter.full_filename) as f:
+            self.assertEqual(len(f.readlines()), len(values))
+
+        CDEPermittedValue.objects.all().delete()
+        ModelImporter().do_import(meta, workdir, logger=logger)
+        self.assertEqual(sorted(CDEPermittedValue.objects.values_list("pv_group_id", "code", "value")), values)
+
+    def test_bad_checksum_rolls_back(self):
+        import tempfile
+        from rdrf.services.io.content.export_import.exceptions import ImportError as ExportImportError
+        from rdrf.services.io.content.export_import.exporters import ModelExporter
+        from rdrf.services.io.content.export_import.importers import ModelImporter
+        workdir = tempfile.mkdtemp()
+        exporter = ModelExporter("rdrf.CDEPermittedValue", logger)
+        exporter.export(workdir=workdir)
+        meta = exporter.get_meta_info()
+        meta["md5_checksum"] = "0" * 32
+
+        CDEPermittedValue.objects.all().delete()
+        with self.assertRaises(ExportImportError):
+            ModelImporter().do_import(meta, workdir, logger=logger)
+        self.assertFalse(CDEPermittedValue.objects.exists())
+
+
 class ImporterTestCase(TestCase):
 
     def _get_yaml_file(self):
@@ -545,6 +585,25 @@ class ImporterTestCase(TestCase):
         importer.create_registry()
         assert importer.state == ImportState.SOUND
 
+    def test_reimport_unchanged(self):
+        yaml_file = self._get_yaml_file()
+        importer = Importer()
+        importer.load_yaml(yaml_file)
+        importer.create_registry(dry_run=True)
+        self.assertTrue(importer.changes["CommonDataElement"]["created"] > 0)
+        self.assertFalse(CommonDataElement.objects.exists())
+
+        importer = Importer()
+        importer.load_yaml(yaml_file)
+        importer.create_registry()
+        reimporter = Importer()
+        reimporter.load_yaml(yaml_file)
+        reimporter.create_registry()
+        self.assertEqual(reimporter.state, ImportState.SOUND)
+        for model_name in ["CDEPermittedValueGroup", "CDEPermittedValue", "CommonDataElement", "Section"]:
+            changes = reimporter.changes[model_name]
+            self.assertEqual((changes["created"], changes["updated"], changes["deleted"]), (0, 0, 0), model_name)
+
 
 class FormTestCase(RDRFTestCase):
 
@@ -638,6 +697,18 @@ class FormTestCase(RDRFTestCase):
         request.user = get_user_model().objects.get(username="curator")
         return request
 
+    def _save_simple_form(self, **values):
+        # posts the simple form of the patient's default context with the given cde values
+        ff = FormFiller(self.simple_form)
+        for section in (self.sectionA, self.sectionB):
+            for cde_code in section.get_elements():
+                if cde_code in values:
+                    ff.add_data(section, cde_code, values[cde_code])
+        request = self._create_request(self.simple_form, ff.data)
+        view = FormView()
+        view.request = request
+        return view.post(request, self.registry.code, self.simple_form.pk, self.patient.pk, self.default_context.pk)
+
     def create_sections(self):
         # "simple" sections ( no files or multi-allowed sections
         self.sectionA = self.create_section(
@@ -791,6 +862,464 @@ class LongitudinalTestCase(FormTestCase):
                           "Each  snapshot should record dict contain a forms field")
 
 
+class DeferredSnapshotTestCase(FormTestCase):
+
+    def test_written_once(self):
+        self._save_simple_form(CDEName="Fred", CDEAge=20)
+
+        wrapper = DynamicDataWrapper(self.patient, rdrf_context_id=self.default_context.pk)
+        record = wrapper._get_record(self.registry.code, "cdes").first()
+        snapshot = wrapper._make_snapshot(self.registry.code, record, form_name=self.simple_form.name)
+        snapshot["save_id"] = "test"
+        history = ClinicalData.objects.collection(self.registry.code, "history").find(self.patient)
+        count = history.count()
+        # a redelivered task does not write the snapshot again
+        self.assertTrue(wrapper.save_deferred_snapshot(self.registry.code, snapshot))
+        self.assertFalse(wrapper.save_deferred_snapshot(self.registry.code, snapshot))
+        self.assertEqual(history.count(), count + 1)
+
+
+class CompiledRulesTestCase(FormTestCase):
+
+    def test_evaluate_many(self):
+        from rdrf.workflows.rules_engine import CompiledRules
+        self._save_simple_form(CDEName="Fred", CDEAge=20)
+
+        age = "/".join([self.simple_form.name, self.sectionA.code, "CDEAge"])
+        rules = CompiledRules(self.registry, [[[">=", ["get", age], 18], ["workflow", "adult"]],
+                                              [["=", ["get", "CDEName"], "Fred"], ["workflow", "fred"]]])
+        self.assertEqual(list(rules.evaluate_many([self.patient.pk])),
+                         [(self.patient.pk, self.default_context.pk, ["workflow", "adult"])])
+        self.assertEqual(rules.matching_patients([self.patient.pk]), {self.patient.pk})
+        rules = CompiledRules(self.registry, [[["<", ["get", age], 18], ["workflow", "child"]]])
+        self.assertEqual(rules.matching_patients([self.patient.pk]), set())
+
+
+class FieldExpressionTestCase(FormTestCase):
+
+    def test_evaluate_many(self):
+        from rdrf.db.generalised_field_expressions import GeneralisedFieldExpressionParser
+        self._save_simple_form(CDEName="Fred", CDEAge=20)
+
+        parser = GeneralisedFieldExpressionParser(self.registry)
+        age = "/".join([self.simple_form.name, self.sectionA.code, "CDEAge"])
+        self.assertIs(parser.parse(age), parser.parse(age))
+        values = parser.evaluate_many([self.patient], [age, "family_name"])
+        self.assertEqual(values, {self.patient.pk: [20, self.patient.family_name]})
+        self.assertEqual(values[self.patient.pk],
+                         [self.patient.evaluate_field_expression(self.registry, expression)
+                          for expression in [age, "family_name"]])
+
+
+class PatientReportTestCase(FormTestCase):
+
+    def test_batch_markdown(self):
+        from rdrf.services.io.actions.patient_report import BatchReport, ReportParser
+        self._save_simple_form(CDEName="Fred", CDEAge=20)
+
+        spec = "{{family_name}}: {{%s/%s/CDEName}} {{CDEAge}}" % (self.simple_form.name, self.sectionA.code)
+        parser = ReportParser(self.registry, "report", spec, self.user, self.patient)
+        batch = BatchReport(self.registry, "report", spec, self.user, [self.patient])
+        markdowns = batch._get_markdowns([self.patient])
+        self.assertEqual(markdowns, [(parser.filename, parser.get_markdown())])
+        self.assertEqual(parser.get_markdown(), "%s: Fred 20" % self.patient.family_name)
+
+
+class PatientStatusReportTestCase(FormTestCase):
+
+    def _add_record(self, patient, context, name, timestamp):
+        data = {"django_id": patient.pk,
+                "django_model": "Patient",
+                "context_id": context.pk,
+                "timestamp": timestamp,
+                "forms": [{"name": self.simple_form.name,
+                           "sections": [{"code": self.sectionA.code,
+                                         "allow_multiple": False,
+                                         "cdes": [{"code": "CDEName", "value": name},
+                                                  {"code": "CDEAge", "value": 20}]}]}]}
+        ClinicalData.objects.create(registry_code=self.registry.code,
+                                    collection="cdes",
+                                    data=data,
+                                    django_id=patient.pk,
+                                    django_model="Patient",
+                                    context_id=context.pk)
+
+    def test_preload_matches_per_patient_queries(self):
+        from unittest.mock import patch
+        from rdrf.models.definition.models import ContextFormGroup, ContextFormGroupItem, RDRFContext
+        from rdrf.models.definition.models import ConsentSection, ConsentQuestion, CustomAction
+        from rdrf.services.io.actions import patient_status_report
+        from rdrf.services.io.actions.patient_status_report import ReportGenerator, get_timestamp
+        from rdrf.helpers.utils import format_date
+        from registry.patients.models import ConsentValue
+
+        class PerPatientReport(ReportGenerator):
+            # the queries per patient and cell the batch preload replaced
+
+            def _preload(self, patient_models):
+                pass
+
+            def _get_context(self, patient_model):
+                return self._get_fixed_context(patient_model.context_models)
+
+            def _load_patient_data(self, patient_model, context_id):
+                return patient_model.get_dynamic_data(self.registry_model, context_id=context_id)
+
+            def _get_followup_date(self, patient_model, context_form_group_name, form_name):
+                cfg = ContextFormGroup.objects.get(registry=self.registry_model, name=context_form_group_name)
+                latest_date = None
+                for context_model in patient_model.context_models:
+                    if context_model.context_form_group and context_model.context_form_group.pk == cfg.pk:
+                        try:
+                            clinical_data = ClinicalData.objects.get(context_id=context_model.pk,
+                                                                     django_model="Patient",
+                                                                     collection="cdes",
+                                                                     django_id=patient_model.pk)
+                            timestamp = get_timestamp(clinical_data.data)
+                            if latest_date is None or timestamp > latest_date:
+                                latest_date = timestamp
+                        except ClinicalData.DoesNotExist:
+                            pass
+                return format_date(latest_date) if latest_date is not None else ""
+
+            def _get_consent(self, patient_model, consent_section_code, consent_code, get_date=False):
+                for consent_section in self.registry_model.consent_sections.all():
+                    if consent_section.code == consent_section_code:
+                        for consent_question in consent_section.questions.all():
+                            if consent_question.code == consent_code:
+                                try:
+                                    consent_value = ConsentValue.objects.get(patient=patient_model,
+                                                                             consent_question=consent_question)
+                                except ConsentValue.DoesNotExist:
+                                    return "" if get_date else "False"
+                                if get_date:
+                                    return format_date(consent_value.last_update or consent_value.first_save)
+                                return "True"
+                return "" if get_date else "False"
+
+        cfg = ContextFormGroup.objects.create(registry=self.registry, context_type="F", name="Status")
+        ContextFormGroupItem.objects.create(context_form_group=cfg, registry_form=self.simple_form)
+        harry, harry_context = self.patient, self.default_context
+        sally = self.create_patient()
+        sally.working_groups.add(self.wg)
+        sally_context = self.default_context
+        nobody = self.create_patient()
+        nobody.working_groups.add(self.wg)
+        RDRFContext.objects.filter(pk__in=[harry_context.pk, sally_context.pk, self.default_context.pk]) \
+                           .update(context_form_group=cfg)
+        self._add_record(harry, harry_context, "Harry", "2020-05-01T10:00:00")
+        self._add_record(sally, sally_context, "Sally", "2021-02-03T10:00:00")
+
+        consent_section = ConsentSection.objects.create(code="status", section_label="Status", registry=self.registry)
+        consent_question = ConsentQuestion.objects.create(code="agree", position=1, section=consent_section,
+                                                          question_label="Agree")
+        ConsentValue.objects.create(patient=sally, consent_question=consent_question, answer=True,
+                                    first_save=datetime(2020, 1, 2).date())
+
+        spec = {"context_form_group": "Status",
+                "columns": [{"type": "demographics", "name": "given_names"},
+                            {"type": "demographics", "name": "date_of_birth"},
+                            {"type": "cde", "name": "simple/sectionA/CDEName"},
+                            {"type": "completion", "name": "simple"},
+                            {"type": "%", "name": "simple"},
+                            {"type": "consent", "name": "status/agree"},
+                            {"type": "consent_date", "name": "status/agree"},
+                            {"type": "followup_date", "name": "simple", "context_form_group": "Status"}]}
+        custom_action = CustomAction.objects.create(registry=self.registry, code="status", name="Status",
+                                                    action_type="SR", scope="U", data=json.dumps(spec))
+
+        def report(generator_class):
+            generator = generator_class(custom_action, self.registry, "status", custom_action.data, self.user, None)
+            generator.generate_report()
+            return list(generator.report)
+
+        with patch.object(patient_status_report, "BATCH_SIZE", 2):
+            rows = report(ReportGenerator)
+        self.assertEqual(rows, report(PerPatientReport))
+        self.assertEqual(len(rows), 4)
+
+
+class PatientListingOrderTestCase(FormTestCase):
+
+    def test_code_field_order(self):
+        from rdrf.views.patients_listing import ColumnCodeField
+        self.patient.sex = "1"
+        self.patient.save()
+        for sex, patient_type in [("2", "carrier"), ("2", None), ("3", None), ("1", "index"), ("2", "Affected")]:
+            patient = self.create_patient()
+            patient.sex = sex
+            patient.patient_type = patient_type
+            patient.save()
+        column = ColumnCodeField("Code", "patients.can_see_code_field")
+        patients = Patient.objects.filter(rdrf_registry=self.registry)
+        for sort_direction in ["asc", "desc"]:
+            ordered = [p.code_field for p in patients.order_by(*column.order_by(sort_direction))]
+            self.assertEqual(ordered, sorted(ordered, reverse=sort_direction == "desc"))
+
+
+class PatientSearchTestCase(FormTestCase):
+
+    def test_search_patients(self):
+        from registry.patients.search import index_patients, search_patients, working_group_patients
+        self.patient.family_name = "Smithers"
+        self.patient.given_names = "Harry"
+        self.patient.save()
+        patients = working_group_patients(Patient.objects.all(), [self.wg])
+        self.assertEqual(list(search_patients(patients, "smith")), [self.patient])
+        self.assertEqual(list(search_patients(patients, "harry smith")), [self.patient])
+        self.assertEqual(list(search_patients(patients, "jones")), [])
+        self.assertEqual(list(search_patients(patients, "")), [])
+        other_group = WorkingGroup.objects.create(name="othergroup", registry=self.registry)
+        self.assertEqual(list(search_patients(working_group_patients(Patient.objects.all(), [other_group]), "smith")),
+                         [])
+        self.assertEqual(list(search_patients(index_patients(patients), "smith")), [self.patient])
+
+
+class ContextExportImportTestCase(FormTestCase):
+
+    def test_timestamps_kept(self):
+        import tempfile
+        from rdrf.models.definition.models import RDRFContext
+        from rdrf.services.io.content.export_import.exporters import ModelExporter
+        from rdrf.services.io.content.export_import.importers import ModelImporter
+        exported_at = datetime(2001, 2, 3, 4, 5, 6)
+        RDRFContext.objects.update(created_at=exported_at, last_updated=exported_at)
+        timestamps = sorted(RDRFContext.objects.values_list("object_id", "created_at", "last_updated"))
+        workdir = tempfile.mkdtemp()
+        exporter = ModelExporter("rdrf.RDRFContext", logger)
+        exporter.export(workdir=workdir)
+
+        RDRFContext.objects.all().delete()
+        ModelImporter().do_import(exporter.get_meta_info(), workdir, logger=logger)
+        self.assertEqual(sorted(RDRFContext.objects.values_list("object_id", "created_at", "last_updated")),
+                         timestamps)
+        self.assertTrue(RDRFContext._meta.get_field("created_at").auto_now_add)
+
+
+class FormClassCacheTestCase(FormTestCase):
+
+    def test_compiled_once(self):
+        from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_section, form_class_cache_stats
+        create_form_class_for_section(self.registry, self.simple_form, self.sectionA)
+        before = form_class_cache_stats()
+        form_class = create_form_class_for_section(self.registry, self.simple_form, self.sectionA)
+        after = form_class_cache_stats()
+        self.assertEqual(after["hits"], before["hits"] + 1)
+        self.assertEqual(after["misses"], before["misses"])
+        self.assertEqual(list(form_class().fields.keys()),
+                         ["%s____%s____%s" % (self.simple_form.name, self.sectionA.code, code)
+                          for code in ["CDEName", "CDEAge"]])
+
+
+class CDEIndexTestCase(FormTestCase):
+
+    def test_query_indexed_cde(self):
+        from rdrf.db.cde_index import CDEQuery, CDEQueryError
+        key = settings.FORM_SECTION_DELIMITER.join([self.simple_form.name, self.sectionA.code, "CDEAge"])
+        metadata = self.registry.metadata
+        metadata["indexed_cdes"] = [key]
+        self.registry.metadata_json = json.dumps(metadata)
+        self.registry.save()
+
+        self._save_simple_form(CDEName="Fred", CDEAge=20)
+
+        query = CDEQuery(self.registry)
+        self.assertEqual(query.filter(key, "gte", 18).patient_ids(), [self.patient.pk])
+        self.assertEqual(query.filter(key, "gt", 20).patient_ids(), [])
+        with self.assertRaises(CDEQueryError):
+            query.filter(key.replace("CDEAge", "CDEName"), "eq", "Fred")
+
+
+class FieldValueProjectorTestCase(FormTestCase):
+
+    def _record(self, name, age, items):
+        return {"forms": [{"name": self.simple_form.name,
+                           "sections": [{"code": self.sectionA.code, "allow_multiple": False,
+                                         "cdes": [{"code": "CDEName", "value": name},
+                                                  {"code": "CDEAge", "value": age}]}]},
+                          {"name": self.multi_form.name,
+                           "sections": [{"code": self.sectionC.code, "allow_multiple": True,
+                                         "cdes": [[{"code": "CDEName", "value": item_name},
+                                                   {"code": "CDEAge", "value": item_age}]
+                                                  for item_name, item_age in items]}]}]}
+
+    def _values(self):
+        from explorer.models import FieldValue
+        return {(fv.form.name, fv.cde.code, fv.index): (fv.raw_value, fv.raw_integer)
+                for fv in FieldValue.objects.filter(context=self.default_context)}
+
+    def test_project_diff(self):
+        from explorer.utils import FieldValueProjector
+        projector = FieldValueProjector(self.registry)
+        record = self._record("Fred", 20, [("Bob", 30), ("Jo", 40)])
+        self.assertEqual(projector.project(self.patient.pk, self.default_context, record), (6, 0, 0))
+        self.assertEqual(self._values()[("multi", "CDEAge", 1)], (None, 40))
+        self.assertEqual(projector.project(self.patient.pk, self.default_context, record), (0, 0, 0))
+
+        # a value changed, a value cleared and the second item removed
+        record = self._record("Fred", None, [("Bobby", 30)])
+        self.assertEqual(projector.project(self.patient.pk, self.default_context, record), (0, 2, 2))
+        self.assertEqual(self._values(), {("simple", "CDEName", 0): ("Fred", None),
+                                          ("simple", "CDEAge", 0): (None, None),
+                                          ("multi", "CDEName", 0): ("Bobby", None),
+                                          ("multi", "CDEAge", 0): (None, 30)})
+
+        # the rows of other forms are kept when projecting one form
+        record["forms"][0]["sections"][0]["cdes"][0]["value"] = "Freddy"
+        projector.project(self.patient.pk, self.default_context, record, form_model=self.simple_form)
+        self.assertEqual(self._values()[("simple", "CDEName", 0)], ("Freddy", None))
+        self.assertEqual(len(self._values()), 4)
+
+    def test_projected_once_per_transaction(self):
+        from django.db import connections
+        with self.settings(FIELD_VALUES_PROJECTION="sync"):
+            record = ClinicalData.objects.create(registry_code=self.registry.code,
+                                                 collection="cdes",
+                                                 django_id=self.patient.pk,
+                                                 context_id=self.default_context.pk,
+                                                 data=self._record("Fred", 20, []))
+            record.save()
+        scheduled = [func for _, func in connections["clinical"].run_on_commit
+                     if getattr(func, "field_values_record_id", None) == record.pk]
+        self.assertEqual(len(scheduled), 1)
+
+
+class PivotFieldValuesTestCase(FormTestCase):
+
+    def _record(self, name, height, bmi, items):
+        return {"forms": [{"name": self.simple_form.name,
+                           "sections": [{"code": self.sectionA.code, "allow_multiple": False,
+                                         "cdes": [{"code": "CDEName", "value": name}]},
+                                        {"code": self.sectionB.code, "allow_multiple": False,
+                                         "cdes": [{"code": "CDEHeight", "value": height},
+                                                  {"code": "CDEBMI", "value": bmi}]}]},
+                          {"name": self.multi_form.name,
+                           "sections": [{"code": self.sectionC.code, "allow_multiple": True,
+                                         "cdes": [[{"code": "CDEAge", "value": age}] for age in items]}]}]}
+
+    def _per_row(self, sql_dicts, blank_dict, report_columns, max_items):
+        # the query per context and datatype of each result row the pivot replaced
+        from copy import copy
+        from explorer.models import FieldValue
+        attributes = [("string", "raw_value"), ("range", "display_value"), ("integer", "raw_integer"),
+                      ("float", "raw_float"), ("file", "file_name"), ("boolean", "raw_boolean"),
+                      ("date", "raw_date")]
+        rows = []
+        for d in sql_dicts:
+            row_dict = copy(blank_dict)
+            row_dict.update(d)
+            patient_model = Patient.objects.get(id=int(d['id']))
+            for context_model in patient_model.context_models:
+                row = copy(row_dict)
+                row["context_id"] = context_model.pk
+                qry = FieldValue.objects.filter(registry_id=self.registry.id,
+                                                patient_id=patient_model.pk,
+                                                context_id=context_model.pk,
+                                                column_name__in=report_columns,
+                                                index__lt=max_items)
+                for datatype, attribute in attributes:
+                    for fv in qry.filter(datatype=datatype):
+                        row[fv.column_name] = getattr(fv, attribute)
+                for fv in qry.filter(datatype='calculated'):
+                    row[fv.column_name] = fv.get_calculated_value()
+                rows.append(row)
+        return rows
+
+    def test_pivot_matches_per_row(self):
+        from explorer.models import FieldValue
+        from explorer.utils import DatabaseUtils, FieldValueProjector
+        projector = FieldValueProjector(self.registry)
+        first_context = self.default_context
+        projector.project(self.patient.pk, first_context, self._record("Fred", 1.8, "24.5", [30, 40, 50]))
+        other_patient = self.create_patient()
+        projector.project(other_patient.pk, self.default_context, self._record("Jo", None, "n/a", [20]))
+
+        column_names = sorted(set(FieldValue.objects.values_list("column_name", flat=True)))
+        # one column is left out of the report
+        report_columns = column_names[1:]
+        blank_dict = {column_name: None for column_name in report_columns}
+        sql_dicts = [{"id": self.patient.pk, "family_name": "A"}, {"id": other_patient.pk, "family_name": "B"}]
+
+        database_utils = DatabaseUtils()
+        database_utils.registry_model = self.registry
+        expected = self._per_row(sql_dicts, blank_dict, report_columns, 2)
+        self.assertEqual(len(expected), 2)
+        # a patient no longer in the database is skipped
+        rows = list(database_utils._pivot_field_values(sql_dicts + [{"id": 0}], blank_dict, report_columns, 2))
+        self.assertEqual(rows, expected)
+
+
+class ChangeLogBackfillTestCase(FormTestCase):
+
+    def test_history_read_from_log_after_backfill(self):
+        import io
+        from rdrf.db import change_log
+        # a save writes change rows before the existing history is backfilled
+        self._save_simple_form(CDEName="Fred")
+        self.assertFalse(change_log.is_logged(self.registry.code))
+        call_command("backfill_cde_changes", registry_code=self.registry.code, stdout=io.StringIO())
+        self.assertTrue(change_log.is_logged(self.registry.code))
+
+
+class HistoryDeltaTestCase(TestCase):
+
+    def _record(self, name, items):
+        return {"django_id": 1,
+                "context_id": 2,
+                "timestamp": "2020-01-01 10:00:00",
+                "forms": [{"name": "demographics",
+                           "sections": [{"code": "details",
+                                         "allow_multiple": False,
+                                         "cdes": [{"code": "name", "value": name},
+                                                  {"code": "age", "value": 40}]},
+                                        {"code": "visits",
+                                         "allow_multiple": True,
+                                         "cdes": [[{"code": "visit", "value": item}] for item in items]}]}]}
+
+    def test_round_trip(self):
+        from rdrf.db.history import make_delta, apply_delta
+        base = self._record("Fred", ["a"])
+        record = self._record("Bob", ["a", "b"])
+        record["timestamp"] = "2020-01-02 10:00:00"
+        record["forms"].append({"name": "other", "sections": []})
+        del record["django_id"]
+        delta = make_delta(base, record)
+        self.assertEqual(apply_delta(base, delta), record)
+        self.assertEqual(delta["forms"][0]["sections"][0]["cdes"], {"name": "Bob"})
+        self.assertEqual(apply_delta(base, make_delta(base, base)), base)
+
+    def test_changed_values(self):
+        from rdrf.db.change_log import changed_values
+        previous = self._record("Fred", ["a"])
+        record = self._record("Bob", ["a", "b"])
+        self.assertEqual(sorted(changed_values(previous, record)),
+                         [(("demographics", "details", "name"), "Bob"),
+                          (("demographics", "visits", "visit"), ["a", "b"])])
+        self.assertEqual(len(changed_values(None, previous)), 3)
+        self.assertEqual(changed_values(previous, previous), [])
+
+    def test_load_snapshots_keeps_full_snapshots(self):
+        from rdrf.db.history import load_snapshots
+        snapshot = {"record_type": "snapshot", "record": self._record("Fred", [])}
+        with self.assertNumQueries(0, using="clinical"):
+            self.assertEqual(load_snapshots([snapshot]), [snapshot])
+
+
+class FormProgressPreloadTestCase(FormTestCase):
+
+    def test_preload_matches_single_load(self):
+        from rdrf.forms.progress.form_progress import FormProgress
+        self._save_simple_form(CDEName="Fred")
+
+        expected = FormProgress(self.registry).get_form_progress(self.simple_form, self.patient, self.default_context)
+
+        form_progress = FormProgress(self.registry)
+        form_progress.preload([(self.patient, self.default_context)])
+        with self.assertNumQueries(0, using="clinical"):
+            self.assertEqual(form_progress.get_form_progress(self.simple_form, self.patient, self.default_context),
+                             expected)
+
+
 class DeCamelcaseTestCase(TestCase):
 
     _EXPECTED_VALUE = "Your Condition"
@@ -816,6 +1345,183 @@ class DateFunctionsTestCase(TestCase):
         self.assertEqual(r3, None)
 
 
+class ClinicalDocumentTestCase(TestCase):
+
+    def setUp(self):
+        self.data = {"forms": [{"name": "form1",
+                                "sections": [{"code": "sec1",
+                                              "allow_multiple": False,
+                                              "cdes": [{"code": "cde1", "value": "a"},
+                                                       {"code": "cde2", "value": ""}]},
+                                             {"code": "multi1",
+                                              "allow_multiple": True,
+                                              "cdes": [[{"code": "cde3", "value": 1}],
+                                                       [{"code": "cde3", "value": 2},
+                                                        {"code": "cde4", "value": "b"}]]}]}]}
+
+    def test_single_section_lookup(self):
+        from rdrf.db.clinical_document import ClinicalDocument
+        document = ClinicalDocument(self.data)
+        self.assertEqual(document.value("form1", "sec1", "cde1"), "a")
+        self.assertTrue(("form1", "sec1", "cde2") in document)
+        self.assertFalse(("form1", "sec1", "missing") in document)
+        self.assertEqual(document.value("form2", "sec1", "cde1"), None)
+
+    def test_multisection_lookup(self):
+        from rdrf.db.clinical_document import ClinicalDocument
+        document = ClinicalDocument(self.data)
+        self.assertEqual(document.num_items("form1", "multi1"), 2)
+        self.assertEqual(document.values("form1", "multi1", "cde3"), [1, 2])
+        self.assertEqual(document.item_value("form1", "multi1", "cde4", 1), "b")
+        self.assertEqual(document.item_value("form1", "multi1", "cde4", 0), None)
+        self.assertEqual(document.first_value("form1", "multi1", "cde3"), 1)
+
+    def test_matches_get_cde_value(self):
+        from rdrf.db.clinical_document import ClinicalDocument
+        from rdrf.helpers.utils import get_cde_value
+
+        class M:
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+        form_model = M(name="form1")
+        cde_model = M(code="cde3")
+        for section_model in [M(code="sec1"), M(code="multi1")]:
+            self.assertEqual(get_cde_value(form_model, section_model, cde_model, self.data),
+                             get_cde_value(form_model, section_model, cde_model, ClinicalDocument(self.data)))
+
+
+class MetadataCacheTestCase(TestCase):
+
+    def test_lookup_and_invalidation(self):
+        from rdrf.helpers import metadata_cache
+        cde_model = CommonDataElement.objects.create(code="mcCDE1", name="Before", datatype="string")
+        self.assertEqual(metadata_cache.load_cde("mcCDE1").name, "Before")
+        cde_model.name = "After"
+        cde_model.save()
+        self.assertEqual(metadata_cache.load_cde("mcCDE1").name, "After")
+
+    def test_missing_codes(self):
+        from rdrf.helpers import metadata_cache
+        self.assertIsNone(metadata_cache.get_section("mcMissing"))
+        with self.assertRaises(Section.DoesNotExist):
+            metadata_cache.load_section("mcMissing")
+        with self.assertRaises(CommonDataElement.DoesNotExist):
+            metadata_cache.load_cde("mcMissing")
+
+
+class CalculationGraphTestCase(TestCase):
+
+    def test_affected_in_evaluation_order(self):
+        from rdrf.forms.fields.calculation_graph import CalculationGraph
+        graph = CalculationGraph({"BMI": ["Height", "Weight"],
+                                  "BMICategory": ["BMI"],
+                                  "Age": ["DateOfBirth"]})
+        self.assertEqual(graph.affected(["Weight"]), ["BMI", "BMICategory"])
+        self.assertEqual(graph.affected(["DateOfBirth"]), ["Age"])
+        self.assertEqual(graph.affected(["Unrelated"]), [])
+
+    def test_cycle(self):
+        from rdrf.forms.fields.calculation_graph import CalculationGraph, CalculationGraphError
+        with self.assertRaises(CalculationGraphError):
+            CalculationGraph({"A": ["B"], "B": ["A"]})
+
+    def test_calculated_functions(self):
+        from rdrf.forms.fields.calculation_graph import get_graph
+        graph = get_graph()
+        self.assertIn("CDEBMI", graph.affected(["CDEWeight"]))
+        self.assertIn("INITREVINTERVLC", graph.affected(["FIRSTSEENLC"]))
+
+    def test_changed_codes(self):
+        from rdrf.forms.fields.calculation_graph import changed_codes
+
+        def record(weight, height):
+            return {"forms": [{"name": "Body", "sections": [{"code": "sec", "allow_multiple": False,
+                                                             "cdes": [{"code": "CDEWeight", "value": weight},
+                                                                      {"code": "CDEHeight", "value": height}]}]},
+                              {"name": "Other", "sections": []}]}
+
+        self.assertEqual(changed_codes("Body", record(70, 180), record(72, 180)), {"CDEWeight"})
+        self.assertEqual(changed_codes("Body", record(70, 180), record(70, 180)), set())
+        self.assertEqual(changed_codes("Other", record(70, 180), record(72, 180)), set())
+        self.assertEqual(changed_codes("Body", None, record(70, None)), {"CDEWeight", "CDEHeight"})
+
+
+class ParquetExportTestCase(TestCase):
+
+    def test_convert_value(self):
+        import sqlalchemy as alc
+        from datetime import date
+        from rdrf.reports.parquet_export import convert_value
+        self.assertEqual(convert_value(alc.Integer(), "12"), 12)
+        self.assertEqual(convert_value(alc.Float(), "1.5"), 1.5)
+        self.assertIsNone(convert_value(alc.Float(), "NaN?"))
+        self.assertIsNone(convert_value(alc.Integer(), ""))
+        self.assertEqual(convert_value(alc.Date(), "2019-05-01"), date(2019, 5, 1))
+        self.assertEqual(convert_value(alc.DateTime(), "2019-05-01 10:30:00"), datetime(2019, 5, 1, 10, 30))
+        self.assertEqual(convert_value(alc.String(), 3), "3")
+
+
+class ParquetExtractTestCase(FormTestCase):
+
+    def test_working_group_patients(self):
+        from rdrf.reports.generator import Generator
+        from rdrf.services.io.actions.parquet_extract import get_working_groups
+        working_groups = get_working_groups(self.user, self.registry)
+        self.assertEqual(list(working_groups), [self.wg])
+        generator = Generator(self.registry, db="default", working_groups=working_groups)
+        self.assertEqual(list(generator.patients), [self.patient])
+        other_group = WorkingGroup.objects.create(name="othergroup", registry=self.registry)
+        generator = Generator(self.registry, db="default", working_groups=[other_group])
+        self.assertEqual(list(generator.patients), [])
+
+
+class ReportingRefreshTestCase(TransactionTestCase):
+    # the generator reads and writes through its own connections, which only
+    # see committed data
+    databases = {'default', 'clinical'}
+    fixtures = ['testing_auth', 'testing_users', 'testing_rdrf']
+
+    def setUp(self):
+        from rdrf.db.contexts_api import RDRFContextManager
+        self.registry = Registry.objects.get(code='fh')
+        section = Section.objects.create(code="refreshSection", display_name="Refresh", elements="CDEName")
+        RegistryForm.objects.create(name="refresh", registry=self.registry, sections=section.code)
+        context_manager = RDRFContextManager(self.registry)
+        self.contexts = []
+        for name in ["Harry", "Sally"]:
+            patient = Patient.objects.create(consent=True, given_names=name, family_name="Refresh",
+                                             date_of_birth=datetime(1978, 6, 15))
+            patient.rdrf_registry.set([self.registry])
+            context_model = context_manager.get_or_create_default_context(patient, new_patient=True)
+            self._set_name(patient, context_model, name)
+            self.contexts.append((patient, context_model))
+
+    def _set_name(self, patient, context_model, name):
+        patient.set_form_value(self.registry.code, "refresh", "refreshSection", "CDEName", name,
+                               context_model=context_model)
+
+    def _names(self, generator):
+        rows = generator.reporting_engine.execute("SELECT context_id, refreshsection_cdename FROM refresh")
+        return dict(rows.fetchall())
+
+    def test_refresh_rewrites_changed_contexts_only(self):
+        from unittest.mock import patch
+        from rdrf.reports.generator import Generator
+        generator = Generator(self.registry, db="default")
+        generator.create_tables()
+        (harry, harry_context), (sally, sally_context) = self.contexts
+        self.assertEqual(self._names(generator), {harry_context.pk: "Harry", sally_context.pk: "Sally"})
+        # rows which are rewritten lose the marker
+        generator.reporting_engine.execute("UPDATE refresh SET refreshsection_cdename = 'unchanged'")
+
+        self._set_name(sally, sally_context, "Sal")
+        with patch("rdrf.reports.generator.REFRESH_OVERLAP", timedelta(0)):
+            # patient by patient extraction refreshes in batches too
+            Generator(self.registry, db="default", batch_size=None).refresh_tables()
+        self.assertEqual(self._names(generator), {harry_context.pk: "unchanged", sally_context.pk: "Sal"})
+
+
 class FakeClinicalData(object):
     def __init__(self, pk, data):
         self.pk = pk
@@ -1808,6 +2514,22 @@ class UpdateCalculatedFieldsTestCase(FormTestCase):
             db_record)
         self.assertEqual(cdebmi_value, "25.96")
 
+    def test_bulk_run_updates_cde_index(self):
+        from rdrf.db import cde_index
+        key = settings.FORM_SECTION_DELIMITER.join([self.simple_form.name, self.sectionB.code, "CDEBMI"])
+        metadata = self.registry.metadata
+        metadata["indexed_cdes"] = [key]
+        self.registry.metadata_json = json.dumps(metadata)
+        self.registry.save()
+        cde_index.rebuild(self.registry)
+        query = cde_index.CDEQuery(self.registry).filter(key, "eq", 25.96)
+        self.assertEqual(query.patient_ids(), [])
+
+        call_command('update_calculated_fields', registry_code=[self.registry.code], patient_id=[self.patient.id],
+                     workers=1)
+
+        self.assertEqual(query.patient_ids(), [self.patient.pk])
+
 
 class CICImporterTestCase(TestCase):
     """
@@ -10,11 +10,12 @@ from django.forms.formsets import formset_factory
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.models import RegistryForm, Registry, QuestionnaireResponse
 from rdrf.models.definition.models import Section, CommonDataElement, ClinicalData
 from registry.patients.models import Patient, ParentGuardian
 from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_section
-from rdrf.db.dynamic_data import DynamicDataWrapper
+from rdrf.db.dynamic_data import DynamicDataWrapper, build_form_data
 from django.http import Http404
 from rdrf.forms.file_upload import wrap_fs_data_for_form
 from rdrf.forms.file_upload import wrap_file_cdes
@@ -31,7 +32,6 @@ from rdrf.helpers.utils import anonymous_not_allowed
 
 from rdrf.db.contexts_api import RDRFContextManager
 from rdrf.db.contexts_api import RDRFContextError
-from explorer.utils import create_field_values
 
 
 from django.shortcuts import redirect
@@ -48,6 +48,7 @@ from rdrf.services.rpc.actions import ActionExecutor
 from rdrf.helpers.utils import FormLink
 from rdrf.forms.dynamic.dynamic_forms import create_form_class_for_consent_section
 from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.forms.fields.calculation_graph import changed_codes, recalculate_dependents
 
 from rdrf.forms.navigation.locators import PatientLocator
 from rdrf.forms.components import RDRFContextLauncherComponent
@@ -154,21 +155,23 @@ class SectionInfo(object):
         self.form_set_class = form_set_class
         self.prefix = prefix
 
-    def save(self):
+    def save(self, commit=True):
         if not self.is_multiple:
             self.patient_wrapper.save_dynamic_data(
-                self.registry_code, self.collection_name, self.data)
+                self.registry_code, self.collection_name, self.data, commit=commit)
         else:
             self.patient_wrapper.save_dynamic_data(self.registry_code,
                                                    self.collection_name,
                                                    self.data,
                                                    multisection=True,
-                                                   index_map=self.index_map)
+                                                   index_map=self.index_map,
+                                                   commit=commit)
 
-    def recreate_form_instance(self):
+    def recreate_form_instance(self, current_data=None):
         # called when all sections on a form are valid
         # We do this to create a form instance which has correct links to uploaded files
-        current_data = self.patient_wrapper.load_dynamic_data(self.registry_code, "cdes")
+        if current_data is None:
+            current_data = self.patient_wrapper.load_dynamic_data(self.registry_code, "cdes")
         if self.is_multiple:
             # the cleaned data from the form submission
             dynamic_data = self.data[self.section_code]
@@ -471,6 +474,22 @@ class FormView(View):
         # the ids of each cde on the form
         return ",".join(form_class().fields.keys())
 
+    def _recalculate_dependents(self, registry_model, patient_model, dyn_patient, form_model, changed_codes):
+        # the browser updates the calculated cdes of this form only
+        if dyn_patient.rdrf_context_id == "add" or not changed_codes:
+            return []
+        context_model = RDRFContext.objects.filter(pk=dyn_patient.rdrf_context_id).first()
+        try:
+            return recalculate_dependents(patient_model,
+                                          registry_model,
+                                          context_model,
+                                          form_model.name,
+                                          changed_codes,
+                                          self.request.user)
+        except Exception as ex:
+            logger.error("error recalculating dependent calculated fields: %s" % ex)
+            return []
+
     @method_decorator(anonymous_not_allowed)
     @login_required_method
     def post(self, request, registry_code, form_id, patient_id, context_id=None):
@@ -540,9 +559,12 @@ class FormView(View):
         # this is used by formset plugin:
         # the full ids on form eg { "section23": ["form23^^sec01^^CDEName", ... ] , ...}
         section_field_ids_map = {}
+        # the record before this save, read once for all the sections
+        current_record = dyn_patient.load_dynamic_data(self.registry.code, "cdes", flattened=False)
+        current_data = build_form_data(current_record) if current_record is not None else None
 
         for section_index, s in enumerate(sections):
-            section_model = Section.objects.get(code=s)
+            section_model = metadata_cache.load_section(s)
             form_class = create_form_class_for_section(
                 registry,
                 form_obj,
@@ -569,7 +591,6 @@ class FormView(View):
                         dynamic_data,
                         form_class=form_class)
                     sections_to_save.append(section_info)
-                    current_data = dyn_patient.load_dynamic_data(self.registry.code, "cdes")
                     form_data = wrap_file_cdes(
                         registry_code, dynamic_data, current_data, multisection=False)
                     form_section[s] = form_class(dynamic_data, initial=form_data)
@@ -609,7 +630,6 @@ class FormView(View):
                     for i in reversed(to_remove):
                         del dynamic_data[i]
 
-                    current_data = dyn_patient.load_dynamic_data(self.registry.code, "cdes")
                     section_dict = {s: dynamic_data}
                     section_info = SectionInfo(s,
                                                dyn_patient,
@@ -643,48 +663,30 @@ class FormView(View):
             # to any upload files won't work
             # If any are invalid, nothing needs to be done as the forms have already been created from the form
             # submission data
+            # the sections update the record in memory, which is written once
+            for section_info in sections_to_save:
+                section_info.save(commit=False)
+            record = dyn_patient.commit_dynamic_data(registry_code, "cdes")
+            saved_data = build_form_data(record.data) if record is not None else None
             for section_info in sections_to_save:
-                section_info.save()
-                form_instance = section_info.recreate_form_instance()
+                form_instance = section_info.recreate_form_instance(saved_data)
                 form_section[section_info.section_code] = form_instance
 
-            progress_dict = dyn_patient.save_form_progress(
-                registry_code, context_model=self.rdrf_context)
-            # Save one snapshot after all sections have being persisted
-            dyn_patient.save_snapshot(
-                registry_code,
-                "cdes",
-                form_name=form_obj.name,
-                form_user=self.request.user.username)
-
-            # save report friendly field values
-            try:
-                if self.rdrf_context:
-                    create_field_values(registry,
-                                        patient,
-                                        self.rdrf_context,
-                                        remove_existing=True,
-                                        form_model=form_obj)
-            except Exception as ex:
-                logger.warning("error creating field values: %s" % ex)
-                raise
+            changed = changed_codes(form_obj.name, current_record, record.data) if record is not None else set()
+            recalculated = self._recalculate_dependents(registry, patient, dyn_patient, form_obj, changed)
+            # the progress is computed from the saved record unless
+            # recalculated fields have changed it since
+            nested_data = record.data if record is not None and not recalculated else None
 
             if self.CREATE_MODE and dyn_patient.rdrf_context_id != "add":
                 # we've created the context on the fly so no redirect to the edit view on
                 # the new context
                 newly_created_context = RDRFContext.objects.get(id=dyn_patient.rdrf_context_id)
                 dyn_patient.save_form_progress(
-                    registry_code, context_model=newly_created_context)
-
-                try:
-                    create_field_values(registry,
-                                        patient,
-                                        newly_created_context,
-                                        remove_existing=True,
-                                        form_model=form_obj)
-                # TODO: the following line is smelly - it is eating all exceptions.
-                except Exception as ex:
-                    logger.warning("Error creating field values for new context: %s" % ex)
+                    registry_code, context_model=newly_created_context, dynamic_data=nested_data)
+                dyn_patient.save_snapshot(registry_code, "cdes", form_name=form_obj.name,
+                                          form_user=self.request.user.username,
+                                          record=record if not recalculated else None)
 
                 return HttpResponseRedirect(
                     reverse(
@@ -698,16 +700,31 @@ class FormView(View):
             if dyn_patient.rdrf_context_id == "add":
                 raise Exception("Content not created")
 
+            progress_dict = dyn_patient.save_form_progress(
+                registry_code, context_model=self.rdrf_context, dynamic_data=nested_data)
+            # Save one snapshot after all sections have being persisted -
+            # written after the commit in a celery task if
+            # settings.FORM_SAVE_SIDE_EFFECTS is "async"
+            dyn_patient.save_snapshot(
+                registry_code,
+                "cdes",
+                form_name=form_obj.name,
+                form_user=self.request.user.username,
+                record=record if not recalculated else None)
+
+            # the report friendly field values follow the saves of the cdes
+            # record ( see explorer.models.clinical_data_saved )
+
             if registry.has_feature("rulesengine"):
-                rules_block = registry.metadata.get("rules", {})
-                form_rules = rules_block.get(form_obj.name, [])
+                from rdrf.workflows.rules_engine import get_compiled_rules
+                form_rules = get_compiled_rules(registry, form_obj.name)
                 if len(form_rules) > 0:
                     # this may redirect or produce side effects
                     rules_evaluation_context = {"patient_model": patient,
                                                 "registry_model": registry,
                                                 "form_name": form_obj.name,
                                                 "context_id": self.rdrf_context.pk,
-                                                "clinical_data": None}
+                                                "clinical_data": nested_data}
                     action_result = self._evaluate_form_rules(form_rules, rules_evaluation_context)
                     if isinstance(action_result, HttpResponseRedirect):
                         return action_result
@@ -823,7 +840,7 @@ class FormView(View):
         ids = {}
         for s in section_parts:
             try:
-                sec = Section.objects.get(code=s.strip())
+                sec = metadata_cache.load_section(s.strip())
                 display_names[s] = sec.display_name
                 ids[s] = sec.id
                 sections.append(s)
@@ -884,7 +901,7 @@ class FormView(View):
                 self.dynamic_data['questionnaire_context'] = 'au'
 
         for s in sections:
-            section_model = Section.objects.get(code=s)
+            section_model = metadata_cache.load_section(s)
             form_class = self._get_form_class_for_section(
                 self.registry, self.registry_form, section_model)
             section_elements = section_model.get_elements()
@@ -1222,7 +1239,7 @@ class QuestionnaireView(FormView):
         section_field_ids_map = {}
 
         for section in sections:
-            section_model = Section.objects.get(code=section)
+            section_model = metadata_cache.load_section(section)
             section_elements = section_model.get_elements()
             section_element_map[section] = section_elements
             form_class = create_form_class_for_section(
@@ -1329,7 +1346,7 @@ class QuestionnaireView(FormView):
 
                     def _get_label(self, delimited_key):
                         _, _, cde_code = delimited_key.split("____")
-                        cde_model = CommonDataElement.objects.get(code=cde_code)
+                        cde_model = metadata_cache.load_cde(cde_code)
                         return cde_model.name
 
                     def _get_answer(self):
@@ -1358,7 +1375,7 @@ class QuestionnaireView(FormView):
 
                     def _get_cde_model(self):
                         _, _, cde_code = self.delimited_key.split("____")
-                        return CommonDataElement.objects.get(code=cde_code)
+                        return metadata_cache.load_cde(cde_code)
 
                 def get_question(form_model, section_model, cde_model, data_map):
                     from rdrf.helpers.utils import mongo_key_from_models
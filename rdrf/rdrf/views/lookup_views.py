@@ -22,8 +22,8 @@ class PatientLookup(View):
     def get(self, request, reg_code):
         from rdrf.models.definition.models import Registry
         from registry.patients.models import Patient
+        from registry.patients.search import search_patients, working_group_patients
         from registry.groups.models import WorkingGroup
-        from django.db.models import Q
 
         term = None
         results = []
@@ -39,14 +39,11 @@ class PatientLookup(View):
                         wg for wg in WorkingGroup.objects.filter(
                             registry=registry_model)]
 
-                query = (Q(given_names__icontains=term) | Q(family_name__icontains=term)) & \
-                    Q(working_groups__in=working_groups)
-
-                for patient_model in Patient.objects.filter(query):
-                    if patient_model.active:
-                        name = "%s" % patient_model
-                        results.append({"value": patient_model.pk, "label": name,
-                                        "class": "Patient", "pk": patient_model.pk})
+                patients = working_group_patients(Patient.objects.filter(active=True), working_groups)
+                for patient_model in search_patients(patients, term):
+                    name = "%s" % patient_model
+                    results.append({"value": patient_model.pk, "label": name,
+                                    "class": "Patient", "pk": patient_model.pk})
 
         except Registry.DoesNotExist:
             results = []
@@ -8,13 +8,15 @@ from django.shortcuts import redirect, get_object_or_404
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
-from django.db.models import Q
+from django.db.models import Case, CharField, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Lower
 from django.core.paginator import Paginator, InvalidPage
 from rdrf.models.definition.models import Registry
 from rdrf.forms.progress.form_progress import FormProgress
+from rdrf.db.cde_index import CDEQuery, CDEQueryError
 from rdrf.db.contexts_api import RDRFContextManager
 from rdrf.forms.components import FormGroupButton
-from registry.patients.models import Patient
+from registry.patients.models import Patient, PatientSummary
 from rdrf.helpers.utils import MinType
 from rdrf.helpers.utils import consent_check
 from django.utils.translation import ugettext as _
@@ -162,6 +164,8 @@ class PatientsListingView(View):
                 return 0
 
         self.search_term = request.POST.get("search[value]") or ""
+        # json list of [ form____section____cde key, operator, value ] on indexed cdes
+        self.cde_filters = self._get_cde_filters(request.POST.get("cde_filters"))
         self.draw = getint("draw")  # unknown
         self.start = getint("start")  # offset
         self.length = getint("length")  # page size
@@ -171,6 +175,15 @@ class PatientsListingView(View):
 
         self.columns = self.get_configure_columns()
 
+    def _get_cde_filters(self, cde_filters):
+        if not cde_filters:
+            return None
+        try:
+            return CDEQuery.from_spec(self.registry_model, json.loads(cde_filters))
+        except (ValueError, CDEQueryError) as ex:
+            logger.warning("ignoring cde filters %s: %s" % (cde_filters, ex))
+            return None
+
     def get_results(self, request):
         if self.registry_model is None:
             return []
@@ -213,6 +226,7 @@ class PatientsListingView(View):
         self.apply_ordering()
         self.record_total = self.patients.count()
         self.apply_search_filter()
+        self.apply_cde_filters()
         self.filtered_total = self.patients.count()
         return self.get_rows_in_page()
 
@@ -261,9 +275,20 @@ class PatientsListingView(View):
             logger.error("invalid page number: %s" % self.page_number)
             return []
 
+        page.object_list = list(page.object_list)
+        self.preload_progress(page.object_list)
         self.append_rows(page, rows)
         return rows
 
+    def preload_progress(self, patients):
+        # progress is only shown for registries without contexts and read from the
+        # summary where there is one - load the rest of the page in one go
+        if self.supports_contexts:
+            return
+        summary_fields = [col.summary_field for col in self.columns if isinstance(col, ColumnNonContexts)]
+        self.form_progress.preload([(patient, None) for patient in patients
+                                    if any(getattr(patient, field, None) is None for field in summary_fields)])
+
     def append_rows(self, page_object, row_list_to_update):
         if self.registry_model.has_feature("consent_checks"):
             row_list_to_update.extend([self._get_row_dict(obj) for obj in page_object.object_list
@@ -293,14 +318,25 @@ class PatientsListingView(View):
             code=self.registry_model.code)
         self.patients = Patient.objects.all().prefetch_related(
             "working_groups").prefetch_related("rdrf_registry").filter(rdrf_registry__code=self.registry_model.code)
+        self.annotate_summary()
+
+    def annotate_summary(self):
+        # the persisted listing values so they can be sorted and paged on in SQL
+        summaries = PatientSummary.objects.filter(patient=OuterRef("pk"), registry=self.registry_model)
+        self.patients = self.patients.annotate(
+            summary_diagnosis_progress=Subquery(summaries.values("diagnosis_progress")[:1]),
+            summary_diagnosis_currency=Subquery(summaries.values("diagnosis_currency")[:1]),
+            summary_has_genetic_data=Subquery(summaries.values("has_genetic_data")[:1]))
 
     def apply_search_filter(self):
         if self.search_term:
-            q1 = Q(given_names__icontains=self.search_term)
-            q2 = Q(family_name__icontains=self.search_term)
-            q3 = Q(deident__icontains=self.search_term)
-            qry = q1 | q2 | q3
-            self.patients = self.patients.filter(qry)
+            # the listing keeps its own ordering and paging, so only the filter is shared
+            from registry.patients.search import search_filter
+            self.patients = self.patients.filter(search_filter(self.search_term))
+
+    def apply_cde_filters(self):
+        if self.cde_filters:
+            self.patients = self.cde_filters.filter_patients(self.patients)
 
     def filter_by_user_group(self):
         if not self.user.is_superuser:
@@ -333,10 +369,7 @@ class PatientsListingView(View):
 
     def apply_ordering(self):
         if self.sort_field and self.sort_direction:
-            def sdir(field):
-                return "-" + field if self.sort_direction == "desc" else field
-
-            sort_fields = chain(*[map(sdir, col.sort_fields)
+            sort_fields = chain(*[col.order_by(self.sort_direction)
                                   for col in self.columns
                                   if col.field == self.sort_field])
 
@@ -369,6 +402,9 @@ class Column(object):
     def get_sort_value_for_none(self):
         return self.bottom
 
+    def order_by(self, sort_direction):
+        return ["-" + field if sort_direction == "desc" else field for field in self.sort_fields]
+
     def sort_key(self, supports_contexts=False,
                  form_progress=None, context_manager=None):
 
@@ -436,34 +472,46 @@ class ColumnDateOfBirth(Column):
 
 class ColumnCodeField(Column):
     field = 'code_field'
-    sort_fields = []
+    sort_fields = ["sex", "patient_type"]
+
+    def order_by(self, sort_direction):
+        # the order of the displayed code ( see Patient.code_field ): the sex label
+        # in the current language, then the patient type, patients without one first
+        sex_label = Case(*[When(sex=code, then=Value(str(label))) for code, label in Patient.SEX_CHOICES],
+                         output_field=CharField())
+        patient_type = Lower("patient_type")
+        if sort_direction == "desc":
+            return [sex_label.desc(), patient_type.desc(nulls_last=True)]
+        return [sex_label.asc(), patient_type.asc(nulls_first=True)]
 
 
 class ColumnNonContexts(Column):
-    sort_fields = []
+    # annotation holding the persisted value ( see PatientsListingView.annotate_summary )
+    summary_field = None
+
+    @property
+    def sort_fields(self):
+        return [self.summary_field]
+
+    def order_by(self, sort_direction):
+        # patients without a summary sort as the lowest value
+        if sort_direction == "desc":
+            return [F(self.summary_field).desc(nulls_last=True)]
+        return [F(self.summary_field).asc(nulls_first=True)]
 
     def cell(self, patient, supports_contexts=False, form_progress=None, context_manager=None):
         if supports_contexts:
             # if registry supports contexts, should use the context browser
             return None
+        value = getattr(patient, self.summary_field, None)
+        if value is not None:
+            return value
+        # no summary saved yet
         return self.cell_non_contexts(patient, form_progress, context_manager)
 
     def fmt(self, val):
         return self.icon(None) if val is None else self.fmt_non_contexts(val)
 
-    def sort_key(self, supports_contexts=False,
-                 form_progress=None, context_manager=None):
-
-        def sk(patient):
-            value = self.cell(patient, supports_contexts, form_progress, context_manager)
-
-            if value is None:
-                return self.bottom
-            else:
-                return value
-
-        return sk
-
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         pass
 
@@ -484,6 +532,7 @@ class ColumnWorkingGroups(Column):
 
 class ColumnDiagnosisProgress(ColumnNonContexts):
     field = "diagnosis_progress"
+    summary_field = "summary_diagnosis_progress"
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_progress("diagnosis", patient)
@@ -497,6 +546,7 @@ class ColumnDiagnosisProgress(ColumnNonContexts):
 
 class ColumnDiagnosisCurrency(ColumnNonContexts):
     field = "diagnosis_currency"
+    summary_field = "summary_diagnosis_currency"
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_currency("diagnosis", patient)
@@ -507,6 +557,7 @@ class ColumnDiagnosisCurrency(ColumnNonContexts):
 
 class ColumnGeneticDataMap(ColumnNonContexts):
     field = "genetic_data_map"
+    summary_field = "summary_has_genetic_data"
 
     def cell_non_contexts(self, patient, form_progress=None, context_manager=None):
         return form_progress.get_group_has_data("genetic", patient)
@@ -1,3 +1,4 @@
+from rdrf.helpers import metadata_cache
 from rdrf.models.definition.models import RegistryForm, Section, CommonDataElement
 from explorer.views import Humaniser
 from django.urls import reverse
@@ -593,7 +594,7 @@ class _ExistingDataWrapper(object):
         for item in raw_items:
             display_fields = []
             for cde_code in item:
-                cde_model = CommonDataElement.objects.get(code=cde_code)
+                cde_model = metadata_cache.load_cde(cde_code)
                 display_name = cde_model.name
                 raw_value = item[cde_code]
                 display_value = self.humaniser.display_value2(form_model,
@@ -710,8 +711,8 @@ class _Question(object):
         self.question_type = None
         self.form_model = RegistryForm.objects.get(registry=self.registry_model,
                                                    name=form_name)
-        self.section_model = Section.objects.get(code=section_code)
-        self.cde_model = CommonDataElement.objects.get(code=cde_code)
+        self.section_model = metadata_cache.load_section(section_code)
+        self.cde_model = metadata_cache.load_cde(cde_code)
         self.section_code = section_code
         self.cde_code = cde_code
         # raw value to be stored in Mongo ( or a list of values if from a
@@ -788,7 +789,7 @@ class _Question(object):
         if self.cde_code in KEY_MAP:
             demographic_field = KEY_MAP[self.cde_code][0]
             target_expression = demographic_field
-            target_display_name = CommonDataElement.objects.get(code=self.cde_code).name
+            target_display_name = metadata_cache.load_cde(self.cde_code).name
             return TargetCDE(target_display_name, target_expression)
 
         t = self.questionnaire.questionnaire_reverse_mapper.parse_generated_section_code(
@@ -919,7 +920,7 @@ class _MultiSectionItem(object):
     def answer(self):
         fields = []
         for cde_code in self.value_map:
-            cde_model = CommonDataElement.objects.get(code=cde_code)
+            cde_model = metadata_cache.load_cde(cde_code)
             display_name = cde_model.name
             raw_value = self.value_map[cde_code]
             if not self.is_address:
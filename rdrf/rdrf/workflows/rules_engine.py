@@ -1,5 +1,10 @@
-from rdrf.models.definition.models import Section
+import operator
+
+from django.core.exceptions import ObjectDoesNotExist
+
+from rdrf.helpers import metadata_cache
 from rdrf.helpers.utils import get_full_path
+from rdrf.db.clinical_document import ClinicalDocument
 import logging
 
 logger = logging.getLogger(__name__)
@@ -31,91 +36,177 @@ class RulesEvaluationError(Exception):
     pass
 
 
-class RulesEvaluator:
-    def __init__(self, rules, evaluation_context):
-        self.rules = rules
-        self.evaluation_context = evaluation_context
+def _constant(value):
+    return lambda document: value
 
-    def get_action(self):
-        for condition_block, action in self.rules:
-            condition = self._eval(condition_block)
-            if condition:
-                return self._eval_action(action)
 
-    def _eval(self, expr):
+def _fail(message):
+    # raised when ( and only if ) the expression is evaluated, as the
+    # interpreted rules did
+    def fail(document):
+        raise RulesEvaluationError(message)
+    return fail
+
+
+COMPARISONS = {
+    Tokens.EQUALS: operator.eq,
+    Tokens.LT: operator.lt,
+    Tokens.LTE: operator.le,
+    Tokens.GT: operator.gt,
+    Tokens.GTE: operator.ge,
+}
+
+
+class CompiledRules:
+    """
+    Condition / action pairs compiled once into closures over a
+    ClinicalDocument, the cde paths of their gets resolved up front
+    """
+
+    def __init__(self, registry_model, rules):
+        self.registry_model = registry_model
+        self.rules = [(self._compile(condition_block), action) for condition_block, action in rules]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _compile(self, expr):
         # atoms evaluate themselves
         if not isinstance(expr, type([])):
-            return expr
-        else:
-            head = expr[0]
-            if head == Tokens.EQUALS:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) == self._eval(right)
-            elif head == Tokens.GET:
-                cde = expr[1]
-                value = self._get_cde_value(cde)
-                return value
-            elif head == Tokens.AND:
-                rest = expr[1:]
-                return all(map(self._eval, rest))
-            elif head == Tokens.OR:
-                rest = expr[1:]
-                return any(map(self._eval, rest))
-            elif head == Tokens.LT:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) < self._eval(right)
-            elif head == Tokens.GT:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) > self._eval(right)
-            elif head == Tokens.GTE:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) >= self._eval(right)
-            elif head == Tokens.LTE:
-                left = expr[1]
-                right = expr[2]
-                return self._eval(left) <= self._eval(right)
-            elif head == Tokens.IN:
-                element = self._eval(expr[1])
-                a_list = list(map(self._eval, expr[2]))
-                result = element in a_list
-                return result
-            elif head == Tokens.BETWEEN:
-                value = self._eval(expr[1])
-                low = self._eval(expr[2])
-                high = self._eval(expr[3])
-                return value >= low and value <= high
+            return _constant(expr)
+        head = expr[0]
+        if head == Tokens.GET:
+            return self._compile_get(expr[1])
+        elif head in COMPARISONS:
+            compare = COMPARISONS[head]
+            left = self._compile(expr[1])
+            right = self._compile(expr[2])
+            return lambda document: compare(left(document), right(document))
+        elif head == Tokens.AND:
+            rest = [self._compile(e) for e in expr[1:]]
+            return lambda document: all(e(document) for e in rest)
+        elif head == Tokens.OR:
+            rest = [self._compile(e) for e in expr[1:]]
+            return lambda document: any(e(document) for e in rest)
+        elif head == Tokens.IN:
+            element = self._compile(expr[1])
+            a_list = [self._compile(e) for e in expr[2]]
+            return lambda document: element(document) in [e(document) for e in a_list]
+        elif head == Tokens.BETWEEN:
+            value, low, high = [self._compile(e) for e in expr[1:4]]
+
+            def between(document):
+                v = value(document)
+                return v >= low(document) and v <= high(document)
+            return between
+        return _fail("Unknown head: %s" % head)
+
+    def _compile_get(self, field_spec):
+        try:
+            if "/" in field_spec:
+                form_name, section_code, cde_code = field_spec.split("/")
             else:
-                raise RulesEvaluationError("Unknown head: %s" % head)
-
-    def _get_cde_value(self, field_spec):
-        patient_model = self.evaluation_context["patient_model"]
-        registry_model = self.evaluation_context["registry_model"]
-        context_id = self.evaluation_context.get("context_id", None)
-        # faster to load this in
-        clinical_data = self.evaluation_context.get("clinical_data", None)
-
-        if "/" in field_spec:
-            form_name, section_code, cde_code = field_spec.split("/")
-        else:
-            form_name, section_code, cde_code = self._get_unique_field(field_spec)
+                form_name, section_code, cde_code = get_full_path(self.registry_model, field_spec)
+            section_model = metadata_cache.load_section(section_code)
+        except (ValueError, ObjectDoesNotExist) as ex:
+            return _fail("Cannot get %s: %s" % (field_spec, ex))
+
+        if section_model.allow_multiple:
+            return lambda document: [value for value in document.values(form_name, section_code, cde_code) if value]
+        return lambda document: document.value(form_name, section_code, cde_code)
+
+    def match(self, clinical_data):
+        """
+        The action of the first rule whose condition holds for the nested
+        record ( or ClinicalDocument ), None if there is none
+        """
+        document = ClinicalDocument.wrap(clinical_data)
+        for condition, action in self.rules:
+            if condition(document):
+                return action
+        return None
+
+    def evaluate_many(self, patient_ids, context_ids=None, batch_size=500):
+        """
+        Yields ( patient id, context id, action ) for the cdes record of each
+        context of the patients ( only of context_ids if given ), action being
+        that of the first rule holding or None. The records are loaded
+        batch_size patients per query. A record the rules fail on ( eg
+        comparing a missing value ) is logged and gives None.
+        """
+        from rdrf.models.definition.models import ClinicalData
+        patient_ids = list(patient_ids)
+        for start in range(0, len(patient_ids), batch_size):
+            records = ClinicalData.objects.collection(self.registry_model.code, "cdes").filter(
+                django_model="Patient", django_id__in=patient_ids[start:start + batch_size])
+            if context_ids is not None:
+                records = records.filter(context_id__in=context_ids)
+            seen = set()
+            for patient_id, context_id, data in records.values_list("django_id", "context_id", "data"):
+                # the first record of a context is the one the forms show
+                if (patient_id, context_id) in seen:
+                    continue
+                seen.add((patient_id, context_id))
+                try:
+                    action = self.match(data)
+                except (RulesEvaluationError, TypeError) as ex:
+                    logger.warning("rules failed for patient %s context %s: %s" % (patient_id, context_id, ex))
+                    action = None
+                yield patient_id, context_id, action
+
+    def matching_patients(self, patient_ids, context_ids=None):
+        """
+        The ids of the patients a rule holds for in some context
+        """
+        return set(patient_id for patient_id, context_id, action in self.evaluate_many(patient_ids, context_ids)
+                   if action is not None)
+
+
+def get_compiled_rules(registry_model, form_name):
+    """
+    The compiled rules of a form ( the "rules" block of the registry
+    metadata ), cached until the registry definition changes
+    """
+    rules_cache = metadata_cache.get_rules_cache()
+    key = (registry_model.code, form_name)
+    if key not in rules_cache:
+        rules = registry_model.metadata.get("rules", {}).get(form_name, [])
+        rules_cache[key] = CompiledRules(registry_model, rules)
+    return rules_cache[key]
 
-        section_model = Section.objects.get(code=section_code)
 
-        return patient_model.get_form_value(registry_model.code,
-                                            form_name,
-                                            section_code,
-                                            cde_code,
-                                            multisection=section_model.allow_multiple,
-                                            context_id=context_id,
-                                            clinical_data=clinical_data)
+class RulesEvaluator:
+    def __init__(self, rules, evaluation_context):
+        # rules may be compiled already ( see get_compiled_rules )
+        if not isinstance(rules, CompiledRules):
+            rules = CompiledRules(evaluation_context["registry_model"], rules)
+        self.rules = rules
+        self.evaluation_context = evaluation_context
+        self._document = None
 
-    def _get_unique_field(self, cde_code):
-        registry_model = self.evaluation_context["registry_model"]
-        return get_full_path(registry_model, cde_code)
+    def get_action(self):
+        if len(self.rules) == 0:
+            return None
+        action = self.rules.match(self._get_document())
+        if action is not None:
+            return self._eval_action(action)
+
+    def _get_document(self):
+        # the record is loaded and indexed once for all the rules
+        if self._document is None:
+            # faster to load this in - the nested record or a ClinicalDocument
+            clinical_data = self.evaluation_context.get("clinical_data", None)
+            if clinical_data is None:
+                from rdrf.db.dynamic_data import DynamicDataWrapper
+                patient_model = self.evaluation_context["patient_model"]
+                registry_model = self.evaluation_context["registry_model"]
+                context_id = self.evaluation_context.get("context_id", None)
+                wrapper = DynamicDataWrapper(patient_model, rdrf_context_id=context_id)
+                clinical_data = wrapper.load_dynamic_data(registry_model.code, "cdes", flattened=False)
+            if clinical_data is None:
+                raise RulesEvaluationError("No clinical data to evaluate rules against")
+            self._document = ClinicalDocument.wrap(clinical_data)
+        return self._document
 
     def _eval_action(self, action):
         if not isinstance(action, type([])):
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rdrf', '0138_clinicaldata_last_updated'),
+        ('patients', '0037_auto_20200716_1211'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('diagnosis_progress', models.IntegerField(db_index=True, default=0)),
+                ('diagnosis_currency', models.BooleanField(db_index=True, default=False)),
+                ('has_genetic_data', models.BooleanField(db_index=True, default=False)),
+                ('last_updated', models.DateTimeField(auto_now=True, db_index=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='patients.Patient')),
+                ('registry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rdrf.Registry')),
+            ],
+            options={
+                'unique_together': {('patient', 'registry')},
+            },
+        ),
+    ]
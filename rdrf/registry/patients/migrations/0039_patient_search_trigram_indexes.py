@@ -0,0 +1,23 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# the expression the icontains lookup compiles to, see registry.patients.search
+SEARCH_FIELDS = ["family_name", "given_names", "umrn", "deident"]
+
+
+def create_index(field):
+    return migrations.RunSQL(
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS patients_patient_%s_trgm '
+        'ON patients_patient USING gin ((UPPER("%s"::text)) gin_trgm_ops)' % (field, field),
+        reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS patients_patient_%s_trgm' % field)
+
+
+class Migration(migrations.Migration):
+    # indexes are created concurrently, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('patients', '0038_patientsummary'),
+    ]
+
+    operations = [TrigramExtension()] + [create_index(field) for field in SEARCH_FIELDS]
@@ -12,8 +12,9 @@ from django.dispatch import receiver
 from django.conf import settings
 import pycountry
 
+from rdrf.helpers import metadata_cache
 from rdrf.db.dynamic_data import DynamicDataWrapper
-from rdrf.models.definition.models import Registry, Section, ConsentQuestion
+from rdrf.models.definition.models import Registry, ConsentQuestion
 from rdrf.models.definition.models import ClinicalData
 from rdrf.models.workflow_models import ClinicianSignupRequest
 from rdrf.helpers.utils import get_cde_value2
@@ -921,7 +922,7 @@ class Patient(models.Model):
             for cde in cde_complete:
                 cde_section = ""
                 for s in section_array:
-                    section = Section.objects.get(code=s)
+                    section = metadata_cache.load_section(s)
                     if cde["code"] in section.elements.split(","):
                         cde_section = s
                 try:
@@ -1004,7 +1005,7 @@ class Patient(models.Model):
             name_path = multiple_form_group.naming_cde_to_use
             if name_path:
                 form_name, section_code, cde_code = name_path.split("/")
-                section_model = Section.objects.get(code=section_code)
+                section_model = metadata_cache.load_section(section_code)
                 is_multisection = section_model.allow_multiple
 
                 try:
@@ -1584,6 +1585,39 @@ class ConsentValue(models.Model):
             self.patient, self.consent_question, self.answer)
 
 
+class PatientSummary(models.Model):
+    """
+    The computed values shown in the patient listing, persisted so that the
+    listing can sort and page on them in SQL.
+    Written by FormProgress.save_progress for registries without multiple
+    contexts ( the only ones the listing shows these values for ).
+    """
+    patient = models.ForeignKey(Patient, related_name="summaries", on_delete=models.CASCADE)
+    registry = models.ForeignKey(Registry, on_delete=models.CASCADE)
+    diagnosis_progress = models.IntegerField(default=0, db_index=True)
+    diagnosis_currency = models.BooleanField(default=False, db_index=True)
+    has_genetic_data = models.BooleanField(default=False, db_index=True)
+    last_updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        unique_together = ("patient", "registry")
+
+    def __str__(self):
+        return "Summary of %s in %s" % (self.patient, self.registry)
+
+    @classmethod
+    def update_from_progress(cls, registry_model, patient_model, progress_data):
+        """
+        progress_data is the data of a progress record ( see FormProgress._calculate )
+        """
+        cls.objects.update_or_create(
+            patient=patient_model,
+            registry=registry_model,
+            defaults={"diagnosis_progress": progress_data.get("diagnosis_group_progress", 0),
+                      "diagnosis_currency": progress_data.get("diagnosis_group_current", False),
+                      "has_genetic_data": progress_data.get("genetic_group_has_data", False)})
+
+
 @receiver(post_delete, sender=PatientRelative)
 def delete_associated_patient_if_any(sender, instance, **kwargs):
     if instance.relative_patient:
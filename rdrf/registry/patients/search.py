@@ -0,0 +1,65 @@
+"""
+Patient search by name and identifier.
+
+The search fields have trigram GIN indexes ( see migration 0039 ) on the
+UPPER(field) expression the icontains lookup compiles to, so a "contains"
+search of any term does not scan the patient table. Results of a lookup
+are ranked: patients with a field starting with the term first, then by
+trigram similarity.
+
+    search_patients(working_group_patients(Patient.objects.all(), working_groups), "smi")
+"""
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+
+SEARCH_FIELDS = ("family_name", "given_names", "umrn", "deident")
+# the fields similarity is ranked on
+NAME_FIELDS = ("family_name", "given_names")
+
+
+def search_filter(term, fields=SEARCH_FIELDS):
+    """
+    Every word of term is in one of the fields
+    """
+    query = Q()
+    for word in term.split():
+        word_query = Q()
+        for field in fields:
+            word_query |= Q(**{"%s__icontains" % field: word})
+        query &= word_query
+    return query
+
+
+def working_group_patients(patients, working_groups):
+    # a subquery rather than a join so patients in several groups are not repeated
+    from registry.patients.models import Patient
+    memberships = Patient.working_groups.through.objects.filter(workinggroup__in=working_groups)
+    return patients.filter(pk__in=memberships.values("patient_id"))
+
+
+def index_patients(patients):
+    """
+    Active patients who are not the relative of another patient ( Patient.is_index
+    in the query, for registries with family linkage )
+    """
+    return patients.filter(active=True, as_a_relative__isnull=True)
+
+
+def search_patients(patients, term, limit=None):
+    """
+    The patients matching term, best matches first
+    """
+    term = term.strip()
+    if not term:
+        return patients.none()
+    if limit is None:
+        limit = settings.PATIENT_SEARCH_LIMIT
+    prefix = Q()
+    for field in SEARCH_FIELDS:
+        prefix |= Q(**{"%s__istartswith" % field: term})
+    ranked = patients.filter(search_filter(term)).annotate(
+        search_prefix=Case(When(prefix, then=Value(1)), default=Value(0), output_field=IntegerField()),
+        search_similarity=Greatest(*[TrigramSimilarity(field, term) for field in NAME_FIELDS]))
+    return ranked.order_by("-search_prefix", "-search_similarity", "family_name", "given_names", "pk")[:limit]